@@ -0,0 +1,118 @@
+######################################################################
+# Benchmark helpers for sk-entra-id.py
+######################################################################
+# see readme.md for more info.
+#
+# Summarises the durations of enrollment stages timed by the 'benchmark' command (percentiles and
+# keys per hour) and compares them with the previous run with the same settings.
+#
+# DEPENDENCIES:
+#   - Click must be installed on the system
+#
+# BSD 2-Clause License
+# Copyright (c) 2025, swjm.blog
+######################################################################
+
+# Standard Library Imports
+import datetime
+import json
+import math
+import os
+
+# Third-Party Library Imports
+import click
+
+
+# Stages of an enrollment timed by the benchmark (in order)
+benchmark_stages = [
+    "token",
+    "get_user_id",
+    "creation_options",
+    "reset",
+    "set_pin",
+    "make_credential",
+    "activate",
+    "min_pin_length",
+    "secure_transport",
+    "total",
+]
+
+
+# Function to compute a percentile of measured durations
+def percentile(values, p):
+    """
+    Returns the p-th percentile of a list of values (nearest-rank method).
+
+    Args:
+        values (list): The values.
+        p (float): The percentile (0-100).
+
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+# Function to summarise and store the results of a benchmark
+def report_benchmark(timings, elapsed, mode, settings, results_file, version):
+    """
+    Prints p50/p95/p99 per stage and keys per hour, compares them to the previous run with the
+    same mode and settings and appends the results to the results file (one JSON object per line).
+
+    Args:
+        timings (dict): Dictionary mapping stage names to lists of durations in seconds.
+        elapsed (float): Wall-clock seconds the benchmark took.
+        mode (str): 'simulated' or 'hardware'.
+        settings (dict): Settings of the run (e.g., simulated latency), recorded with the results.
+        results_file (str): Path to the results file.
+        version (str): The version of sk-entra-id.py, recorded with the results.
+    """
+    keys = len(timings.get("total", []))
+    result = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "version": version,
+        "mode": mode,
+        "settings": settings,
+        "keys": keys,
+        "keys_per_hour": round(keys / elapsed * 3600, 1) if elapsed else None,
+        "stages": {
+            name: {
+                "count": len(timings[name]),
+                "mean": sum(timings[name]) / len(timings[name]),
+                "p50": percentile(timings[name], 50),
+                "p95": percentile(timings[name], 95),
+                "p99": percentile(timings[name], 99),
+            }
+            for name in benchmark_stages
+            if timings.get(name)
+        },
+    }
+
+    # Find the previous run with the same mode and settings
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file, "r", encoding="utf8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry.get("mode") == mode and entry.get("settings") == settings:
+                        previous = entry
+
+    click.secho(f"{'Stage':<18}{'n':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'vs. last p50':>14}")
+    for name, stats in result["stages"].items():
+        change = ""
+        before = (previous or {}).get("stages", {}).get(name)
+        if before and before["p50"]:
+            change = f"{(stats['p50'] - before['p50']) / before['p50']:+.0%}"
+        click.secho(
+            f"{name:<18}{stats['count']:>5}{stats['p50'] * 1000:>10.1f}"
+            f"{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}{change:>14}"
+        )
+    click.secho(f"Throughput: {result['keys_per_hour']} keys/hour ({keys} key(s) in {elapsed:.1f} seconds)")
+
+    with open(results_file, "a", encoding="utf8") as f:
+        f.write(json.dumps(result) + "\n")
+    click.secho(f"Results appended to '{results_file}'.")
@@ -0,0 +1,574 @@
+######################################################################
+# Coordinator of enrollment stations for sk-entra-id.py
+######################################################################
+# see readme.md for more info.
+#
+# Hands out the users of a shared list to several stations (leasing one user at a time to each),
+# records the enrollments they report, and serves the list over HTTP ('coordinator serve').
+#
+# DEPENDENCIES:
+#   - Click must be installed on the system
+#   - Requests must be installed on the system
+#
+# BSD 2-Clause License
+# Copyright (c) 2025, swjm.blog
+######################################################################
+
+# Standard Library Imports
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Third-Party Library Imports
+import click
+import requests
+
+# Local Imports
+from service import check_listen_address
+
+
+# Set variable to control how long a station holds a job leased from the coordinator, in seconds (renewed while held)
+coordinator_lease = 600
+
+
+# Coordinator distributing the users to enroll to several stations
+class Coordinator:
+    """
+    Distributes the users to enroll to several stations and merges the enrollments they complete, in an SQLite database.
+
+    Each user is one job (User Principal Names are unique), which a station leases for a limited time (see lease())
+    and keeps renewing while it works on it (see renew()). The job of a station that stopped renewing it (e.g., because
+    it crashed) is handed out again once its lease has expired. A completed job records the enrollment, and only one
+    enrollment is accepted per user (see complete()), so that the enrollments of all stations can be exported to one
+    CSV file without duplicate YubiKeys.
+
+    The database is either a file shared by the stations or served to them over HTTP by the 'coordinator serve' command
+    (see create_coordinator_server() and RemoteCoordinator). A shared file uses a rollback journal instead of WAL,
+    which does not work across hosts, and relies on the file locking of the network share.
+    """
+
+    def __init__(self, database_file):
+        """
+        Args:
+            database_file (str): Path to the SQLite database file (created if it does not exist).
+        """
+        self.database_file = database_file
+        self._local = threading.local()
+        with self.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    upn TEXT PRIMARY KEY COLLATE NOCASE,
+                    pin_change INTEGER NOT NULL DEFAULT 1,
+                    nfc_restricted INTEGER NOT NULL DEFAULT 1,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    station TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    added_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+                CREATE TABLE IF NOT EXISTS enrollments (
+                    upn TEXT PRIMARY KEY COLLATE NOCASE,
+                    name TEXT,
+                    model TEXT,
+                    serial_number INTEGER NOT NULL UNIQUE,
+                    pin TEXT,
+                    pin_change INTEGER,
+                    nfc_restricted INTEGER,
+                    auth_method TEXT,
+                    station TEXT NOT NULL,
+                    enrolled_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                """
+            )
+
+    def connect(self):
+        """
+        Returns the database connection of the calling thread, opening it if necessary.
+
+        Returns:
+            sqlite3.Connection: The connection.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_file, timeout=30)
+            connection.execute("PRAGMA journal_mode=DELETE")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in a transaction holding the write lock from the start, so that concurrent stations
+        never lease the same job.
+        """
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def add(self, entries):
+        """
+        Adds jobs for users to enroll. Users who already have a job are skipped, unless their job failed.
+
+        Args:
+            entries (Iterable[dict]): Entries as read from a manifest file (see read_manifest()).
+
+        Returns:
+            int: The number of jobs added (or queued again).
+        """
+        added = 0
+        with self.transaction() as connection:
+            for entry in entries:
+                added += connection.execute(
+                    "INSERT INTO jobs (upn, pin_change, nfc_restricted) VALUES (?, ?, ?) "
+                    "ON CONFLICT (upn) DO UPDATE SET status = 'pending', pin_change = excluded.pin_change, "
+                    "nfc_restricted = excluded.nfc_restricted, station = NULL, lease_expires = NULL, error = NULL "
+                    "WHERE status = 'failed'",
+                    (entry["UPN"], bool(entry["PIN change required"]), bool(entry["Secure Transport Mode"])),
+                ).rowcount
+        return added
+
+    def lease(self, station, count=1, duration=coordinator_lease):
+        """
+        Leases the next pending jobs (or jobs whose lease has expired) to a station.
+
+        Args:
+            station (str): The name of the station.
+            count (int, optional): The maximum number of jobs to lease. Default is 1.
+            duration (float, optional): Seconds until the lease expires. Default is coordinator_lease.
+
+        Returns:
+            list: The leased jobs as dictionaries with the keys 'upn', 'pin_change' and 'nfc_restricted'.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT upn, pin_change, nfc_restricted FROM jobs "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) ORDER BY rowid LIMIT ?",
+                (now, count),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE jobs SET status = 'leased', station = ?, lease_expires = ?, attempts = attempts + 1 WHERE upn = ?",
+                [(station, now + duration, upn) for upn, pin_change, nfc_restricted in rows],
+            )
+        return [
+            {"upn": upn, "pin_change": bool(pin_change), "nfc_restricted": bool(nfc_restricted)}
+            for upn, pin_change, nfc_restricted in rows
+        ]
+
+    def reclaim(self, station, duration=coordinator_lease):
+        """
+        Renews the leases a station held before it was restarted, so that it can pick up its unfinished jobs.
+
+        Args:
+            station (str): The name of the station.
+            duration (float, optional): Seconds until the lease expires. Default is coordinator_lease.
+
+        Returns:
+            list: The jobs leased to the station (see lease()).
+        """
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT upn, pin_change, nfc_restricted FROM jobs WHERE status = 'leased' AND station = ? ORDER BY rowid",
+                (station,),
+            ).fetchall()
+            connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE status = 'leased' AND station = ?", (time.time() + duration, station)
+            )
+        return [
+            {"upn": upn, "pin_change": bool(pin_change), "nfc_restricted": bool(nfc_restricted)}
+            for upn, pin_change, nfc_restricted in rows
+        ]
+
+    def renew(self, station, upns, duration=coordinator_lease):
+        """
+        Extends the leases of jobs held by a station.
+
+        Args:
+            station (str): The name of the station.
+            upns (list): The User Principal Names of the jobs.
+            duration (float, optional): Seconds until the leases expire. Default is coordinator_lease.
+
+        Returns:
+            list: The User Principal Names of the jobs the station still holds (a job that was handed out again after
+                its lease expired is not).
+        """
+        renewed = []
+        with self.transaction() as connection:
+            for upn in upns:
+                if connection.execute(
+                    "UPDATE jobs SET lease_expires = ? WHERE upn = ? AND status = 'leased' AND station = ?",
+                    (time.time() + duration, upn, station),
+                ).rowcount:
+                    renewed.append(upn)
+        return renewed
+
+    def release(self, station, upn):
+        """
+        Hands a job held by a station back, to be leased by any station.
+
+        Args:
+            station (str): The name of the station.
+            upn (str): The User Principal Name of the job.
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'pending', station = NULL, lease_expires = NULL "
+                "WHERE upn = ? AND status = 'leased' AND station = ?",
+                (upn, station),
+            )
+
+    def fail(self, station, upn, error):
+        """
+        Records that a station failed to enroll a user. The job is not handed out again until it is added again.
+
+        Args:
+            station (str): The name of the station.
+            upn (str): The User Principal Name of the job.
+            error (str): The reason the enrollment failed.
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, lease_expires = NULL "
+                "WHERE upn = ? AND status = 'leased' AND station = ?",
+                (error, upn, station),
+            )
+
+    def complete(self, station, record):
+        """
+        Records the enrollment of a user by a station, completing the job (even if its lease has expired).
+
+        Only the first enrollment of a user is accepted: a station reporting another YubiKey for a user who is already
+        enrolled is told which station and YubiKey the user was enrolled with, so that the duplicate can be revoked.
+        Likewise, a YubiKey recorded for another user is not recorded again, and the job fails with the conflict.
+
+        Args:
+            station (str): The name of the station.
+            record (dict): The enrollment, with the columns of the enrollments table of the ledger as keys.
+
+        Returns:
+            dict: 'accepted' (bool) and, if not accepted, the 'upn', 'station' and 'serial_number' of the conflicting
+                enrollment.
+        """
+        serial_number = int(record["serial_number"])
+        with self.transaction() as connection:
+            existing = connection.execute(
+                "SELECT upn, station, serial_number FROM enrollments WHERE upn = ? OR serial_number = ? "
+                "ORDER BY upn = ? DESC",
+                (record["upn"], serial_number, record["upn"]),
+            ).fetchone()
+            if existing and existing[2] == serial_number and existing[0].lower() != record["upn"].lower():
+                connection.execute(
+                    "INSERT INTO jobs (upn, pin_change, nfc_restricted, status, station, error) "
+                    "VALUES (?, ?, ?, 'failed', ?, ?) "
+                    "ON CONFLICT (upn) DO UPDATE SET status = 'failed', station = excluded.station, "
+                    "lease_expires = NULL, error = excluded.error",
+                    (
+                        record["upn"], bool(record["pin_change"]), bool(record["nfc_restricted"]), station,
+                        f"YubiKey {serial_number} is already recorded for '{existing[0]}' by station '{existing[1]}'.",
+                    ),
+                )
+                return {"accepted": False, "upn": existing[0], "station": existing[1], "serial_number": existing[2]}
+            if existing is None or existing[2] == serial_number:
+                connection.execute(
+                    "INSERT OR REPLACE INTO enrollments "
+                    "(upn, name, model, serial_number, pin, pin_change, nfc_restricted, auth_method, station) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        record["upn"], record["name"], record["model"], int(record["serial_number"]), record["pin"],
+                        bool(record["pin_change"]), bool(record["nfc_restricted"]), record.get("auth_method"), station,
+                    ),
+                )
+            connection.execute(
+                "INSERT INTO jobs (upn, pin_change, nfc_restricted, status, station) VALUES (?, ?, ?, 'completed', ?) "
+                "ON CONFLICT (upn) DO UPDATE SET status = 'completed', lease_expires = NULL, error = NULL, "
+                "station = coalesce((SELECT station FROM enrollments WHERE upn = excluded.upn), excluded.station)",
+                (record["upn"], bool(record["pin_change"]), bool(record["nfc_restricted"]), station),
+            )
+        if existing is None or existing[2] == serial_number:
+            return {"accepted": True}
+        return {"accepted": False, "upn": existing[0], "station": existing[1], "serial_number": existing[2]}
+
+    def status(self):
+        """
+        Returns the progress of the jobs.
+
+        Returns:
+            dict: The number of jobs by status ('jobs'), the number of enrollments by station ('stations')
+                and the failed jobs with their station and error ('failed').
+        """
+        connection = self.connect()
+        return {
+            "jobs": dict(connection.execute("SELECT status, count(*) FROM jobs GROUP BY status")),
+            "stations": dict(connection.execute("SELECT station, count(*) FROM enrollments GROUP BY station")),
+            "failed": [
+                {"upn": upn, "station": station, "error": error}
+                for upn, station, error in connection.execute(
+                    "SELECT upn, station, error FROM jobs WHERE status = 'failed' ORDER BY rowid"
+                )
+            ],
+        }
+
+    def enrollments(self, pins=False):
+        """
+        Returns the enrollments of all stations (in order of enrollment).
+
+        Args:
+            pins (bool, optional): Whether to include the PINs. Default is False (the 'pin' column is left out).
+
+        Returns:
+            list: The enrollments as dictionaries (with the columns of the enrollments table as keys).
+        """
+        columns = "upn, name, model, serial_number, pin_change, nfc_restricted, auth_method, station, enrolled_at"
+        cursor = self.connect().execute(
+            f"SELECT {columns}{', pin' if pins else ''} FROM enrollments ORDER BY enrolled_at, rowid"
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+
+# Client of a coordinator served by the 'coordinator serve' command
+class RemoteCoordinator:
+    """
+    Calls the methods of a Coordinator served over HTTP by the 'coordinator serve' command (see create_coordinator_server()).
+    """
+
+    # Methods of Coordinator that can be called remotely
+    methods = ("add", "lease", "reclaim", "renew", "release", "fail", "complete", "status", "enrollments")
+
+    def __init__(self, url, token=None):
+        """
+        Args:
+            url (str): The URL of the coordinator (e.g., 'http://coordinator.example.com:8766').
+            token (str, optional): The bearer token required by the coordinator. Default is none.
+        """
+        self.url = url.rstrip("/")
+        self._session = requests.Session()
+        if token:
+            self._session.headers["Authorization"] = f"Bearer {token}"
+
+    def __getattr__(self, name):
+        if name not in self.methods:
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            if name == "add":
+                args = (list(args[0]),) + args[1:]
+            response = self._session.post(f"{self.url}/{name}", json={"args": args, "kwargs": kwargs}, timeout=30)
+            response.raise_for_status()
+            return response.json()["result"]
+
+        return call
+
+
+# Function to open a coordinator from the location given on the command line
+def open_coordinator(location):
+    """
+    Opens a coordinator.
+
+    Args:
+        location (str): The URL of a coordinator served by the 'coordinator serve' command (with the bearer token, if any,
+            in the SK_ENTRA_ID_TOKEN environment variable), or the path to a shared coordinator database.
+
+    Returns:
+        Coordinator: The coordinator (or a RemoteCoordinator with the same methods).
+    """
+    if location.startswith(("http://", "https://")):
+        return RemoteCoordinator(location, os.environ.get("SK_ENTRA_ID_TOKEN"))
+    return Coordinator(location)
+
+
+# Function to create the HTTP server of a coordinator
+def create_coordinator_server(coordinator, host="127.0.0.1", port=8766, token=None):
+    """
+    Creates the HTTP server serving a coordinator to the stations ('coordinator serve' command).
+
+    Every method of the coordinator listed in RemoteCoordinator.methods is called with POST /{method} and a JSON body
+    holding its 'args' and 'kwargs', and answered with a JSON body holding its 'result'. The PINs of the enrollments
+    (see Coordinator.enrollments()) are only returned when a token is required.
+
+    Args:
+        coordinator (Coordinator): The coordinator.
+        host (str, optional): The address to listen on. Default is localhost.
+        port (int, optional): The port to listen on. Default is 8766.
+        token (str, optional): A bearer token required in the Authorization header of every request. Default is none,
+            which is only allowed on a loopback address.
+
+    Returns:
+        ThreadingHTTPServer: The server (not yet serving).
+
+    Raises:
+        ValueError: If no token is given for an address other than a loopback address.
+    """
+    check_listen_address(host, token)
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            authorization = self.headers.get("Authorization", "")
+            if token is not None and not secrets.compare_digest(
+                authorization.encode("utf-8"), f"Bearer {token}".encode("utf-8")
+            ):
+                self.reply(401, {"error": "A valid bearer token is required."})
+                return
+            name = urllib.parse.urlparse(self.path).path.strip("/")
+            if name not in RemoteCoordinator.methods:
+                self.reply(404, {"error": "Not found."})
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                args, kwargs = list(request.get("args", ())), dict(request.get("kwargs", {}))
+                if name == "enrollments" and token is None and (args[:1] or [kwargs.get("pins")])[0]:
+                    self.reply(403, {"error": "PINs are only returned when the coordinator requires a token."})
+                    return
+                result = getattr(coordinator, name)(*args, **kwargs)
+            except (ValueError, KeyError, TypeError) as e:
+                self.reply(400, {"error": f"Invalid request ({e})."})
+                return
+            except sqlite3.Error as e:
+                self.reply(503, {"error": f"Coordinator database unavailable ({e})."})
+                return
+            self.reply(200, {"result": result})
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+# Jobs a station leased from the coordinator
+class LeasedJobs:
+    """
+    The jobs a station leased from a coordinator (see Coordinator), as the source of batch_registration().
+
+    Jobs are leased one at a time as YubiKeys are inserted (see entries()), and their leases are renewed in the
+    background until the outcome of the enrollment is reported (see report()). Jobs the station held before it was
+    restarted are picked up first, so that YubiKeys with an unfinished enrollment can be resumed.
+    """
+
+    def __init__(self, coordinator, ledger, station, duration=coordinator_lease):
+        """
+        Args:
+            coordinator (Coordinator): The coordinator (or RemoteCoordinator).
+            ledger (Ledger): The ledger of the station, from which completed enrollments are reported.
+            station (str): The name of the station (see Telemetry).
+            duration (float, optional): Seconds until a lease expires. Default is coordinator_lease.
+        """
+        self.coordinator = coordinator
+        self.ledger = ledger
+        self.station = station
+        self.duration = duration
+        self._held = {}  # Leased jobs by lowercase User Principal Name
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._renew, name="coordinator-leases", daemon=True)
+        self._thread.start()
+
+    def entries(self):
+        """
+        Leases the jobs for the station.
+
+        Yields:
+            dict: An entry like those read from a manifest file (see read_manifest()).
+        """
+        jobs = self.coordinator.reclaim(self.station, self.duration)
+        while True:
+            for job in jobs:
+                with self._lock:
+                    self._held[job["upn"].lower()] = job
+                yield {
+                    "UPN": job["upn"],
+                    "PIN change required": job["pin_change"],
+                    "Secure Transport Mode": job["nfc_restricted"],
+                }
+            try:
+                jobs = self.coordinator.lease(self.station, 1, self.duration)
+            except (requests.exceptions.RequestException, sqlite3.Error) as e:
+                click.secho(f"🛑 Could not lease a job from the coordinator: {e}")
+                return
+            if not jobs:
+                return
+
+    def report(self, user_principal_name, completed, error=None):
+        """
+        Reports the outcome of an enrollment to the coordinator.
+
+        A completed enrollment is reported with its record from the ledger, also for users not leased by this station
+        (e.g., a resumed enrollment). A failure is only reported for a job held by this station.
+
+        Args:
+            user_principal_name (str): The User Principal Name of the user.
+            completed (bool): Whether the enrollment completed.
+            error (str, optional): The reason the enrollment failed.
+        """
+        with self._lock:
+            job = self._held.pop(user_principal_name.lower(), None)
+        try:
+            if completed:
+                record = self.ledger.enrollment(user_principal_name)
+                result = self.coordinator.complete(self.station, record)
+                if not result["accepted"] and result["upn"].lower() != user_principal_name.lower():
+                    click.secho(
+                        f"⚠️ YubiKey {result['serial_number']} is already recorded for '{result['upn']}' "
+                        f"by station '{result['station']}', '{user_principal_name}' was not recorded."
+                    )
+                elif not result["accepted"]:
+                    click.secho(
+                        f"⚠️ '{user_principal_name}' was already enrolled with YubiKey {result['serial_number']} "
+                        f"by station '{result['station']}', revoke one of the YubiKeys."
+                    )
+            elif job is not None:
+                self.coordinator.fail(self.station, job["upn"], error or "Enrollment failed.")
+        except (requests.exceptions.RequestException, sqlite3.Error) as e:
+            click.secho(f"🛑 Could not report '{user_principal_name}' to the coordinator ({e}), run again to report it.")
+
+    def close(self):
+        """
+        Stops renewing leases and hands back the jobs not started. Jobs with an unfinished enrollment on this station
+        are kept (until their lease expires), so that the YubiKey can be resumed here.
+        """
+        self._stopped.set()
+        unfinished = {state["upn"].lower() for state in self.ledger.unfinished().values()}
+        with self._lock:
+            held, self._held = self._held, {}
+        for upn, job in held.items():
+            if upn not in unfinished:
+                self.coordinator.release(self.station, job["upn"])
+
+    def _renew(self):
+        while not self._stopped.wait(self.duration / 3):
+            with self._lock:
+                upns = [job["upn"] for job in self._held.values()]
+            if not upns:
+                continue
+            try:
+                renewed = {upn.lower() for upn in self.coordinator.renew(self.station, upns, self.duration)}
+            except (requests.exceptions.RequestException, sqlite3.Error) as e:
+                click.secho(f"⚠️ Could not renew leases with the coordinator: {e}")
+                continue
+            with self._lock:
+                for upn in [upn for upn in self._held if upn not in renewed]:
+                    click.secho(f"⚠️ Lease of '{self._held.pop(upn)['upn']}' expired, it may be enrolled by another station.")
@@ -0,0 +1,470 @@
+######################################################################
+# Microsoft Graph API client for sk-entra-id.py
+######################################################################
+# see readme.md for more info.
+#
+# Sends the requests of sk-entra-id.py to Microsoft Graph API through one pooled, keep-alive
+# HTTP session, within a shared rate limit and with retries of throttled requests, and caches
+# the access token (refreshed in the background before it expires).
+#
+# DEPENDENCIES:
+#   - Requests must be installed on the system
+#
+# BSD 2-Clause License
+# Copyright (c) 2025, swjm.blog
+######################################################################
+
+# Standard Library Imports
+import datetime
+import email.utils
+import json
+import random
+import threading
+import time
+from threading import Timer
+
+# Third-Party Library Imports
+import requests
+
+# Default token endpoint of Microsoft Entra ID (see TokenProvider)
+login_endpoint = "https://login.microsoftonline.com"
+
+
+# Rate limiter shared by all requests to Microsoft Graph API
+class RateLimiter:
+    """
+    Token bucket limiting the rate of requests sent to Microsoft Graph API by all threads.
+
+    Parallel enrollment workers share one bucket, so together they stay under the tenant's
+    throttling limits. When Microsoft Graph API throttles a request anyway (HTTP 429), pause()
+    holds back every worker for the time requested by the service.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (float): Requests per second allowed on average.
+            burst (int, optional): Maximum number of requests sent back-to-back. Default is twice the rate.
+        """
+        self.rate = rate
+        self.burst = burst or max(1, int(rate * 2))
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Holds back all requests for the given number of seconds.
+
+        Args:
+            seconds (float): Number of seconds to pause.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+# Function to determine how long to wait before retrying a request to Microsoft Graph API
+def get_retry_delay(response, attempt, base=1, cap=60):
+    """
+    Determines how long to wait before retrying a throttled or failed request.
+
+    Honours the Retry-After header (in seconds or as an HTTP date) if the response has one,
+    otherwise uses exponential backoff with full jitter.
+
+    Args:
+        response (requests.Response): The response to retry, or None if no response was received.
+        attempt (int): The number of the attempt that failed (starting at 0).
+        base (float, optional): Backoff for the first retry in seconds. Default is 1 second.
+        cap (float, optional): Maximum backoff in seconds. Default is 60 seconds.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# Client for Microsoft Graph API sharing a pooled, keep-alive HTTP session
+class GraphClient:
+    """
+    HTTP client shared by all requests to Microsoft Graph API (and its token endpoint).
+
+    All requests go through a single requests.Session, so TCP and TLS connections to
+    graph.microsoft.com are kept alive and reused instead of being set up for every request.
+    The connection pool is sized for the number of parallel enrollment workers.
+
+    Requests are authenticated with the access token of the client's token provider (see TokenProvider).
+    If Microsoft Graph API rejects the token (HTTP 401), a new token is fetched and the request is sent once more.
+
+    Requests to Microsoft Graph API pass through the client's rate limiter (see RateLimiter). Throttled
+    or temporarily failed requests (HTTP 429, 503 and 504) are retried after the delay given by
+    get_retry_delay(); GET requests are also retried on connection errors.
+
+    Each request (with its HTTP status, number of attempts and duration) is recorded by the client's telemetry (see Telemetry).
+
+    Many small requests can be combined into JSON batch requests ($batch) of up to batch_size requests with batch().
+    """
+
+    # HTTP status codes of responses that are retried
+    retry_status_codes = (429, 503, 504)
+
+    # Maximum number of requests in a JSON batch request (a limit of Microsoft Graph API)
+    batch_size = 20
+
+    def __init__(self, pool_size=10, token_provider=None, rate_limiter=None, max_retries=5, telemetry=None):
+        """
+        Args:
+            pool_size (int, optional): Maximum number of connections kept open per host. Default is 10.
+            token_provider (TokenProvider, optional): Provider of access tokens for Microsoft Graph API.
+            rate_limiter (RateLimiter, optional): Rate limiter for requests to Microsoft Graph API.
+            max_retries (int, optional): Maximum number of retries per request. Default is 5.
+            telemetry (Telemetry, optional): Recorder of requests.
+        """
+        self.token_provider = token_provider
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.telemetry = telemetry
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, authenticate=True, **kwargs):
+        """
+        Sends a request through the shared session, retrying it if it is throttled.
+
+        Args:
+            method (str): The HTTP method (e.g., "GET" or "POST").
+            url (str): The request URL.
+            authenticate (bool, optional): Whether to add the headers from set_http_headers() with
+                the current access token to the request. Default is True.
+            **kwargs: Further arguments passed on to requests.Session.request().
+
+        Returns:
+            requests.Response: The response object (of the last attempt).
+
+        Raises:
+            requests.ConnectionError: If the request could not be sent (after retrying GET requests).
+        """
+        start = time.perf_counter()
+        response = None
+        attempts = 0
+        try:
+            for attempt in range(self.max_retries + 1):
+                if authenticate and self.rate_limiter:
+                    self.rate_limiter.acquire()
+                attempts += 1
+                try:
+                    response = self._send(method, url, authenticate, **kwargs)
+                except requests.ConnectionError:
+                    response = None
+                    if method != "GET" or attempt == self.max_retries:
+                        raise
+                else:
+                    if response.status_code not in self.retry_status_codes or attempt == self.max_retries:
+                        return response
+
+                delay = get_retry_delay(response, attempt)
+                if response is not None and response.status_code == 429 and self.rate_limiter:
+                    self.rate_limiter.pause(delay)
+                time.sleep(delay)
+        finally:
+            if self.telemetry:
+                self.telemetry.graph_request(method, url, response, attempts, time.perf_counter() - start)
+
+    def _send(self, method, url, authenticate, headers=None, **kwargs):
+        if not authenticate:
+            return self.session.request(method, url, headers=headers, **kwargs)
+
+        for attempt in range(2):
+            access_token = self.token_provider.get_token()
+            response = self.session.request(
+                method, url, headers={**set_http_headers(access_token), **(headers or {})}, **kwargs
+            )
+            if response.status_code != 401:
+                break
+            # Token expired or was revoked, fetch a new one and try once more
+            self.token_provider.invalidate(access_token)
+        return response
+
+    def get(self, url, authenticate=True, **kwargs):
+        return self.request("GET", url, authenticate, **kwargs)
+
+    def post(self, url, authenticate=True, **kwargs):
+        return self.request("POST", url, authenticate, **kwargs)
+
+    def batch(self, url, requests_by_id):
+        """
+        Sends up to batch_size requests to Microsoft Graph API in a single JSON batch request.
+
+        Microsoft Graph API throttles the requests in a batch individually, so each of them takes a token
+        from the rate limiter. Requests in the batch that are throttled or temporarily failed are sent again
+        (in a new batch) after the longest delay given by get_retry_delay() for any of them.
+
+        Args:
+            url (str): The URL of the $batch endpoint.
+            requests_by_id (dict): The requests by their ID. Each request is a dict with the "method" and the "url"
+                (relative to the Microsoft Graph API endpoint), and optionally the "headers" and the "body".
+
+        Returns:
+            dict: The responses (requests.Response) by request ID. If the batch request itself failed,
+                its response is returned for each of the requests.
+
+        Raises:
+            ValueError: If there are more than batch_size requests.
+        """
+        if len(requests_by_id) > self.batch_size:
+            raise ValueError(f"A batch request cannot contain more than {self.batch_size} requests.")
+
+        responses = {}
+        pending = dict(requests_by_id)
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                for _ in range(len(pending) - 1):  # request() takes the token of the first request
+                    self.rate_limiter.acquire()
+            response = self.post(
+                url, json={"requests": [{"id": request_id, **request} for request_id, request in pending.items()]}
+            )
+            if response.status_code != 200:
+                responses.update(dict.fromkeys(pending, response))
+                break
+            for item in response.json().get("responses", []):
+                responses[item["id"]] = self._batch_response(item)
+
+            pending = {
+                request_id: request for request_id, request in pending.items()
+                if request_id not in responses or responses[request_id].status_code in self.retry_status_codes
+            }
+            if not pending:
+                break
+            if attempt == self.max_retries:
+                responses.update({request_id: response for request_id in pending if request_id not in responses})
+                break
+            delay = max(get_retry_delay(responses.get(request_id), attempt) for request_id in pending)
+            if self.rate_limiter and any(
+                request_id in responses and responses[request_id].status_code == 429 for request_id in pending
+            ):
+                self.rate_limiter.pause(delay)
+            time.sleep(delay)
+        return responses
+
+    def _batch_response(self, item):
+        # Wraps a response of a JSON batch request, so that callers can handle it like any other response
+        response = requests.Response()
+        response.status_code = item["status"]
+        response.headers.update(item.get("headers") or {})
+        response.encoding = "utf-8"
+        response._content = json.dumps(item["body"]).encode("utf-8") if item.get("body") is not None else b""
+        return response
+
+
+# Function to obtain OAuth access token from Microsoft Graph API
+def send_token_request(client, token_endpoint, headers, body):
+    """
+    Sends a token request to the specified token endpoint.
+
+    Args:
+        client (GraphClient): The client sending the request.
+        token_endpoint (str): The token endpoint URL.
+        headers (dict): The HTTP headers for the request.
+        body (dict): The request body.
+
+    Returns:
+        requests.Response: The response object.
+    """
+    response = client.post(token_endpoint, authenticate=False, data=body, headers=headers)
+    response.raise_for_status()  # Raise an exception for HTTP errors
+    return response
+
+
+# Function setting the HTTP headers for Microsoft Graph API
+def set_http_headers(access_token):
+    """
+    Sets the HTTP headers required for making requests to the Microsoft Graph API.
+
+    This function takes an access token as input and returns a dictionary containing
+    the necessary headers for authenticating and formatting the requests to the Microsoft Graph API.
+
+    Args:
+        access_token (str): The access token obtained from the authentication process.
+
+    Returns:
+        dict: A dictionary containing the HTTP headers for the Microsoft Graph API requests.
+    """
+    return {
+        "Accept": "application/json",
+        "Authorization": access_token,
+        "Content-Type": "application/json",
+        # Only advertise encodings that requests can decode (br requires brotli to be installed)
+        "Accept-Encoding": requests.utils.DEFAULT_ACCEPT_ENCODING,
+    }
+
+
+# Function to construct request body when accessing Microsoft Graph API
+def construct_request_body(client_id, client_secret):
+    """
+    Constructs the request body for obtaining an access token.
+
+    Args:
+        client_id (str): The client ID of the application.
+        client_secret (str): The client secret of the application.
+
+    Returns:
+        dict: The constructed request body.
+    """
+    return {
+        "grant_type": "client_credentials",
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "scope": "https://graph.microsoft.com/.default",
+    }
+
+
+# Function to parse access token in response from Microsoft Graph API
+def extract_access_token(response):
+    """
+    Extracts the access token and its lifetime from the response.
+
+    Args:
+        response (requests.Response): The response object.
+
+    Returns:
+        tuple: The extracted access token and its lifetime in seconds.
+    """
+    token_response = response.json()
+    if "access_token" not in token_response:
+        raise ValueError("Access token not found in response")
+    return token_response["access_token"], int(token_response.get("expires_in", 3599))
+
+
+# Function to retrieve acces token from Microsoft Graph API
+def get_access_token_for_microsoft_graph(client_id, client_secret, tenant_id, client, login_endpoint=login_endpoint):
+    """
+    Retrieves an access token for accessing Microsoft Graph API using OAuth client credentials flow.
+
+    Args:
+        client_id (str): The client ID of the application.
+        client_secret (str): The client secret of the application.
+        tenant_id (str): The name of the Entra directory as an fqdn.
+        client (GraphClient): The client sending the token request.
+        login_endpoint (str, optional): The token endpoint of Microsoft Entra ID. Default is login_endpoint.
+
+    Returns:
+        tuple: The access token and its lifetime in seconds.
+    """
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    token_endpoint = f"{login_endpoint}/{tenant_id}/oauth2/v2.0/token"
+
+    body = construct_request_body(client_id, client_secret)
+
+    token_response = send_token_request(client, token_endpoint, headers, body)
+
+    access_token, expires_in = extract_access_token(token_response)
+
+    return access_token, expires_in
+
+
+# Cache for the access token to Microsoft Graph API
+class TokenProvider:
+    """
+    Caches the access token for Microsoft Graph API together with its expiry.
+
+    The token is refreshed in the background shortly before it expires, so long-running
+    (batch) enrollments never wait for, or fail on, an expired token. If a background refresh
+    fails, the token is instead refreshed by the next request that needs it.
+    """
+
+    def __init__(self, client_id, client_secret, tenant_id, client, login_endpoint=login_endpoint, refresh_margin=300):
+        """
+        Args:
+            client_id (str): The client ID of the application.
+            client_secret (str): The client secret of the application.
+            tenant_id (str): The name of the Entra directory as an fqdn.
+            client (GraphClient): The client sending the token requests.
+            login_endpoint (str, optional): The token endpoint of Microsoft Entra ID. Default is login_endpoint.
+            refresh_margin (int, optional): Seconds before expiry at which the token is refreshed
+                in the background. Default is 300 seconds.
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.tenant_id = tenant_id
+        self.client = client
+        self.login_endpoint = login_endpoint
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0
+        self._timer = None
+
+    def get_token(self):
+        """
+        Returns the cached access token, fetching a new one if there is none or it is about to expire.
+
+        Returns:
+            str: A valid access token.
+        """
+        with self._lock:
+            if self._access_token is None or time.monotonic() >= self._expires_at - 60:
+                self._refresh()
+            return self._access_token
+
+    def invalidate(self, access_token):
+        """
+        Discards an access token rejected by Microsoft Graph API, unless it has already been replaced.
+
+        Args:
+            access_token (str): The rejected access token.
+        """
+        with self._lock:
+            if self._access_token == access_token:
+                self._access_token = None
+
+    def _refresh(self):
+        # Must be called with the lock held
+        access_token, expires_in = get_access_token_for_microsoft_graph(
+            self.client_id, self.client_secret, self.tenant_id, self.client, self.login_endpoint
+        )
+        self._access_token = access_token
+        self._expires_at = time.monotonic() + expires_in
+        self._schedule_refresh(max(expires_in - self.refresh_margin, 0))
+
+    def _schedule_refresh(self, delay):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = Timer(delay, self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception:
+                # Try again shortly (the next request will also refresh an expired token)
+                self._schedule_refresh(30)
@@ -0,0 +1,944 @@
+######################################################################
+# Ledger of programmed YubiKeys for sk-entra-id.py
+######################################################################
+# see readme.md for more info.
+#
+# Records programmed YubiKeys and the journal of enrollments in progress in an SQLite database
+# (output.db), and keeps the CSV output file (output.csv) up to date with them. The other records
+# kept in the database (queued registrations, creation options, the directory cache, the prep
+# inventory and revocations) each have a store of their own sharing its connection.
+#
+# BSD 2-Clause License
+# Copyright (c) 2025, swjm.blog
+######################################################################
+
+# Standard Library Imports
+import csv
+import json
+import os
+import sqlite3
+import threading
+
+# Columns of the CSV output file
+csv_headers = [
+    'Name', 'UPN', 'Model', 'Serial number', 'PIN', 'PIN change required', 'Secure Transport Mode'
+]
+
+
+# Ledger of programmed YubiKeys
+class Ledger:
+    """
+    Indexed record of programmed YubiKeys, stored in an SQLite database.
+
+    Replaces scanning the CSV output file: lookups by serial number and User Principal Name
+    use indexes, and the database runs in WAL mode so that parallel enrollment workers (each
+    with its own connection) can append records safely. export_csv() writes the records in
+    the layout of the CSV output file (see csv_headers), which is kept up to date after every
+    change and whose manual edits are applied to the ledger (see sync_csv()).
+
+    The other records kept in the database have stores of their own, which share the connection of each thread:
+    registrations (RegistrationStore), creation_options (CreationOptionsStore), directory (DirectoryStore),
+    inventory (InventoryStore) and revocations (RevocationStore).
+
+    Tables:
+        enrollments: The programmed YubiKeys (see add()).
+        journal: The stages reached by enrollments in progress (see journal()).
+        csv_export: The modification time and size of the CSV output file as last written (see sync_csv()).
+    """
+
+    # Stages recorded in the journal, in order ('registration_queued' instead of 'registered' if registration failed)
+    journal_stages = (
+        "started", "pin_set", "credential_created", "registered", "registration_queued", "configured", "completed"
+    )
+
+    def __init__(self, database_file, csv_file=None):
+        """
+        Args:
+            database_file (str): Path to the SQLite database file (created if it does not exist).
+            csv_file (str, optional): Path to the CSV output file to keep up to date (see sync_csv()). Default is None
+                (the records are only written to a CSV file by export_csv()).
+        """
+        self.database_file = database_file
+        self.csv_file = csv_file
+        self._local = threading.local()
+        self._csv_lock = threading.RLock()
+        with self.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS enrollments (
+                    serial_number INTEGER NOT NULL,
+                    upn TEXT NOT NULL COLLATE NOCASE,
+                    name TEXT,
+                    model TEXT,
+                    pin TEXT,
+                    pin_change INTEGER,
+                    nfc_restricted INTEGER,
+                    enrolled_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                    auth_method TEXT,
+                    registration TEXT NOT NULL DEFAULT 'registered'
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS enrollments_serial_number ON enrollments (serial_number);
+                CREATE INDEX IF NOT EXISTS enrollments_upn ON enrollments (upn);
+                CREATE TABLE IF NOT EXISTS journal (
+                    serial_number INTEGER NOT NULL,
+                    stage TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    recorded_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE INDEX IF NOT EXISTS journal_serial_number ON journal (serial_number);
+                CREATE TABLE IF NOT EXISTS csv_export (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    exported_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                """
+            )
+            # Ledgers written by earlier versions do not record the ID of the FIDO2 method
+            columns = [column[1] for column in connection.execute("PRAGMA table_info(enrollments)")]
+            if "auth_method" not in columns:
+                connection.execute("ALTER TABLE enrollments ADD COLUMN auth_method TEXT")
+            # Nor whether the FIDO2 method was registered (all records were, as failed registrations were not kept)
+            if "registration" not in columns:
+                connection.execute("ALTER TABLE enrollments ADD COLUMN registration TEXT NOT NULL DEFAULT 'registered'")
+
+        # Stores of the other records kept in the database
+        self.registrations = RegistrationStore(self)
+        self.creation_options = CreationOptionsStore(self)
+        self.directory = DirectoryStore(self)
+        self.inventory = InventoryStore(self)
+        self.revocations = RevocationStore(self)
+
+    def connect(self):
+        """
+        Returns the database connection of the calling thread, opening it if necessary.
+
+        Returns:
+            sqlite3.Connection: The connection (usable as a context manager committing a transaction).
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_file, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def add(self, user_display_name, user_name, model, serial_number, pin, pin_change, nfc_restricted, auth_method=None):
+        """
+        Records a programmed YubiKey (replacing any earlier record of the same serial number),
+        removing it from the prep inventory.
+
+        The status of its registration in Microsoft Entra ID is 'registered' if the ID of the FIDO2 method is given,
+        and otherwise that of its queued registration (see RegistrationStore).
+
+        Args:
+            user_display_name (str): The user's display name.
+            user_name (str): The user's User Principal Name.
+            model (str): The YubiKey model name.
+            serial_number (int): The serial number of the YubiKey.
+            pin (str): The PIN set on the YubiKey.
+            pin_change (bool): Whether the user must change the PIN on first use.
+            nfc_restricted (bool): Whether Secure Transport Mode was configured.
+            auth_method (str, optional): The ID of the FIDO2 method registered in Microsoft Entra ID. Default is the
+                ID recorded by the registration queue (if the registration was queued and has completed).
+        """
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO enrollments "
+                "(serial_number, upn, name, model, pin, pin_change, nfc_restricted, auth_method, registration) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, coalesce(?, "
+                "(SELECT auth_method FROM registrations WHERE serial_number = ? AND status = 'registered')), "
+                "CASE WHEN ? IS NOT NULL THEN 'registered' "
+                "ELSE coalesce((SELECT status FROM registrations WHERE serial_number = ?), 'registered') END)",
+                (
+                    int(serial_number), user_name, user_display_name, model, pin, bool(pin_change), bool(nfc_restricted),
+                    auth_method, int(serial_number), auth_method, int(serial_number),
+                ),
+            )
+            connection.execute(
+                "INSERT INTO journal (serial_number, stage, data) VALUES (?, 'completed', '{}')",
+                (int(serial_number),),
+            )
+        self.inventory.remove(serial_number)
+        self.sync_csv()
+
+    def known_pins(self, serial_number):
+        """
+        Returns the PINs recorded for a YubiKey by earlier enrollments (and their journal) and by prepping.
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+
+        Returns:
+            list: The distinct PINs, most recently recorded first.
+        """
+        connection = self.connect()
+        recorded = connection.execute(
+            "SELECT enrolled_at, pin FROM enrollments WHERE serial_number = ?", (int(serial_number),)
+        ).fetchall()
+        recorded += self.inventory.recorded_pins(serial_number)
+        for recorded_at, data in connection.execute(
+            "SELECT recorded_at, data FROM journal WHERE serial_number = ? AND stage = 'started'", (int(serial_number),)
+        ):
+            recorded.append((recorded_at, json.loads(data).get("pin")))
+        recorded.sort(key=lambda record: record[0], reverse=True)
+        return list(dict.fromkeys(pin for recorded_at, pin in recorded if pin))
+
+    def journal(self, serial_number, stage, **data):
+        """
+        Records in the journal that the enrollment of a YubiKey reached a stage (committed before returning).
+
+        Each stage is recorded with the data needed to continue from it, so that an enrollment interrupted
+        by a crash or a failed request can be resumed (see journal_state() and continue_enrollment()).
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+            stage (str): The stage reached (one of journal_stages). 'started' begins a new enrollment of the YubiKey.
+            **data: Data needed to continue from the stage (e.g., pin=... or attestation=...), stored as JSON.
+        """
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO journal (serial_number, stage, data) VALUES (?, ?, ?)",
+                (int(serial_number), stage, json.dumps(data)),
+            )
+
+    def journal_state(self, serial_number):
+        """
+        Returns the state of an unfinished enrollment of a YubiKey from the journal.
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+
+        Returns:
+            dict: The data recorded since the enrollment started, with the last stage reached as 'stage',
+            or None if the YubiKey has no unfinished enrollment.
+        """
+        rows = self.connect().execute(
+            "SELECT stage, data FROM journal WHERE serial_number = ? ORDER BY rowid", (int(serial_number),)
+        )
+        state = None
+        for stage, data in rows:
+            if stage == "started":
+                state = {}
+            if state is not None:
+                state.update(json.loads(data), stage=stage)
+        if state is None or state["stage"] == "completed":
+            return None
+        return state
+
+    def unfinished(self):
+        """
+        Returns the unfinished enrollments in the journal.
+
+        Returns:
+            dict: The state of each unfinished enrollment (see journal_state()) by serial number.
+        """
+        serial_numbers = self.connect().execute(
+            "SELECT serial_number FROM journal GROUP BY serial_number "
+            "HAVING max(CASE WHEN stage = 'completed' THEN rowid END) IS NOT max(rowid)"
+        ).fetchall()
+        states = {serial_number: self.journal_state(serial_number) for serial_number, in serial_numbers}
+        return {serial_number: state for serial_number, state in states.items() if state}
+
+    def remove(self, serial_number):
+        """
+        Removes the record of a YubiKey, so that it can be enrolled again.
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+        """
+        with self.connect() as connection:
+            connection.execute("DELETE FROM enrollments WHERE serial_number = ?", (int(serial_number),))
+        self.sync_csv()
+
+    def set_registration(self, serial_number, status, auth_method=None):
+        """
+        Records the status of the registration of a YubiKey in Microsoft Entra ID (see RegistrationQueue).
+
+        A YubiKey whose registration failed or expired stays recorded, but is no longer considered enrolled
+        (see has_serial_number() and has_user()), so that it (and its user) is enrolled again.
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+            status (str): The status ('pending', 'offline', 'registered', 'expired' or 'failed').
+            auth_method (str, optional): The ID of the FIDO2 method, once registered.
+        """
+        with self.connect() as connection:
+            changed = connection.execute(
+                "UPDATE enrollments SET registration = ?, auth_method = coalesce(?, auth_method) WHERE serial_number = ?",
+                (status, auth_method, int(serial_number)),
+            ).rowcount
+        if changed:
+            self.sync_csv()
+
+    def has_serial_number(self, serial_number):
+        """
+        Checks whether a YubiKey with the given serial number has been programmed.
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+
+        Returns:
+            bool: True if the serial number is recorded (and its registration has not failed or expired), False otherwise.
+        """
+        row = self.connect().execute(
+            "SELECT 1 FROM enrollments WHERE serial_number = ? AND registration NOT IN ('failed', 'expired')",
+            (int(serial_number),),
+        ).fetchone()
+        return row is not None
+
+    def has_user(self, user_name):
+        """
+        Checks whether a YubiKey has been programmed for the given user.
+
+        Args:
+            user_name (str): The User Principal Name of the user (case insensitive).
+
+        Returns:
+            bool: True if the user is recorded (with a YubiKey whose registration has not failed or expired), False otherwise.
+        """
+        row = self.connect().execute(
+            "SELECT 1 FROM enrollments WHERE upn = ? AND registration NOT IN ('failed', 'expired')", (user_name,)
+        ).fetchone()
+        return row is not None
+
+    def enrollment(self, user_name):
+        """
+        Returns the latest YubiKey programmed for the given user.
+
+        Args:
+            user_name (str): The User Principal Name of the user (case insensitive).
+
+        Returns:
+            dict: The record (with the columns of the enrollments table as keys), or None if the user is not recorded.
+        """
+        cursor = self.connect().execute(
+            "SELECT * FROM enrollments WHERE upn = ? ORDER BY enrolled_at DESC, rowid DESC LIMIT 1", (user_name,)
+        )
+        columns = [column[0] for column in cursor.description]
+        row = cursor.fetchone()
+        return dict(zip(columns, row)) if row else None
+
+    def enrollments_by_serial_number(self, serial_numbers):
+        """
+        Returns the records of YubiKeys by serial number.
+
+        Args:
+            serial_numbers (Iterable[int]): The serial numbers of the YubiKeys.
+
+        Returns:
+            dict: The records (with the columns of the enrollments table as keys) of the YubiKeys that are recorded,
+                by serial number.
+        """
+        connection = self.connect()
+        records = {}
+        for serial_number in serial_numbers:
+            cursor = connection.execute("SELECT * FROM enrollments WHERE serial_number = ?", (int(serial_number),))
+            columns = [column[0] for column in cursor.description]
+            row = cursor.fetchone()
+            if row:
+                records[int(serial_number)] = dict(zip(columns, row))
+        return records
+
+    def import_csv(self, csv_file, remove_missing=False):
+        """
+        Records the YubiKeys listed in a CSV output file (e.g., written by an earlier version of this script,
+        or edited by hand).
+
+        Rows replace the records of the same serial number. The ID of the FIDO2 method and the registration status
+        are kept if the file does not have the 'FIDO2 method ID' or 'Registration' column.
+
+        Args:
+            csv_file (str): Path to the CSV file.
+            remove_missing (bool, optional): Whether to remove the records of YubiKeys not listed in the file (apart
+                from those whose registration failed or expired, which are only listed with the 'Registration'
+                column). Default is False.
+
+        Returns:
+            int: The number of records imported.
+        """
+        with open(csv_file, 'r', newline='') as csvfile:
+            rows = [
+                (
+                    int(row['Serial number']),
+                    row['UPN'],
+                    row['Name'],
+                    row['Model'],
+                    row['PIN'],
+                    row['PIN change required'] == 'True',
+                    row['Secure Transport Mode'] == 'True',
+                    row.get('FIDO2 method ID') or None,
+                    row.get('Registration') or None,
+                )
+                for row in csv.DictReader(csvfile)
+                if (row.get('Serial number') or '').isdigit()
+            ]
+        with self.connect() as connection:
+            if remove_missing:
+                listed = {row[0] for row in rows}
+                removed = [
+                    (serial_number,) for serial_number, in connection.execute(
+                        "SELECT serial_number FROM enrollments WHERE registration NOT IN ('failed', 'expired')"
+                    )
+                    if serial_number not in listed
+                ]
+                connection.executemany("DELETE FROM enrollments WHERE serial_number = ?", removed)
+            connection.executemany(
+                "INSERT INTO enrollments "
+                "(serial_number, upn, name, model, pin, pin_change, nfc_restricted, auth_method, registration) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, coalesce(?, 'registered')) "
+                "ON CONFLICT (serial_number) DO UPDATE SET "
+                "upn = excluded.upn, name = excluded.name, model = excluded.model, pin = excluded.pin, "
+                "pin_change = excluded.pin_change, nfc_restricted = excluded.nfc_restricted, "
+                "auth_method = coalesce(?, auth_method), registration = coalesce(?, registration)",
+                [row + row[-2:] for row in rows],
+            )
+        return len(rows)
+
+    def sync_csv(self):
+        """
+        Writes the CSV output file again from the records, first applying the changes made to it by hand.
+
+        The file is written after every change to the recorded YubiKeys (replacing it at once, so that it is never
+        left half written), and its modification time and size are stored. If it has changed since, it was edited:
+        its rows are imported and the records of YubiKeys whose rows were deleted are removed (so that they and their
+        users are enrolled again). A file that was not written by the ledger (e.g., by an earlier version of this
+        script) is only imported, nothing is removed.
+
+        Returns:
+            bool: True if changes to the file were imported, False otherwise (or if there is no CSV output file).
+        """
+        if self.csv_file is None:
+            return False
+        with self._csv_lock:
+            try:
+                stat = os.stat(self.csv_file)
+            except FileNotFoundError:
+                stat = None
+            exported = self.connect().execute("SELECT mtime_ns, size FROM csv_export WHERE id = 1").fetchone()
+            imported = stat is not None and exported != (stat.st_mtime_ns, stat.st_size)
+            if imported:
+                self.import_csv(self.csv_file, remove_missing=exported is not None)
+            self.export_csv(self.csv_file)
+        return imported
+
+    def export_csv(self, csv_file, method_ids=False, registration_status=False):
+        """
+        Writes the recorded YubiKeys to a CSV file in the layout of csv_headers (leaving out those whose registration
+        failed or expired, which are not enrolled, unless their registration status is added).
+
+        Args:
+            csv_file (str): Path to the CSV file (overwritten if it exists).
+            method_ids (bool, optional): Whether to add the 'FIDO2 method ID' column (the ID of the FIDO2 method
+                registered in Microsoft Entra ID). Default is False, so that the layout of the file does not change.
+            registration_status (bool, optional): Whether to add the 'Registration' column (the status of the
+                registration in Microsoft Entra ID: 'registered', 'pending', 'offline', 'failed' or 'expired').
+                Default is False, so that the layout of the file does not change.
+
+        Returns:
+            int: The number of records exported.
+        """
+        rows = self.connect().execute(
+            "SELECT name, upn, model, serial_number, pin, pin_change, nfc_restricted, auth_method, registration "
+            "FROM enrollments WHERE ? OR registration NOT IN ('failed', 'expired') ORDER BY enrolled_at, rowid",
+            (bool(registration_status),),
+        )
+        fieldnames = csv_headers + (['FIDO2 method ID'] if method_ids else [])
+        fieldnames += ['Registration'] if registration_status else []
+        count = 0
+        temporary_file = f"{csv_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_file, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            for name, upn, model, serial_number, pin, pin_change, nfc_restricted, auth_method, registration in rows:
+                row = {
+                    'Name': name,
+                    'UPN': upn,
+                    'Model': model,
+                    'Serial number': serial_number,
+                    'PIN': pin,
+                    'PIN change required': bool(pin_change),
+                    'Secure Transport Mode': bool(nfc_restricted),
+                }
+                if method_ids:
+                    row['FIDO2 method ID'] = auth_method or ''
+                if registration_status:
+                    row['Registration'] = registration
+                writer.writerow(row)
+                count += 1
+        os.replace(temporary_file, csv_file)
+
+        # Remember the CSV output file as written, so that changes to it are detected (see sync_csv())
+        if self.csv_file is not None and os.path.abspath(csv_file) == os.path.abspath(self.csv_file):
+            stat = os.stat(csv_file)
+            with self.connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO csv_export (id, mtime_ns, size) VALUES (1, ?, ?)",
+                    (stat.st_mtime_ns, stat.st_size),
+                )
+        return count
+
+
+# Queued registrations of FIDO2 methods
+class RegistrationStore:
+    """
+    Registrations of credentials in Microsoft Entra ID that failed (or were created offline), queued in the ledger
+    database to be retried (see RegistrationQueue).
+
+    Tables:
+        registrations: The queued registrations, with the outcome of their last attempt.
+    """
+
+    def __init__(self, ledger):
+        """
+        Args:
+            ledger (Ledger): The ledger whose database (and connection of each thread) the store shares.
+        """
+        self.ledger = ledger
+        with ledger.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS registrations (
+                    serial_number INTEGER PRIMARY KEY,
+                    upn TEXT NOT NULL,
+                    credential_id TEXT NOT NULL,
+                    attestation TEXT NOT NULL,
+                    client_data TEXT NOT NULL,
+                    extensions TEXT NOT NULL,
+                    challenge_timeout TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    auth_method TEXT,
+                    queued_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                """
+            )
+
+    def queue(self, serial_number, user_name, credential, error, status="pending"):
+        """
+        Queues the registration of a credential in Microsoft Entra ID that failed, to be retried.
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+            user_name (str): The User Principal Name of the user.
+            credential (dict): The 'credential_id', 'attestation', 'client_data', 'extensions' and
+                'challenge_timeout' of the credential (as recorded in the journal at 'credential_created').
+            error (str): Why the registration failed.
+            status (str, optional): 'pending' to retry in the background, or 'offline' for a credential created
+                in offline mode, which is only uploaded on request (see RegistrationQueue.upload()). Default is 'pending'.
+        """
+        with self.ledger.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO registrations "
+                "(serial_number, upn, credential_id, attestation, client_data, extensions, challenge_timeout, "
+                "last_error, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    int(serial_number),
+                    user_name,
+                    credential["credential_id"],
+                    credential["attestation"],
+                    credential["client_data"],
+                    credential["extensions"],
+                    credential["challenge_timeout"],
+                    error,
+                    status,
+                ),
+            )
+
+    def queued(self, status=None):
+        """
+        Returns the queued registrations (oldest first).
+
+        Args:
+            status (str, optional): Only return registrations with this status ('pending', 'offline',
+                'registered', 'expired' or 'failed'). Default is all registrations.
+
+        Returns:
+            list: The registrations as dictionaries (with the columns of the registrations table as keys).
+        """
+        connection = self.ledger.connect()
+        cursor = connection.execute(
+            "SELECT * FROM registrations WHERE ? IS NULL OR status = ? ORDER BY queued_at, rowid", (status, status)
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def update(self, serial_number, status, attempts, next_attempt=0, last_error=None, auth_method=None):
+        """
+        Records the outcome of an attempt to register a queued credential, also as the registration status of the
+        YubiKey in the ledger (see Ledger.set_registration()).
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+            status (str): The new status ('pending', 'registered', 'expired' or 'failed').
+            attempts (int): The number of attempts made.
+            next_attempt (float, optional): When to attempt the registration again (as returned by time.time()).
+            last_error (str, optional): Why the last attempt failed.
+            auth_method (str, optional): The ID of the FIDO2 method, once registered (also recorded for the YubiKey).
+        """
+        with self.ledger.connect() as connection:
+            connection.execute(
+                "UPDATE registrations SET status = ?, attempts = ?, next_attempt = ?, last_error = ?, auth_method = ? "
+                "WHERE serial_number = ?",
+                (status, attempts, next_attempt, last_error, auth_method, int(serial_number)),
+            )
+        self.ledger.set_registration(serial_number, status, auth_method)
+
+
+# FIDO2 credential creation options stored for offline enrollment
+class CreationOptionsStore:
+    """
+    FIDO2 credential creation options fetched by the 'prefetch' command, stored in the ledger database
+    so that YubiKeys can be enrolled offline.
+
+    Tables:
+        creation_options: The creation options of each user.
+    """
+
+    def __init__(self, ledger):
+        """
+        Args:
+            ledger (Ledger): The ledger whose database (and connection of each thread) the store shares.
+        """
+        self.ledger = ledger
+        with ledger.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS creation_options (
+                    user_id TEXT PRIMARY KEY,
+                    upn TEXT NOT NULL COLLATE NOCASE,
+                    name TEXT,
+                    options TEXT NOT NULL,
+                    challenge_timeout TEXT NOT NULL,
+                    fetched_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE INDEX IF NOT EXISTS creation_options_upn ON creation_options (upn);
+                """
+            )
+
+    def store(self, user_profile, options):
+        """
+        Stores FIDO2 credential creation options fetched for offline enrollment by the 'prefetch' command
+        (replacing earlier ones of the user).
+
+        Args:
+            user_profile (dict): The profile of the user as returned by fetch_user().
+            options (dict): The FIDO2 credential creation options.
+        """
+        with self.ledger.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO creation_options (user_id, upn, name, options, challenge_timeout) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    user_profile["id"],
+                    user_profile["userPrincipalName"],
+                    user_profile["displayName"],
+                    json.dumps(options),
+                    options["challengeTimeoutDateTime"],
+                ),
+            )
+
+    def stored(self, user):
+        """
+        Returns the stored FIDO2 credential creation options of a user (see store()).
+
+        Args:
+            user (str): The ID or User Principal Name (case insensitive) of the user.
+
+        Returns:
+            tuple: The profile of the user and the FIDO2 credential creation options, or (None, None) if none are stored.
+        """
+        row = self.ledger.connect().execute(
+            "SELECT user_id, upn, name, options FROM creation_options WHERE user_id = ? OR upn = ?", (user, user)
+        ).fetchone()
+        if row is None:
+            return None, None
+        user_id, upn, name, options = row
+        return {"id": user_id, "userPrincipalName": upn, "displayName": name}, json.loads(options)
+
+    def delete(self, user_id):
+        """
+        Deletes the stored FIDO2 credential creation options of a user (once their challenge has been used).
+
+        Args:
+            user_id (str): The ID of the user.
+        """
+        with self.ledger.connect() as connection:
+            connection.execute("DELETE FROM creation_options WHERE user_id = ?", (user_id,))
+
+
+# Cache of users in Microsoft Entra ID
+class DirectoryStore:
+    """
+    Cache of the users in Microsoft Entra ID, stored in the ledger database and synchronised with users/delta
+    (see sync_directory()), to look up and complete User Principal Names without a request.
+
+    Tables:
+        directory: The ID, User Principal Name and display name of each user.
+        directory_sync: The delta link for the next synchronisation.
+    """
+
+    def __init__(self, ledger):
+        """
+        Args:
+            ledger (Ledger): The ledger whose database (and connection of each thread) the store shares.
+        """
+        self.ledger = ledger
+        with ledger.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS directory (
+                    user_id TEXT PRIMARY KEY,
+                    upn TEXT COLLATE NOCASE,
+                    name TEXT,
+                    synced REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS directory_upn ON directory (upn);
+                CREATE TABLE IF NOT EXISTS directory_sync (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    delta_link TEXT NOT NULL,
+                    synced_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                """
+            )
+
+    def update(self, users, synced):
+        """
+        Applies a page of changes returned by users/delta to the directory cache (see sync_directory()).
+
+        Users marked as removed are deleted. Others are added, or updated with the properties returned
+        (Microsoft Graph API only returns the properties that changed for users already synchronised).
+
+        Args:
+            users (list): The users (dicts with the "id" and the changed "userPrincipalName" and "displayName").
+            synced (float): The time the synchronisation started (see complete_sync()).
+        """
+        with self.ledger.connect() as connection:
+            connection.executemany(
+                "DELETE FROM directory WHERE user_id = ?",
+                [(user["id"],) for user in users if "@removed" in user],
+            )
+            connection.executemany(
+                "INSERT INTO directory (user_id, upn, name, synced) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET "
+                "upn = COALESCE(excluded.upn, upn), name = COALESCE(excluded.name, name), synced = excluded.synced",
+                [
+                    (user["id"], user.get("userPrincipalName"), user.get("displayName"), synced)
+                    for user in users if "@removed" not in user
+                ],
+            )
+
+    def complete_sync(self, delta_link, synced=None):
+        """
+        Stores the delta link for the next synchronisation of the directory cache.
+
+        Args:
+            delta_link (str): The @odata.deltaLink returned with the last page of users/delta.
+            synced (float, optional): The time a full synchronisation started. If given, users not returned
+                since then are deleted from the cache. Default is None (an incremental synchronisation).
+        """
+        with self.ledger.connect() as connection:
+            if synced is not None:
+                connection.execute("DELETE FROM directory WHERE synced < ?", (synced,))
+            connection.execute(
+                "INSERT OR REPLACE INTO directory_sync (id, delta_link, synced_at) VALUES (1, ?, CURRENT_TIMESTAMP)",
+                (delta_link,),
+            )
+
+    def delta_link(self):
+        """
+        Returns the delta link stored by the last synchronisation of the directory cache, or None if there was none.
+        """
+        row = self.ledger.connect().execute("SELECT delta_link FROM directory_sync WHERE id = 1").fetchone()
+        return row[0] if row else None
+
+    def user(self, user_principal_name):
+        """
+        Looks up a user in the directory cache.
+
+        Args:
+            user_principal_name (str): The User Principal Name (case insensitive) of the user.
+
+        Returns:
+            dict: The profile of the user (as returned by fetch_user()), or None if the user is not cached.
+        """
+        row = self.ledger.connect().execute(
+            "SELECT user_id, upn, name FROM directory WHERE upn = ?", (user_principal_name,)
+        ).fetchone()
+        if row is None:
+            return None
+        user_id, upn, name = row
+        return {"id": user_id, "userPrincipalName": upn, "displayName": name}
+
+    def complete_user_principal_name(self, prefix, limit=50):
+        """
+        Returns the User Principal Names in the directory cache starting with a prefix (case insensitive).
+
+        Args:
+            prefix (str): The beginning of the User Principal Name.
+            limit (int, optional): Maximum number of User Principal Names returned. Default is 50.
+
+        Returns:
+            list: The User Principal Names, in alphabetical order.
+        """
+        pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        rows = self.ledger.connect().execute(
+            "SELECT upn FROM directory WHERE upn LIKE ? ESCAPE '\\' ORDER BY upn LIMIT ?", (pattern, limit)
+        )
+        return [upn for (upn,) in rows]
+
+    def size(self):
+        """
+        Returns the number of users in the directory cache.
+        """
+        return self.ledger.connect().execute("SELECT COUNT(*) FROM directory").fetchone()[0]
+
+
+# Inventory of prepped YubiKeys
+class InventoryStore:
+    """
+    YubiKeys prepped by the 'prep' command and not yet enrolled, stored in the ledger database.
+
+    Tables:
+        inventory: The model, firmware, PIN and capabilities of each prepped YubiKey.
+    """
+
+    def __init__(self, ledger):
+        """
+        Args:
+            ledger (Ledger): The ledger whose database (and connection of each thread) the store shares.
+        """
+        self.ledger = ledger
+        with ledger.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS inventory (
+                    serial_number INTEGER PRIMARY KEY,
+                    model TEXT,
+                    firmware TEXT,
+                    pin TEXT NOT NULL,
+                    capabilities TEXT NOT NULL,
+                    prepped_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                """
+            )
+
+    def add(self, serial_number, model, firmware, pin, capabilities):
+        """
+        Records a YubiKey prepped by the 'prep' command in the inventory (replacing any earlier record of the same
+        serial number).
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+            model (str): The YubiKey model name.
+            firmware (tuple): The firmware version of the YubiKey.
+            pin (str): The PIN set on the YubiKey.
+            capabilities (dict): The capabilities of the YubiKey (see prep_on_station()).
+        """
+        with self.ledger.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO inventory (serial_number, model, firmware, pin, capabilities) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (int(serial_number), model, ".".join(map(str, firmware)), pin, json.dumps(capabilities)),
+            )
+
+    def prepped(self, serial_number=None):
+        """
+        Returns the prepped YubiKeys not yet enrolled.
+
+        Args:
+            serial_number (int, optional): Only return the YubiKey with this serial number. Default is all YubiKeys.
+
+        Returns:
+            list: The YubiKeys, as dicts with the 'serial_number', 'model', 'firmware', 'pin', 'capabilities'
+                and 'prepped_at', in the order they were prepped.
+        """
+        query = "SELECT serial_number, model, firmware, pin, capabilities, prepped_at FROM inventory"
+        if serial_number is not None:
+            rows = self.ledger.connect().execute(query + " WHERE serial_number = ?", (int(serial_number),))
+        else:
+            rows = self.ledger.connect().execute(query + " ORDER BY prepped_at, serial_number")
+        return [
+            {
+                "serial_number": serial_number,
+                "model": model,
+                "firmware": firmware,
+                "pin": pin,
+                "capabilities": json.loads(capabilities),
+                "prepped_at": prepped_at,
+            }
+            for serial_number, model, firmware, pin, capabilities, prepped_at in rows
+        ]
+
+    def remove(self, serial_number):
+        """
+        Removes a YubiKey from the inventory (once it is enrolled).
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+        """
+        with self.ledger.connect() as connection:
+            connection.execute("DELETE FROM inventory WHERE serial_number = ?", (int(serial_number),))
+
+    def recorded_pins(self, serial_number):
+        """
+        Returns the PIN recorded for a YubiKey when it was prepped (see Ledger.known_pins()).
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+
+        Returns:
+            list: The PIN (if the YubiKey is in the inventory) with the time it was recorded, as (prepped_at, pin).
+        """
+        return self.ledger.connect().execute(
+            "SELECT prepped_at, pin FROM inventory WHERE serial_number = ?", (int(serial_number),)
+        ).fetchall()
+
+
+# Record of revoked YubiKeys
+class RevocationStore:
+    """
+    YubiKeys whose FIDO2 method was deleted from Microsoft Entra ID by the 'revoke' command, stored in the ledger
+    database.
+
+    Tables:
+        revocations: The serial number, user and deleted FIDO2 method of each revoked YubiKey.
+    """
+
+    def __init__(self, ledger):
+        """
+        Args:
+            ledger (Ledger): The ledger whose database (and connection of each thread) the store shares.
+        """
+        self.ledger = ledger
+        with ledger.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS revocations (
+                    serial_number INTEGER NOT NULL,
+                    upn TEXT NOT NULL COLLATE NOCASE,
+                    auth_method TEXT,
+                    revoked_at TEXT DEFAULT CURRENT_TIMESTAMP
+                );
+                """
+            )
+
+    def record(self, serial_number, user_name, auth_method):
+        """
+        Records that the FIDO2 method of a YubiKey was deleted from Microsoft Entra ID (see Ledger.remove() to remove
+        the record of the YubiKey, so that its user can be enrolled again).
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+            user_name (str): The User Principal Name of the user.
+            auth_method (str): The ID of the deleted FIDO2 method (None if none was registered).
+        """
+        with self.ledger.connect() as connection:
+            connection.execute(
+                "INSERT INTO revocations (serial_number, upn, auth_method) VALUES (?, ?, ?)",
+                (int(serial_number), user_name, auth_method),
+            )
@@ -0,0 +1,501 @@
+######################################################################
+# Enrollment service of sk-entra-id.py
+######################################################################
+# see readme.md for more info.
+#
+# Runs enrollment jobs submitted to a local HTTP API ('serve' command) on the YubiKeys attached
+# to the station, pairing jobs with YubiKeys as both become available.
+#
+# BSD 2-Clause License
+# Copyright (c) 2025, swjm.blog
+######################################################################
+
+# Standard Library Imports
+import ipaddress
+import json
+import secrets
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Queue of enrollment jobs submitted to the local HTTP API ('serve' command)
+class EnrollmentService:
+    """
+    Runs enrollment jobs submitted to the local HTTP API (see create_api_server()) on the YubiKeys attached to the station.
+
+    A job enrolls a user on the YubiKey with a given serial number (i.e., the YubiKey in a given port of the USB hub)
+    or, without a serial number, on the next new YubiKey attached. Jobs are paired with YubiKeys as soon as both
+    are available, in order of submission, and run in parallel (see the enroll argument). A YubiKey with an
+    unfinished enrollment in the journal is only paired with a job for the user it was being enrolled for,
+    which resumes the enrollment (see the resume argument). A job for a YubiKey that can never be paired with it,
+    because the YubiKey is already enrolled or has an unfinished enrollment for another user, fails at once.
+
+    The progress messages of a YubiKey (see publish()) are recorded as events of the job it is enrolled for.
+    Jobs are kept in memory only: the journal and the ledger record the enrollments themselves.
+
+    The functions of sk-entra-id.py that enroll YubiKeys are passed in (see create_enrollment_service() there).
+    """
+
+    def __init__(
+        self, watcher, ledger, telemetry, enroll, resume, fetch_user, is_enrollable, bind_only=False, job_history=1000
+    ):
+        """
+        Args:
+            watcher (DeviceWatcher): The watcher of the YubiKeys attached to the station.
+            ledger (Ledger): The ledger in which the enrollments are recorded.
+            telemetry (Telemetry): The recorder of the events and metrics of the enrollments.
+            enroll (callable): Enrolls a user on a YubiKey, taking the device, the profile of the user and the
+                pin_change and nfc_restricted options, and returning whether the enrollment completed.
+            resume (callable): Resumes the unfinished enrollment of a YubiKey, taking the device and the state of
+                the enrollment (see Ledger.journal_state()), and returning whether the enrollment completed.
+            fetch_user (callable): Looks up a user by User Principal Name, returning the profile of the user
+                (or None) and the HTTP status code.
+            is_enrollable (callable): Whether the YubiKey with a given serial number is to be enrolled.
+            bind_only (bool, optional): Whether only prepped YubiKeys are enrolled (the --bind option). Default is False.
+            job_history (int, optional): How many finished jobs are kept (the oldest are forgotten). Default is 1000.
+        """
+        self.watcher = watcher
+        self.ledger = ledger
+        self.telemetry = telemetry
+        self.enroll = enroll
+        self.resume = resume
+        self.fetch_user = fetch_user
+        self.is_enrollable = is_enrollable
+        self.bind_only = bind_only
+        self.job_history = job_history
+        self._condition = threading.Condition()
+        self._jobs = {}  # Jobs by ID, in order of submission
+        self._running = {}  # IDs of the running jobs by serial number of their YubiKey
+        self._metrics_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the thread pairing queued jobs with attached YubiKeys (unless already started).
+        """
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="enrollment-service", daemon=True)
+                self._thread.start()
+
+    def submit(self, user_principal_name, serial_number=None, pin_change=True, nfc_restricted=True):
+        """
+        Queues the enrollment of a user.
+
+        Args:
+            user_principal_name (str): The User Principal Name of the user to enroll.
+            serial_number (int, optional): The serial number of the YubiKey to enroll. Default is the next new YubiKey.
+            pin_change (bool, optional): Whether to force the user to change the PIN on first use. Default is True.
+            nfc_restricted (bool, optional): Whether to configure Secure Transport Mode. Default is True.
+
+        Returns:
+            dict: The job (see job()).
+
+        Raises:
+            TypeError: If pin_change or nfc_restricted is not a boolean (e.g., the string "false" from a request).
+        """
+        if not (isinstance(pin_change, bool) and isinstance(nfc_restricted, bool)):
+            raise TypeError("pin_change and nfc_restricted must be True or False.")
+        job = {
+            "id": uuid.uuid4().hex,
+            "upn": user_principal_name,
+            "serial_number": serial_number,
+            "pin_change": pin_change,
+            "nfc_restricted": nfc_restricted,
+            "status": "queued",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+            "events": [],
+        }
+        with self._condition:
+            self._jobs[job["id"]] = job
+            self._event(job, "Queued, insert a YubiKey..." if serial_number is None else f"Queued for YubiKey {serial_number}...")
+            error = self._conflict(job)
+            if error:
+                self._finish(job, "failed", f"🛑 {error}", error)
+            return self._view(job)
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job (a running job cannot be cancelled).
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            dict: The job (see job()), or None if there is no such job.
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job["status"] == "queued":
+                self._finish(job, "cancelled", "Cancelled.")
+            return self._view(job)
+
+    def job(self, job_id):
+        """
+        Returns a job.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            dict: The job without its events (status is 'queued', 'running', 'completed', 'failed' or 'cancelled'),
+                or None if there is no such job.
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return self._view(job) if job else None
+
+    def jobs(self):
+        """
+        Returns all jobs (in order of submission).
+
+        Returns:
+            list: The jobs (see job()).
+        """
+        with self._condition:
+            return [self._view(job) for job in self._jobs.values()]
+
+    def events(self, job_id, start=0, timeout=None):
+        """
+        Waits for new events of a job.
+
+        Args:
+            job_id (str): The ID of the job.
+            start (int, optional): The number of events already seen. Default is 0.
+            timeout (float, optional): Maximum number of seconds to wait. Default is to wait forever.
+
+        Returns:
+            tuple: The new events (possibly none on timeout) and whether the job has finished,
+                or None if there is no such job.
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            self._condition.wait_for(lambda: len(job["events"]) > start or job["finished_at"], timeout)
+            return job["events"][start:], job["finished_at"] is not None
+
+    def yubikeys(self):
+        """
+        Returns the YubiKeys attached to the station.
+
+        Returns:
+            list: The YubiKeys as dictionaries with the serial number, model, status ('enrolled', 'unfinished',
+                'prepped', 'new' or, with the --bind option, 'not prepped') and the ID of the job running on it.
+        """
+        generation, yubikeys = self.watcher.snapshot()
+        attached = []
+        for serial_number, device in sorted(yubikeys.items(), key=lambda item: item[0] or 0):
+            if serial_number is None:
+                status = "no serial number"
+            elif self.ledger.has_serial_number(serial_number):
+                status = "enrolled"
+            elif self.ledger.journal_state(serial_number):
+                status = "unfinished"
+            elif self.ledger.inventory.prepped(serial_number):
+                status = "prepped"
+            else:
+                status = "not prepped" if self.bind_only else "new"
+            with self._condition:
+                job_id = self._running.get(serial_number)
+            attached.append({"serial_number": serial_number, "model": device.name, "status": status, "job": job_id})
+        return attached
+
+    def publish(self, serial_number, message):
+        """
+        Records a progress message of a YubiKey as an event of the job running on it (see station_echo()).
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+            message (str): The message.
+        """
+        with self._condition:
+            job = self._jobs.get(self._running.get(serial_number))
+            if job is not None:
+                self._event(job, message)
+
+    def _view(self, job):
+        return {name: value for name, value in job.items() if name != "events"}
+
+    def _event(self, job, message):
+        job["events"].append({"time": time.time(), "status": job["status"], "message": message})
+        self._condition.notify_all()
+
+    def _finish(self, job, status, message, error=None):
+        job["status"] = status
+        job["error"] = error
+        job["finished_at"] = time.time()
+        self._event(job, message)
+
+        # Forget the oldest finished jobs
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[:max(0, len(finished) - self.job_history)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            # Only watch the YubiKeys while jobs are queued (see DeviceWatcher)
+            with self._condition:
+                self._condition.wait_for(lambda: any(job["status"] == "queued" for job in self._jobs.values()))
+            generation, yubikeys = self.watcher.snapshot()
+            with self._condition:
+                pairs = self._pair(yubikeys)
+            for job, device, state in pairs:
+                threading.Thread(
+                    target=self._enroll, args=(job, device, state), name=f"enrollment-{device.info.serial}", daemon=True
+                ).start()
+
+            # Wake up when a YubiKey is inserted or removed, or shortly after a job is submitted
+            self.watcher.wait_for_change(generation, timeout=0.25)
+
+    def _conflict(self, job):
+        # Returns why a job for a given YubiKey can never be paired with it (or None if it can)
+        serial_number = job["serial_number"]
+        if serial_number is None:
+            return None
+        enrollment = self.ledger.enrollments_by_serial_number([serial_number]).get(serial_number)
+        if enrollment:
+            return f"YubiKey {serial_number} is already enrolled for '{enrollment['upn']}', revoke it to enroll it again."
+        state = self.ledger.journal_state(serial_number)
+        if state and state["upn"].lower() != job["upn"].lower():
+            return (
+                f"YubiKey {serial_number} has an unfinished enrollment for '{state['upn']}', "
+                "submit a job for that user to resume it."
+            )
+        return None
+
+    def _pair(self, yubikeys):
+        queued = [job for job in self._jobs.values() if job["status"] == "queued"]
+        if not queued:
+            return []
+
+        # Fail the jobs whose YubiKey was enrolled (or started to be enrolled) for another job since they were queued
+        for job in list(queued):
+            error = self._conflict(job)
+            if error:
+                queued.remove(job)
+                self._finish(job, "failed", f"🛑 {error}", error)
+        reserved = {job["serial_number"] for job in queued if job["serial_number"] is not None}
+        pairs = []
+        for serial_number in sorted(serial for serial in yubikeys if serial is not None):
+            if serial_number in self._running or not self.is_enrollable(serial_number):
+                continue
+            state = self.ledger.journal_state(serial_number)
+            if state:
+                candidates = [
+                    job for job in queued
+                    if job["upn"].lower() == state["upn"].lower() and job["serial_number"] in (None, serial_number)
+                ]
+            elif serial_number in reserved:
+                candidates = [job for job in queued if job["serial_number"] == serial_number]
+            else:
+                candidates = [job for job in queued if job["serial_number"] is None]
+            if not candidates:
+                continue
+            job = candidates[0]
+            queued.remove(job)
+            job["serial_number"] = serial_number
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            self._running[serial_number] = job["id"]
+            pairs.append((job, yubikeys[serial_number], state))
+        return pairs
+
+    def _enroll(self, job, device, state):
+        serial_number = device.info.serial
+        status, message, error = "failed", None, None
+        try:
+            if state:
+                state.setdefault("pin_change", job["pin_change"])
+                state.setdefault("nfc_restricted", job["nfc_restricted"])
+                completed = self.resume(device, state)
+            else:
+                with self.telemetry.context(serial=serial_number, upn=job["upn"]):
+                    user_profile, status_code = self.fetch_user(job["upn"])
+                if user_profile is None:
+                    error = f"Could not find user '{job['upn']}' (HTTP {status_code})."
+                    completed = False
+                else:
+                    completed = self.enroll(device, user_profile, job["pin_change"], job["nfc_restricted"])
+            if completed:
+                status, message = "completed", "Completed."
+        except Exception as e:
+            error = f"Enrollment failed: {e}"
+        with self._condition:
+            del self._running[serial_number]
+            self._finish(job, status, message or f"🛑 {error or 'Enrollment failed.'}", error)
+
+        # Keep the metrics up to date
+        with self._metrics_lock:
+            self.telemetry.write_metrics()
+
+
+# Function to refuse serving without a token on an address other hosts can reach
+def check_listen_address(host, token):
+    """
+    Checks that a server requiring no token only listens on a loopback address.
+
+    Args:
+        host (str): The address to listen on.
+        token (str): The bearer token required by the server, or None.
+
+    Raises:
+        ValueError: If no token is given for an address other than a loopback address.
+    """
+    try:
+        loopback = host == "localhost" or ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if token is None and not loopback:
+        raise ValueError(f"A token is required to listen on '{host}'.")
+
+
+# Function to create the HTTP server of the enrollment service
+def create_api_server(service, host="127.0.0.1", port=8765, token=None):
+    """
+    Creates the HTTP server of the local API of the enrollment service ('serve' command).
+
+    Requests and responses are JSON:
+
+        GET    /yubikeys           The YubiKeys attached to the station (see EnrollmentService.yubikeys())
+        GET    /jobs               All jobs (see EnrollmentService.job())
+        POST   /jobs               Submit a job: {"upn": "...", "serial_number": 12345678 (optional),
+                                   "pin_change": true (optional), "secure_transport": true (optional)}
+        GET    /jobs/{id}          A job
+        DELETE /jobs/{id}          Cancel a queued job
+        GET    /jobs/{id}/events   The progress events of a job as Server-Sent Events, until the job has finished
+
+    PINs are never returned: they are recorded in the ledger and the CSV output file only.
+
+    Args:
+        service (EnrollmentService): The enrollment service.
+        host (str, optional): The address to listen on. Default is localhost.
+        port (int, optional): The port to listen on. Default is 8765.
+        token (str, optional): A bearer token required in the Authorization header of every request. Default is none,
+            which is only allowed on a loopback address.
+
+    Returns:
+        ThreadingHTTPServer: The server (not yet serving).
+
+    Raises:
+        ValueError: If no token is given for an address other than a loopback address.
+    """
+    check_listen_address(host, token)
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def authorized(self):
+            if token is None:
+                return True
+            authorization = self.headers.get("Authorization", "")
+            if secrets.compare_digest(authorization.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+                return True
+            self.reply(401, {"error": "A valid bearer token is required."})
+            return False
+
+        def route(self):
+            path = urllib.parse.urlparse(self.path).path.strip("/").split("/")
+            job_id = path[1] if len(path) > 1 else None
+            return path[0], job_id, path[2:]
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+            resource, job_id, rest = self.route()
+            if resource == "yubikeys" and job_id is None:
+                self.reply(200, service.yubikeys())
+            elif resource == "jobs" and job_id is None:
+                self.reply(200, service.jobs())
+            elif resource == "jobs" and not rest:
+                job = service.job(job_id)
+                if job:
+                    self.reply(200, job)
+                else:
+                    self.reply(404, {"error": "No such job."})
+            elif resource == "jobs" and rest == ["events"]:
+                self.stream_events(job_id)
+            else:
+                self.reply(404, {"error": "Not found."})
+
+        def do_POST(self):
+            if not self.authorized():
+                return
+            resource, job_id, rest = self.route()
+            if resource != "jobs" or job_id is not None:
+                self.reply(404, {"error": "Not found."})
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                user_principal_name = request["upn"].strip()
+                serial_number = request.get("serial_number")
+                if serial_number is not None:
+                    serial_number = int(serial_number)
+                if not user_principal_name:
+                    raise ValueError("upn is empty")
+                pin_change = request.get("pin_change", True)
+                nfc_restricted = request.get("secure_transport", True)
+                for name, value in (("pin_change", pin_change), ("secure_transport", nfc_restricted)):
+                    if not isinstance(value, bool):
+                        raise ValueError(f"{name} is not true or false")
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                self.reply(400, {"error": f"Invalid job ({e}), expected {{\"upn\": ..., \"serial_number\": ...}}."})
+                return
+            job = service.submit(user_principal_name, serial_number, pin_change, nfc_restricted)
+            self.reply(202, job)
+
+        def do_DELETE(self):
+            if not self.authorized():
+                return
+            resource, job_id, rest = self.route()
+            job = service.cancel(job_id) if resource == "jobs" and job_id and not rest else None
+            if job:
+                self.reply(200, job)
+            else:
+                self.reply(404, {"error": "No such job."})
+
+        def stream_events(self, job_id):
+            seen = 0
+            result = service.events(job_id, seen, timeout=0)
+            if result is None:
+                self.reply(404, {"error": "No such job."})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            try:
+                while True:
+                    events, finished = service.events(job_id, seen, timeout=15) or ([], True)
+                    for event in events:
+                        self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                    seen += len(events)
+                    if finished and not events:
+                        break
+                    if not events:
+                        self.wfile.write(b": keep-alive\n\n")  # Detect clients that went away
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,1031 @@
+######################################################################
+# Simulated YubiKeys and Microsoft Graph API for sk-entra-id.py
+######################################################################
+# see readme.md for more info.
+#
+# Provides a software CTAP2 authenticator (standing in for the FIDO application of a YubiKey),
+# a simulated station into which such authenticators are inserted and removed, and a local
+# mock of the parts of Microsoft Graph API used by sk-entra-id.py. Together they allow full
+# enrollments to run without hardware or a tenant (python sk-entra-id.py --simulate 10).
+#
+# DEPENDENCIES:
+#   - Python-fido2 must be installed on the system
+#
+# BSD 2-Clause License
+# Copyright (c) 2025, swjm.blog
+######################################################################
+
+# Standard Library Imports
+import datetime
+import json
+import os
+import re
+import secrets
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Third-Party Library Imports
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from fido2 import cbor
+from fido2.attestation import PackedAttestation
+from fido2.cose import ES256
+from fido2.ctap import CtapDevice, CtapError, STATUS
+from fido2.ctap2 import ClientPin
+from fido2.ctap2.pin import PinProtocolV1, PinProtocolV2
+from fido2.hid import CAPABILITY, CTAPHID
+from fido2.utils import sha256, websafe_decode, websafe_encode
+from fido2.webauthn import (
+    AttestationObject,
+    AttestedCredentialData,
+    AuthenticatorData,
+    CollectedClientData,
+)
+
+
+# Set variable to control the AAGUID reported by simulated authenticators
+simulated_aaguid = uuid.UUID("00000000-5e11-4a7e-b10c-000000000001").bytes
+
+# Set variable to control the serial number of the first simulated YubiKey
+first_serial_number = 90000001
+
+
+# Version of a simulated YubiKey, comparable to tuples like (5, 7)
+class SimulatedVersion(tuple):
+    def __str__(self):
+        return ".".join(str(part) for part in self)
+
+
+# Device info of a simulated YubiKey (the attributes of yubikit's DeviceInfo used by sk-entra-id.py)
+class SimulatedDeviceInfo:
+    def __init__(self, serial, version):
+        self.serial = serial
+        self.version = SimulatedVersion(version)
+        self.nfc_restricted = False
+
+
+# Software CTAP2 authenticator
+class SimulatedAuthenticator:
+    """
+    Software implementation of the CTAP2 commands used to program a YubiKey.
+
+    Supports authenticatorGetInfo, authenticatorClientPIN (PIN/UV auth protocols 1 and 2, with
+    permissions), authenticatorMakeCredential (ES256, packed self attestation, credProtect and
+    hmac-secret), authenticatorReset (only within 10 seconds of insertion, like a YubiKey),
+    authenticatorConfig (setMinPINLength) and authenticatorCredentialManagement (metadata, enumeration
+    and deletion). As on CTAP 2.1 authenticators, the permissions of a PIN/UV auth token are cleared
+    once it has been used to create a credential.
+    """
+
+    PROTOCOLS = {2: PinProtocolV2(), 1: PinProtocolV1()}
+
+    def __init__(self, version=(5, 7, 1), pin=None, touch_delay=0.0):
+        """
+        Args:
+            version (tuple, optional): The firmware version. Default is (5, 7, 1).
+            pin (str, optional): A PIN already set on the authenticator. Default is no PIN.
+            touch_delay (float, optional): Seconds the simulated user takes to touch the authenticator. Default is 0.
+        """
+        self.version = tuple(version)
+        self.touch_delay = touch_delay
+        self._lock = threading.Lock()
+        self._key_agreement = ec.generate_private_key(ec.SECP256R1())
+        self.powered_up_at = time.monotonic()
+        self.created = 0  # Credentials created since manufacture (not cleared by a reset)
+        self._factory_reset()
+        if pin is not None:
+            self.pin_hash = sha256(pin.encode())[:16]
+            self.pin_length = len(pin)
+
+    def _factory_reset(self):
+        self.pin_hash = None
+        self.pin_length = 0
+        self.pin_retries = 8
+        self.min_pin_length = 4
+        self.force_pin_change = False
+        self.always_uv = False
+        self.enterprise_attestation = False
+        self.credentials = []
+        self._pin_token = None
+        self._permissions = 0
+        self._permissions_rp_id = None
+        self._enumeration = []
+
+    @property
+    def supports_config(self):
+        return self.version >= (5, 7)
+
+    def power_up(self):
+        """Simulates the authenticator being (re-)inserted: tokens are discarded."""
+        with self._lock:
+            self.powered_up_at = time.monotonic()
+            self._pin_token = None
+            self._permissions = 0
+
+    def call_cbor(self, request, on_keepalive=None):
+        """
+        Handles a CTAPHID_CBOR request.
+
+        Args:
+            request (bytes): The command byte followed by the CBOR encoded parameters.
+            on_keepalive (callable, optional): Called with STATUS.UPNEEDED while waiting for touch.
+
+        Returns:
+            bytes: The status byte followed by the CBOR encoded response.
+        """
+        command = request[0]
+        params = cbor.decode(request[1:]) if len(request) > 1 else {}
+        handlers = {
+            0x01: self._make_credential,
+            0x04: self._get_info,
+            0x06: self._client_pin,
+            0x07: self._reset,
+            0x0A: self._credential_management,
+        }
+        if self.supports_config:
+            handlers[0x0D] = self._config
+        handler = handlers.get(command)
+        try:
+            if handler is None:
+                raise CtapError(CtapError.ERR.INVALID_COMMAND)
+            with self._lock:
+                response = handler(params, on_keepalive)
+        except CtapError as e:
+            return struct.pack(">B", e.code)
+        return b"\x00" + (cbor.encode(response) if response is not None else b"")
+
+    def _touch(self, on_keepalive):
+        if on_keepalive:
+            on_keepalive(STATUS.UPNEEDED)
+        if self.touch_delay:
+            time.sleep(self.touch_delay)
+
+    def _get_info(self, params, on_keepalive):
+        options = {
+            "rk": True,
+            "up": True,
+            "plat": False,
+            "clientPin": self.pin_hash is not None,
+            "credMgmt": True,
+            "pinUvAuthToken": True,
+            "makeCredUvNotRqd": True,
+        }
+        if self.supports_config:
+            options["authnrCfg"] = True
+            options["setMinPINLength"] = True
+            options["alwaysUv"] = self.always_uv
+            options["ep"] = self.enterprise_attestation
+        return {
+            0x01: ["U2F_V2", "FIDO_2_0", "FIDO_2_1"],
+            0x02: ["credProtect", "hmac-secret", "minPinLength"],
+            0x03: simulated_aaguid,
+            0x04: options,
+            0x05: 1200,
+            0x06: list(self.PROTOCOLS),
+            0x07: 8,
+            0x08: 128,
+            0x09: ["usb"],
+            0x0A: [{"alg": -7, "type": "public-key"}],
+            0x0C: self.force_pin_change,
+            0x0D: self.min_pin_length,
+            0x0E: (self.version[0] << 16) | (self.version[1] << 8) | self.version[2],
+        }
+
+    # PIN/UV auth protocol
+
+    def _protocol(self, params, key=0x01):
+        protocol = self.PROTOCOLS.get(params.get(key))
+        if protocol is None:
+            raise CtapError(CtapError.ERR.INVALID_PARAMETER)
+        return protocol
+
+    def _shared_secret(self, protocol, peer_cose_key):
+        peer = ec.EllipticCurvePublicNumbers(
+            int.from_bytes(peer_cose_key[-2], "big"),
+            int.from_bytes(peer_cose_key[-3], "big"),
+            ec.SECP256R1(),
+        ).public_key()
+        return protocol.kdf(self._key_agreement.exchange(ec.ECDH(), peer))
+
+    def _verify(self, protocol, key, message, signature):
+        if not secrets.compare_digest(protocol.authenticate(key, message), signature or b""):
+            raise CtapError(CtapError.ERR.PIN_AUTH_INVALID)
+
+    def _check_pin(self, protocol, shared_secret, pin_hash_enc):
+        if self.pin_retries == 0:
+            raise CtapError(CtapError.ERR.PIN_BLOCKED)
+        if not secrets.compare_digest(protocol.decrypt(shared_secret, pin_hash_enc), self.pin_hash):
+            self.pin_retries -= 1
+            self._key_agreement = ec.generate_private_key(ec.SECP256R1())
+            raise CtapError(CtapError.ERR.PIN_INVALID)
+        self.pin_retries = 8
+
+    def _set_pin_hash(self, protocol, shared_secret, new_pin_enc):
+        padded = protocol.decrypt(shared_secret, new_pin_enc)
+        pin = padded.rstrip(b"\x00")
+        if len(padded) < 64 or len(pin.decode()) < self.min_pin_length:
+            raise CtapError(CtapError.ERR.PIN_POLICY_VIOLATION)
+        self.pin_hash = sha256(pin)[:16]
+        self.pin_length = len(pin.decode())
+        self.force_pin_change = False
+        self._pin_token = None
+
+    def _client_pin(self, params, on_keepalive):
+        sub_command = params.get(0x02)
+        protocol = self._protocol(params)
+
+        if sub_command == ClientPin.CMD.GET_PIN_RETRIES:
+            return {0x03: self.pin_retries}
+
+        if sub_command == ClientPin.CMD.GET_KEY_AGREEMENT:
+            numbers = self._key_agreement.public_key().public_numbers()
+            return {
+                0x01: {
+                    1: 2,
+                    3: -25,
+                    -1: 1,
+                    -2: numbers.x.to_bytes(32, "big"),
+                    -3: numbers.y.to_bytes(32, "big"),
+                }
+            }
+
+        shared_secret = self._shared_secret(protocol, params[0x03])
+
+        if sub_command == ClientPin.CMD.SET_PIN:
+            if self.pin_hash is not None:
+                raise CtapError(CtapError.ERR.NOT_ALLOWED)
+            self._verify(protocol, shared_secret, params[0x05], params.get(0x04))
+            self._set_pin_hash(protocol, shared_secret, params[0x05])
+            return None
+
+        if sub_command == ClientPin.CMD.CHANGE_PIN:
+            if self.pin_hash is None:
+                raise CtapError(CtapError.ERR.PIN_NOT_SET)
+            self._verify(protocol, shared_secret, params[0x05] + params[0x06], params.get(0x04))
+            self._check_pin(protocol, shared_secret, params[0x06])
+            self._set_pin_hash(protocol, shared_secret, params[0x05])
+            return None
+
+        if sub_command in (ClientPin.CMD.GET_TOKEN_USING_PIN_LEGACY, ClientPin.CMD.GET_TOKEN_USING_PIN):
+            if self.pin_hash is None:
+                raise CtapError(CtapError.ERR.PIN_NOT_SET)
+            self._check_pin(protocol, shared_secret, params[0x06])
+            if self.force_pin_change:
+                raise CtapError(CtapError.ERR.PIN_POLICY_VIOLATION)
+            if sub_command == ClientPin.CMD.GET_TOKEN_USING_PIN:
+                permissions = params.get(0x09, 0)
+                if not permissions:
+                    raise CtapError(CtapError.ERR.INVALID_PARAMETER)
+                if permissions & ClientPin.PERMISSION.AUTHENTICATOR_CFG and not self.supports_config:
+                    raise CtapError(CtapError.ERR.UNAUTHORIZED_PERMISSION)
+            else:
+                # Legacy tokens may be used for make credential and get assertion only
+                permissions = ClientPin.PERMISSION.MAKE_CREDENTIAL | ClientPin.PERMISSION.GET_ASSERTION
+            self._pin_token = os.urandom(32)
+            self._permissions = permissions
+            self._permissions_rp_id = params.get(0x0A)
+            return {0x02: protocol.encrypt(shared_secret, self._pin_token)}
+
+        raise CtapError(CtapError.ERR.INVALID_SUBCOMMAND)
+
+    def _check_token(self, protocol, message, pin_uv_param, permission, rp_id=None):
+        if self._pin_token is None:
+            raise CtapError(CtapError.ERR.PIN_AUTH_INVALID)
+        self._verify(protocol, self._pin_token, message, pin_uv_param)
+        if not self._permissions & permission:
+            raise CtapError(CtapError.ERR.PIN_AUTH_INVALID)
+        if rp_id and self._permissions_rp_id not in (None, rp_id):
+            raise CtapError(CtapError.ERR.PIN_AUTH_INVALID)
+
+    # Commands
+
+    def _make_credential(self, params, on_keepalive):
+        client_data_hash = params[0x01]
+        rp = params[0x02]
+        user = params[0x03]
+        if not any(p.get("alg") == -7 for p in params[0x04]):
+            raise CtapError(CtapError.ERR.UNSUPPORTED_ALGORITHM)
+        options = params.get(0x07) or {}
+
+        if self.pin_hash is not None:
+            if 0x08 not in params:
+                raise CtapError(CtapError.ERR.PIN_REQUIRED)
+            protocol = self._protocol(params, 0x09)
+            self._check_token(
+                protocol, client_data_hash, params[0x08], ClientPin.PERMISSION.MAKE_CREDENTIAL, rp["id"]
+            )
+            user_verified = True
+        elif options.get("uv"):
+            raise CtapError(CtapError.ERR.UNSUPPORTED_OPTION)
+        else:
+            user_verified = False
+
+        self._touch(on_keepalive)
+
+        # As on CTAP 2.1 authenticators, only the large blob write permission survives use of the token
+        self._permissions &= ClientPin.PERMISSION.LARGE_BLOB_WRITE
+
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        credential_id = os.urandom(64)
+        credential_data = AttestedCredentialData.create(
+            simulated_aaguid, credential_id, ES256.from_cryptography_key(private_key.public_key())
+        )
+
+        extensions = {}
+        requested = params.get(0x06) or {}
+        if requested.get("credProtect"):
+            extensions["credProtect"] = requested["credProtect"]
+        if requested.get("hmac-secret"):
+            extensions["hmac-secret"] = True
+
+        flags = AuthenticatorData.FLAG.UP | AuthenticatorData.FLAG.AT
+        if user_verified:
+            flags |= AuthenticatorData.FLAG.UV
+        if extensions:
+            flags |= AuthenticatorData.FLAG.ED
+        auth_data = AuthenticatorData.create(
+            sha256(rp["id"].encode()), flags, 0, credential_data, extensions or None
+        )
+        signature = private_key.sign(auth_data + client_data_hash, ec.ECDSA(hashes.SHA256()))
+
+        self.created += 1
+        self.credentials.append(
+            {
+                "rp": rp,
+                "user": user,
+                "credential_id": credential_id,
+                "private_key": private_key,
+                "cred_protect": extensions.get("credProtect", 1),
+            }
+        )
+        return {
+            0x01: "packed",
+            0x02: auth_data,
+            0x03: {"alg": -7, "sig": signature},
+        }
+
+    def _reset(self, params, on_keepalive):
+        if time.monotonic() - self.powered_up_at > 10:
+            raise CtapError(CtapError.ERR.NOT_ALLOWED)
+        self._touch(on_keepalive)
+        self._factory_reset()
+        return None
+
+    def _credential_management(self, params, on_keepalive):
+        sub_command = params.get(0x01)
+        sub_command_params = params.get(0x02) or {}
+        if sub_command not in (0x03, 0x05):  # Continuing an enumeration needs no token
+            message = struct.pack(">B", sub_command)
+            if 0x02 in params:
+                message += cbor.encode(params[0x02])
+            protocol = self._protocol(params, 0x03)
+            self._check_token(protocol, message, params.get(0x04), ClientPin.PERMISSION.CREDENTIAL_MGMT)
+            self._enumeration = []
+
+        if sub_command == 0x01:  # getCredsMetadata
+            return {0x01: len(self.credentials), 0x02: 25 - len(self.credentials)}
+
+        if sub_command == 0x02:  # enumerateRPsBegin
+            rps = list({credential["rp"]["id"]: credential["rp"] for credential in self.credentials}.values())
+            if not rps:
+                raise CtapError(CtapError.ERR.NO_CREDENTIALS)
+            self._enumeration = [{0x03: rp, 0x04: sha256(rp["id"].encode())} for rp in rps]
+            return {**self._enumeration.pop(0), 0x05: len(rps)}
+
+        if sub_command == 0x04:  # enumerateCredentialsBegin
+            credentials = [
+                {
+                    0x06: credential["user"],
+                    0x07: {"type": "public-key", "id": credential["credential_id"]},
+                    0x08: ES256.from_cryptography_key(credential["private_key"].public_key()),
+                    0x0A: credential["cred_protect"],
+                }
+                for credential in self.credentials
+                if sha256(credential["rp"]["id"].encode()) == sub_command_params.get(0x01)
+            ]
+            if not credentials:
+                raise CtapError(CtapError.ERR.NO_CREDENTIALS)
+            self._enumeration = credentials
+            return {**self._enumeration.pop(0), 0x09: len(credentials)}
+
+        if sub_command in (0x03, 0x05):  # enumerateRPsGetNextRP, enumerateCredentialsGetNextCredential
+            if not self._enumeration:
+                raise CtapError(CtapError.ERR.NOT_ALLOWED)
+            return self._enumeration.pop(0)
+
+        if sub_command == 0x06:  # deleteCredential
+            credential_id = (sub_command_params.get(0x02) or {}).get("id")
+            remaining = [credential for credential in self.credentials if credential["credential_id"] != credential_id]
+            if len(remaining) == len(self.credentials):
+                raise CtapError(CtapError.ERR.NO_CREDENTIALS)
+            self.credentials = remaining
+            return None
+
+        raise CtapError(CtapError.ERR.INVALID_SUBCOMMAND)
+
+    def _config(self, params, on_keepalive):
+        sub_command = params.get(0x01)
+        sub_command_params = params.get(0x02)
+        if self.pin_hash is not None:
+            message = b"\xff" * 32 + b"\x0d" + struct.pack("<B", sub_command)
+            if sub_command_params is not None:
+                message += cbor.encode(sub_command_params)
+            protocol = self._protocol(params, 0x03)
+            self._check_token(
+                protocol, message, params.get(0x04), ClientPin.PERMISSION.AUTHENTICATOR_CFG
+            )
+
+        if sub_command != 0x03:  # setMinPINLength
+            raise CtapError(CtapError.ERR.INVALID_SUBCOMMAND)
+        sub_command_params = sub_command_params or {}
+        new_min_pin_length = sub_command_params.get(0x01, self.min_pin_length)
+        if new_min_pin_length < self.min_pin_length:
+            raise CtapError(CtapError.ERR.PIN_POLICY_VIOLATION)
+        self.min_pin_length = new_min_pin_length
+        if sub_command_params.get(0x03) or (self.pin_hash and self.pin_length < new_min_pin_length):
+            self.force_pin_change = True
+        return None
+
+
+# Connection to a simulated YubiKey (the FIDO HID connection used by fido2)
+class SimulatedConnection(CtapDevice):
+    def __init__(self, yubikey):
+        self.yubikey = yubikey
+        self.closed = False
+
+    @property
+    def capabilities(self):
+        return CAPABILITY.CBOR | CAPABILITY.WINK
+
+    def call(self, cmd, data=b"", event=None, on_keepalive=None):
+        if self.closed or not self.yubikey.attached:
+            raise OSError("Simulated YubiKey is not attached")
+        if cmd == CTAPHID.CBOR:
+            return self.yubikey.authenticator.call_cbor(data, on_keepalive)
+        if cmd == CTAPHID.WINK:
+            return b""
+        raise CtapError(CtapError.ERR.INVALID_COMMAND)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.yubikey.station.connection_closed(self.yubikey)
+
+    @classmethod
+    def list_devices(cls):
+        return iter([])
+
+
+# Management session with a simulated YubiKey (the parts of yubikit's ManagementSession used by sk-entra-id.py)
+class SimulatedManagementSession:
+    def __init__(self, connection):
+        self.yubikey = connection.yubikey
+
+    def read_device_info(self):
+        return self.yubikey.info
+
+    def write_device_config(self, config=None, reboot=False, cur_lock_code=None, new_lock_code=None):
+        if config is not None and config.nfc_restricted is not None:
+            if self.yubikey.info.version < (5, 7):
+                raise CtapError(CtapError.ERR.INVALID_PARAMETER)
+            self.yubikey.info.nfc_restricted = bool(config.nfc_restricted)
+
+
+# Simulated YubiKey (the parts of ykman's ScriptingDevice used by sk-entra-id.py)
+class SimulatedYubiKey:
+    def __init__(self, station, serial_number, version=(5, 7, 1), pin=None, touch_delay=0.0):
+        self.station = station
+        self.info = SimulatedDeviceInfo(serial_number, version)
+        self.name = "YubiKey 5 NFC"
+        self.authenticator = SimulatedAuthenticator(version, pin, touch_delay)
+        self.attached = False
+        self.insertions = 0
+        self.had_pin = pin is not None
+
+    @property
+    def fingerprint(self):
+        return f"simulated:{self.info.serial}:{self.insertions}"
+
+    def fido(self):
+        return SimulatedConnection(self)
+
+    def __repr__(self):
+        return f"SimulatedYubiKey({self.info.serial})"
+
+
+# Station with simulated YubiKeys, used by sk-entra-id.py instead of the YubiKeys attached over USB
+class SimulatedStation:
+    """
+    Device backend with simulated YubiKeys and a simulated operator.
+
+    The station holds a supply of YubiKeys and keeps up to `slots` of them inserted. The simulated
+    operator reacts to the programming sequence the way a person at the station would:
+
+    - When the connection to a YubiKey that had a PIN set on insertion is closed before it has been
+      reset (i.e. the operator was asked to re-insert it for a reset), the YubiKey is re-inserted.
+    - When the connection to any other YubiKey is closed, it is removed and the next YubiKey from
+      the supply is inserted in its place.
+
+    Touch is simulated after touch_delay seconds. on_change is called after every insertion and
+    removal (sk-entra-id.py uses it to re-scan the attached YubiKeys immediately).
+    """
+
+    def __init__(self, count, slots=1, version=(5, 7, 1), pin=None, touch_delay=0.0):
+        """
+        Args:
+            count (int): The number of YubiKeys in the supply.
+            slots (int, optional): The number of YubiKeys inserted at the same time. Default is 1.
+            version (tuple, optional): The firmware version of the YubiKeys. Default is (5, 7, 1).
+            pin (str, optional): A PIN already set on every YubiKey (so that they need a reset). Default is no PIN.
+            touch_delay (float, optional): Seconds the simulated operator takes to touch a YubiKey. Default is 0.
+        """
+        self.slots = slots
+        self.on_change = None
+        self._lock = threading.RLock()
+        self.supply = [
+            SimulatedYubiKey(self, first_serial_number + i, version, pin, touch_delay)
+            for i in range(count)
+        ]
+        self.attached = []
+        self.removed = []
+        self._fill()
+
+    def _fill(self):
+        while len(self.attached) < self.slots and self.supply:
+            self._insert(self.supply.pop(0))
+
+    def _insert(self, yubikey):
+        yubikey.attached = True
+        yubikey.insertions += 1
+        yubikey.created_at_insertion = yubikey.authenticator.created
+        yubikey.authenticator.power_up()
+        self.attached.append(yubikey)
+
+    def _notify(self):
+        if self.on_change:
+            self.on_change()
+
+    def connection_closed(self, yubikey):
+        """Simulates the operator removing (and, for a reset, re-inserting) a YubiKey."""
+        if not yubikey.attached:
+            return
+        with self._lock:
+            self.attached.remove(yubikey)
+            yubikey.attached = False
+        self._notify()
+
+        authenticator = yubikey.authenticator
+        with self._lock:
+            if (
+                yubikey.had_pin
+                and authenticator.pin_hash is not None
+                and authenticator.created == yubikey.created_at_insertion
+            ):
+                # Re-inserted to be reset (no credential was created since it was inserted)
+                yubikey.had_pin = False
+                self._insert(yubikey)
+            else:
+                self.removed.append(yubikey)
+                self._fill()
+        self._notify()
+
+    def list_yubikeys(self):
+        """
+        Lists the simulated YubiKeys currently inserted, keyed by serial number.
+
+        Returns:
+            dict: A dictionary mapping serial numbers to simulated YubiKeys.
+        """
+        with self._lock:
+            return {yubikey.info.serial: yubikey for yubikey in self.attached}
+
+    def open_event_socket(self):
+        return None
+
+    def management_session(self, connection):
+        return SimulatedManagementSession(connection)
+
+
+# Function to encode bytes as base64url without padding (as used by Microsoft Graph API)
+def b64url(data):
+    return websafe_encode(data)
+
+
+# Mock of the parts of Microsoft Graph API used by sk-entra-id.py
+class MockGraphServer:
+    """
+    Local HTTP server implementing the Microsoft Graph API and token endpoints used by sk-entra-id.py.
+
+    Implements:
+        POST /{tenant}/oauth2/v2.0/token                                  (client credentials)
+        GET  /beta/users/{id or UPN}
+        GET  /beta/users/delta                                            (paged, with delta links)
+        GET  /beta/users/{id or UPN}/authentication/fido2Methods/creationOptions
+        GET  /beta/users/{id or UPN}/authentication/fido2Methods
+        POST /beta/users/{id or UPN}/authentication/fido2Methods          (verifies the attestation)
+        DELETE /beta/users/{id or UPN}/authentication/fido2Methods/{id}
+        GET  /beta/groups?$filter=displayName eq '{name}'
+        GET  /beta/groups/{id}
+        GET  /beta/groups/{id}/transitiveMembers/microsoft.graph.user     (paged)
+        POST /beta/$batch                                                 (JSON batching of the above)
+
+    Any UPN containing '@' is treated as an existing user, unless the set of users is given, and any
+    group name as an existing group of `group_size` users, unless the groups are given.
+    Responses can be delayed by `latency` seconds to mimic the round trip to Microsoft Graph API.
+    """
+
+    def __init__(
+        self, users=None, groups=None, group_size=10, latency=0.0, challenge_timeout=5, page_size=100,
+        host="127.0.0.1", port=0,
+    ):
+        """
+        Args:
+            users (Iterable[str], optional): UPNs of the existing users. Default is any UPN.
+            groups (dict, optional): UPNs of the members of the existing groups, by group name. Default is any name.
+            group_size (int, optional): Number of members of the groups that are not given. Default is 10.
+            latency (float, optional): Seconds each response is delayed. Default is 0.
+            challenge_timeout (int, optional): Default challenge timeout in minutes. Default is 5.
+            page_size (int, optional): Maximum number of users per page of users/delta. Default is 100.
+            host (str, optional): Address to listen on. Default is 127.0.0.1.
+            port (int, optional): Port to listen on. Default is any free port.
+        """
+        self.latency = latency
+        self.challenge_timeout = challenge_timeout
+        self.page_size = page_size
+        self.client_id = "simulated-client-id"
+        self.client_secret = secrets.token_urlsafe(16)
+        self.tenant_id = "simulated.onmicrosoft.com"
+        self._lock = threading.Lock()
+        self._tokens = set()
+        self.users = {}
+        self._changes = []  # IDs of users added or removed (positions are the delta tokens)
+        self._challenges = {}
+        self.methods = {}
+        self.requests = []
+        self.groups = {}
+        self.group_size = group_size
+        self._any_user = users is None
+        self._any_group = groups is None
+        for upn in users or ():
+            self._add_user(upn)
+        for name, members in (groups or {}).items():
+            self._add_group(name, members)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Send each response in one segment (avoids delayed ACK stalls on keep-alive connections)
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server._handle(self, "GET")
+
+            def do_POST(self):
+                server._handle(self, "POST")
+
+            def do_DELETE(self):
+                server._handle(self, "DELETE")
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def config(self):
+        """
+        Returns a config (as read from config.json by sk-entra-id.py) pointing at this server.
+
+        Returns:
+            dict: The config.
+        """
+        return {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "tenant_id": self.tenant_id,
+            "graph_endpoint": self.url + "/beta",
+            "login_endpoint": self.url,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="mock-graph", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, typ, value, traceback):
+        self.stop()
+
+    # Directory
+
+    def _add_user(self, upn):
+        user_id = str(uuid.uuid5(uuid.NAMESPACE_URL, upn.lower()))
+        name = upn.split("@")[0].replace(".", " ").title()
+        user = {"id": user_id, "userPrincipalName": upn, "displayName": name}
+        self.users[user_id] = user
+        self._changes.append(user_id)
+        return user
+
+    def remove_user(self, user):
+        """
+        Deletes a user (reported as removed by users/delta).
+
+        Args:
+            user (str): The ID or User Principal Name of the user.
+        """
+        profile = self.find_user(user)
+        if profile:
+            with self._lock:
+                del self.users[profile["id"]]
+                self._changes.append(profile["id"])
+
+    def _add_group(self, name, members):
+        group_id = str(uuid.uuid5(uuid.NAMESPACE_URL, "group:" + name.lower()))
+        member_ids = []
+        for upn in members:
+            user = next((user for user in self.users.values() if user["userPrincipalName"].lower() == upn.lower()), None)
+            member_ids.append((user or self._add_user(upn))["id"])
+        self.groups[group_id] = {"id": group_id, "displayName": name, "members": member_ids}
+        return self.groups[group_id]
+
+    def find_group(self, group):
+        """
+        Looks up a group by ID or name.
+
+        Args:
+            group (str): The ID or name of the group.
+
+        Returns:
+            dict: The group (with the IDs of its members), or None if not found.
+        """
+        with self._lock:
+            if group in self.groups:
+                return self.groups[group]
+            for profile in self.groups.values():
+                if profile["displayName"].lower() == group.lower():
+                    return profile
+            if self._any_group:
+                slug = "".join(c for c in group.lower() if c.isalnum())
+                return self._add_group(
+                    group, [f"member{i}.{slug}@{self.tenant_id}" for i in range(1, self.group_size + 1)]
+                )
+        return None
+
+    def find_user(self, user):
+        """
+        Looks up a user by ID or UPN.
+
+        Args:
+            user (str): The ID or User Principal Name of the user.
+
+        Returns:
+            dict: The user, or None if not found.
+        """
+        with self._lock:
+            if user in self.users:
+                return self.users[user]
+            for profile in self.users.values():
+                if profile["userPrincipalName"].lower() == user.lower():
+                    return profile
+            if self._any_user and "@" in user:
+                return self._add_user(user)
+        return None
+
+    # HTTP handling
+
+    def _reply(self, handler, status, body=None, headers=None):
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        handler.send_response(status)
+        if body is not None:
+            handler.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _error(self, status, code, message):
+        return status, {"error": {"code": code, "message": message}}
+
+    def _handle(self, handler, method):
+        url = urlparse(handler.path)
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        with self._lock:
+            self.requests.append((method, url.path))
+        if self.latency:
+            time.sleep(self.latency)
+
+        path = [unquote(part) for part in url.path.strip("/").split("/")]
+        if method == "POST" and path[1:] == ["oauth2", "v2.0", "token"]:
+            return self._reply(handler, *self._token(parse_qs(body.decode("utf-8"))))
+
+        authorization = handler.headers.get("Authorization", "")
+        token = authorization.split(" ")[-1]
+        with self._lock:
+            authorized = token in self._tokens
+        if not authorized:
+            return self._reply(handler, *self._error(401, "InvalidAuthenticationToken", "Access token is invalid."))
+
+        if method == "POST" and path == ["beta", "$batch"]:
+            return self._reply(handler, *self._batch(body))
+        self._reply(handler, *self._route(method, url, body))
+
+    def _route(self, method, url, body):
+        path = [unquote(part) for part in url.path.strip("/").split("/")]
+        if path[:2] == ["beta", "groups"] and method == "GET":
+            return self._groups(path[2:], parse_qs(url.query))
+        if path[:2] != ["beta", "users"] or len(path) < 3:
+            return self._error(404, "NotFound", f"Resource '{url.path}' not found.")
+        if method == "GET" and path[2:] == ["delta"]:
+            return self._delta(parse_qs(url.query))
+        user = self.find_user(path[2].rstrip("/"))
+        if user is None:
+            return self._error(404, "Request_ResourceNotFound", f"User '{path[2]}' does not exist.")
+
+        resource = path[3:]
+        query = parse_qs(url.query)
+        if method == "GET" and not resource:
+            return 200, user
+        if resource[:2] == ["authentication", "fido2Methods"]:
+            if method == "GET" and resource[2:] == ["creationOptions"]:
+                return self._creation_options(user, query)
+            if method == "GET" and not resource[2:]:
+                with self._lock:
+                    methods = list(self.methods.get(user["id"], {}).values())
+                return 200, {"value": methods}
+            if method == "POST" and not resource[2:]:
+                return self._create_method(user, body)
+            if method == "DELETE" and len(resource) == 3:
+                with self._lock:
+                    deleted = self.methods.get(user["id"], {}).pop(resource[2], None)
+                if deleted is None:
+                    return self._error(404, "itemNotFound", f"FIDO2 method '{resource[2]}' does not exist.")
+                return 204, None
+        return self._error(405, "MethodNotAllowed", f"{method} '{url.path}' is not supported.")
+
+    def _groups(self, resource, query):
+        if not resource:
+            match = re.fullmatch(r"displayName eq '((?:[^']|'')*)'", (query.get("$filter") or [""])[0])
+            if not match:
+                return self._error(400, "Request_UnsupportedQuery", "Only filtering by displayName is supported.")
+            group = self.find_group(match.group(1).replace("''", "'"))
+            return 200, {"value": [{"id": group["id"], "displayName": group["displayName"]}] if group else []}
+
+        with self._lock:
+            group = self.groups.get(resource[0])
+        if group is None:
+            return self._error(404, "Request_ResourceNotFound", f"Group '{resource[0]}' does not exist.")
+        if not resource[1:]:
+            return 200, {"id": group["id"], "displayName": group["displayName"]}
+        if resource[1:] != ["transitiveMembers", "microsoft.graph.user"]:
+            return self._error(405, "MethodNotAllowed", f"'{'/'.join(resource)}' is not supported.")
+
+        top = int((query.get("$top") or [self.page_size])[0])
+        offset = int((query.get("$skiptoken") or [0])[0])
+        with self._lock:
+            members = [self.users[user_id] for user_id in group["members"] if user_id in self.users]
+        body = {"@odata.count": len(members), "value": members[offset:offset + top]}
+        if offset + top < len(members):
+            body["@odata.nextLink"] = (
+                f"{self.url}/beta/groups/{group['id']}/transitiveMembers/microsoft.graph.user?$top={top}&$skiptoken={offset + top}"
+            )
+        return 200, body
+
+    def _delta(self, query):
+        # Tokens are positions in the change log: a delta token where the changes start, a skip token
+        # where they start and end and the offset of the page
+        with self._lock:
+            if "$deltatoken" in query:
+                since, end, offset = int(query["$deltatoken"][0]), len(self._changes), 0
+            elif "$skiptoken" in query:
+                since, end, offset = (int(part) for part in query["$skiptoken"][0].split("."))
+            else:
+                since, end, offset = 0, len(self._changes), 0
+            user_ids = list(dict.fromkeys(self._changes[since:end]))
+            page = [
+                self.users.get(user_id) or {"id": user_id, "@removed": {"reason": "deleted"}}
+                for user_id in user_ids[offset:offset + self.page_size]
+            ]
+        body = {"value": page}
+        if offset + self.page_size < len(user_ids):
+            body["@odata.nextLink"] = f"{self.url}/beta/users/delta?$skiptoken={since}.{end}.{offset + self.page_size}"
+        else:
+            body["@odata.deltaLink"] = f"{self.url}/beta/users/delta?$deltatoken={end}"
+        return 200, body
+
+    def _batch(self, body):
+        try:
+            requests = json.loads(body)["requests"]
+        except (KeyError, TypeError, ValueError) as e:
+            return self._error(400, "BadRequest", f"Malformed batch request: {e}")
+        if len(requests) > 20:
+            return self._error(400, "BadRequest", "A batch request cannot contain more than 20 requests.")
+
+        responses = []
+        for request in requests:
+            url = urlparse("/beta/" + request["url"].lstrip("/"))
+            payload = json.dumps(request["body"]).encode("utf-8") if "body" in request else b""
+            status, response = self._route(request["method"], url, payload)
+            responses.append({"id": request["id"], "status": status, "body": response})
+        return 200, {"responses": responses}
+
+    def _token(self, form):
+        if (
+            form.get("client_id", [None])[0] != self.client_id
+            or form.get("client_secret", [None])[0] != self.client_secret
+        ):
+            return 401, {"error": "invalid_client"}
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            self._tokens.add(token)
+        return 200, {"token_type": "Bearer", "expires_in": 3599, "access_token": token}
+
+    def _creation_options(self, user, query):
+        timeout = int((query.get("challengeTimeoutInMinutes") or query.get("challenge_timeout") or [self.challenge_timeout])[0])
+        challenge = os.urandom(32)
+        expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=timeout)
+        with self._lock:
+            self._challenges[b64url(challenge)] = (user["id"], expiry)
+        return (
+            200,
+            {
+                "challengeTimeoutDateTime": expiry.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                "publicKey": {
+                    "challenge": b64url(challenge),
+                    "timeout": timeout * 60000,
+                    "attestation": "direct",
+                    "rp": {"id": "login.microsoft.com", "name": "Microsoft"},
+                    "user": {
+                        "id": b64url(uuid.UUID(user["id"]).bytes),
+                        "displayName": user["displayName"],
+                        "name": user["userPrincipalName"],
+                    },
+                    "pubKeyCredParams": [
+                        {"type": "public-key", "alg": -7},
+                        {"type": "public-key", "alg": -257},
+                    ],
+                    "excludeCredentials": [],
+                    "authenticatorSelection": {
+                        "authenticatorAttachment": "cross-platform",
+                        "requireResidentKey": True,
+                        "userVerification": "required",
+                    },
+                    "extensions": {
+                        "hmacCreateSecret": True,
+                        "enforceCredentialProtectionPolicy": True,
+                        "credentialProtectionPolicy": "userVerificationOptional",
+                    },
+                },
+            },
+        )
+
+    def _create_method(self, user, body):
+        try:
+            request = json.loads(body)
+            credential = request["publicKeyCredential"]
+            client_data = CollectedClientData(websafe_decode(credential["response"]["clientDataJSON"]))
+            attestation = AttestationObject(websafe_decode(credential["response"]["attestationObject"]))
+        except (KeyError, TypeError, ValueError) as e:
+            return self._error(400, "invalidRequest", f"Malformed request: {e}")
+
+        with self._lock:
+            user_id, expiry = self._challenges.pop(b64url(client_data.challenge), (None, None))
+        if user_id != user["id"] or expiry < datetime.datetime.now(datetime.timezone.utc):
+            return self._error(400, "invalidRequest", "Challenge is unknown or has expired.")
+        if client_data.type != "webauthn.create" or attestation.auth_data.rp_id_hash != sha256(b"login.microsoft.com"):
+            return self._error(400, "invalidRequest", "Client data or RP ID does not match.")
+        try:
+            PackedAttestation().verify(attestation.att_stmt, attestation.auth_data, client_data.hash)
+        except Exception as e:
+            return self._error(400, "invalidRequest", f"Attestation could not be verified: {e}")
+
+        method = {
+            "id": b64url(attestation.auth_data.credential_data.credential_id),
+            "displayName": request.get("displayName"),
+            "createdDateTime": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "aaGuid": str(uuid.UUID(bytes=bytes(attestation.auth_data.credential_data.aaguid))),
+            "model": "YubiKey 5 NFC",
+            "attestationLevel": "notAttested",
+        }
+        with self._lock:
+            self.methods.setdefault(user["id"], {})[method["id"]] = method
+        return 201, method
@@ -15,6 +15,16 @@
 # 
 # USAGE: python sk-entra-id.py
 #
+# MODULES (next to this script):
+#   - graph.py: Microsoft Graph API client (rate limit, retries, access token)
+#   - ledger.py: Ledger of programmed YubiKeys and the CSV output file
+#   - telemetry.py: Timing spans, events and metrics of enrollments
+#   - watcher.py: Watcher of attached YubiKeys
+#   - service.py: Enrollment service and its local HTTP API ('serve' command)
+#   - coordinator.py: Coordinator of several stations ('coordinator' command)
+#   - benchmark.py: Summary of benchmark results ('benchmark' command)
+#   - simulator.py: Simulated YubiKeys and Microsoft Graph API (--simulate option)
+#
 # BSD 2-Clause License                                                             
 # Copyright (c) 2025, swjm.blog
 # Copyright (c) 2024, Yubico AB
@@ -49,37 +59,45 @@
 # Standard Library Imports
 import base64
 import datetime
+import hashlib
 import json
 import os
-import re
 import secrets
 import sys
+import threading
 import time
+import uuid
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Timer
 import platform
-from time import sleep
+
+try:
+    import readline  # Completion of User Principal Names at prompts (not available on Windows)
+except ImportError:
+    readline = None
 
 # Third-Party Library Imports
 import click
 import requests
 from contextlib import contextmanager
-from fido2.client import Fido2Client, UserInteraction
-from fido2.ctap2 import Ctap2, ClientPin, Config
-from fido2.ctap2.extensions import CredProtectExtension
-from fido2.ctap2.pin import ClientPin
-from fido2.hid import CtapHidDevice
-from fido2.utils import websafe_encode
 import string
 import csv
 
-# Local Imports
-from ykman import scripting as s
-from yubikit.management import (
-    ManagementSession,
-    DeviceConfig,
-)
-from ykman.device import list_ctap_devices
-from yubikit.core.fido import FidoConnection
+# Local Imports (modules next to this script)
+from benchmark import report_benchmark
+from coordinator import Coordinator, LeasedJobs, create_coordinator_server, open_coordinator
+from graph import GraphClient, RateLimiter, TokenProvider, get_retry_delay
+from ledger import Ledger, csv_headers
+from service import EnrollmentService, check_listen_address, create_api_server
+from telemetry import Telemetry
+from watcher import DeviceWatcher, open_uevent_socket
+
+# Version of this script (recorded with benchmark results)
+__version__ = "1.5"
+
+# NOTE: The hardware libraries (fido2, ykman and yubikit) are imported by the functions using them,
+# so that the script starts (and can be imported, e.g., by other tools) without loading them.
 
 
 # Function to display program banner
@@ -114,902 +132,2870 @@ def banner():
     click.secho("                                                                                            ")
 
 
-# Function to obtain OAuth access token from Microsoft Graph API
-def send_token_request(token_endpoint, headers, body):
-    """
-    Sends a token request to the specified token endpoint.
-
-    Args:
-        token_endpoint (str): The token endpoint URL.
-        headers (dict): The HTTP headers for the request.
-        body (dict): The request body.
+# Set variable to control PIN length
+pin_length = 4
 
-    Returns:
-        requests.Response: The response object.
-    """
-    response = requests.post(token_endpoint, data=body, headers=headers, verify=False)
-    response.raise_for_status()  # Raise an exception for HTTP errors
-    return response
+# Set variable to control how long the challenges of FIDO2 credential creation options are valid, in minutes
+# (may be overridden in the config file; for offline enrollment, credentials must be uploaded within this time)
+challenge_timeout = 5
 
+# Set variable to control the number of connections to Microsoft Graph API kept open (one per parallel worker)
+graph_pool_size = 10
 
-# Function setting the HTTP headers for Microsoft Graph API
-def set_http_headers(access_token):
-    """
-    Sets the HTTP headers required for making requests to the Microsoft Graph API.
+# Set variables to control the request rate to Microsoft Graph API (shared by all parallel workers)
+graph_rate_limit = 10  # Requests per second
+graph_max_retries = 5  # Retries of throttled requests
 
-    This function takes an access token as input and returns a dictionary containing
-    the necessary headers for authenticating and formatting the requests to the Microsoft Graph API.
+# Set variables to control the Microsoft Graph API and token endpoints (may be overridden in the config file)
+graph_endpoint = "https://graph.microsoft.com/beta"
+login_endpoint = "https://login.microsoftonline.com"
 
-    Args:
-        access_token (str): The access token obtained from the authentication process.
+# Set variable to control the location of the ledger (the record of programmed YubiKeys) and the CSV output file
+# (written from the ledger after every change)
+ledger_file = "output.db"
+output_file = "output.csv"
 
-    Returns:
-        dict: A dictionary containing the HTTP headers for the Microsoft Graph API requests.
-    """
-    return {
-        "Accept": "application/json",
-        "Authorization": access_token,
-        "Content-Type": "application/json",
-        "Accept-Encoding": "gzip, deflate, br",
-    }
+# Ledger of programmed YubiKeys (opened by open_ledger())
+ledger = None
 
 
-# Function to construct request body when accessing Microsoft Graph API
-def construct_request_body(client_id, client_secret):
-    """
-    Constructs the request body for obtaining an access token.
+# Timing spans, events and metrics (files set by the --events and --metrics options)
+telemetry = Telemetry()
 
-    Args:
-        client_id (str): The client ID of the application.
-        client_secret (str): The client secret of the application.
+# Shared HTTP client for all requests to Microsoft Graph API (connected by connect_to_graph())
+graph = GraphClient(
+    graph_pool_size,
+    rate_limiter=RateLimiter(graph_rate_limit),
+    max_retries=graph_max_retries,
+    telemetry=telemetry,
+)
 
-    Returns:
-        dict: The constructed request body.
-    """
-    return {
-        "grant_type": "client_credentials",
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "scope": "https://graph.microsoft.com/.default",
-    }
+# Thread pool for requests to Microsoft Graph API running while YubiKeys are being programmed
+graph_executor = ThreadPoolExecutor(max_workers=graph_pool_size)
 
 
-# Function to parse access token in response from Microsoft Graph API
-def extract_access_token(response):
+# Function to exit the program after a countdown
+def exit_program():
     """
-    Extracts the access token from the response.
+    Exits the program after a countdown of 3 seconds.
+    """
+    click.clear()
+    # Exit program in 3 seconds
+    for i in range(3, 0, -1):  # Countdown from 3 seconds
+        click.secho(f"Exiting program in {i} seconds...")
+        time.sleep(1)
+        click.clear()
+    click.clear()
+    sys.exit(1)
 
-    Args:
-        response (requests.Response): The response object.
 
-    Returns:
-        str: The extracted access token.
+# Function to check if program is running as administrator
+def check_administrator():
+    """
+    Checks if the script is running with administrative privileges (required on Windows).
     """
-    access_token = re.search('"access_token":"([^"]+)"', str(response.content))
-    if not access_token:
-        raise ValueError("Access token not found in response")
-    return access_token.group(1)
+    if platform.system() == "Windows":
+        import ctypes
+
+        if ctypes.windll.shell32.IsUserAnAdmin() == 0:
+            click.clear()
+            banner()
+            click.pause(
+                "🛑 Program is not running as administrator (press any key to exit)"
+            )
+            exit_program()
 
 
-# Function to retrieve acces token from Microsoft Graph API
-def get_access_token_for_microsoft_graph(client_id, client_secret, tenant_id):
+# Function to load the config file
+def load_config(config_file=None):
     """
-    Retrieves an access token for accessing Microsoft Graph API using OAuth client credentials flow.
+    Loads the JSON file containing details of the Microsoft Entra ID app registration
+    necessary to connect and provision our user(s). See readme.md for more information!
 
     Args:
-        client_id (str): The client ID of the application.
-        client_secret (str): The client secret of the application.
-        tenant_id (str): The name of the Entra directory as an fqdn.
+        config_file (str, optional): Path to the config file. Default is config.json next to the script.
 
     Returns:
-        str: The access token.
+        dict: The config, containing (at least) 'client_id', 'client_secret' and 'tenant_id'.
     """
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    token_endpoint = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+    if config_file is None:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        config_file = os.path.join(script_dir, "config.json")
 
-    body = construct_request_body(client_id, client_secret)
+    if not os.path.exists(config_file):
+        banner()
+        click.pause("🛑 Config file not found (press any key to continue)")
+        click.clear()
+        # Prompt for config file path if not found
+        banner()
+        config_file = click.prompt("Please provide a path to the config file", type=str)
 
-    token_response = send_token_request(token_endpoint, headers, body)
+    try:
+        with open(config_file, "r", encoding="utf8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        banner()
+        click.pause(f"🛑 Config file not found (press any key to exit)")
+        exit_program()
+    except json.JSONDecodeError:
+        banner()
+        click.pause("🛑 Error decoding JSON (press any key to exit)")
+        exit_program()
 
-    access_token = extract_access_token(token_response)
+    # Config attributes we need
+    missing = [name for name in ("client_id", "client_secret", "tenant_id") if not config.get(name)]
+    if missing:
+        banner()
+        click.pause(f"🛑 Config file is missing {', '.join(missing)} (press any key to exit)")
+        exit_program()
 
-    return access_token
+    return config
 
 
-# Set variable to control PIN length
-pin_length = 4
+# Function to open the ledger of programmed YubiKeys
+def open_ledger():
+    """
+    Opens the ledger (an SQLite database) in which programmed YubiKeys are recorded.
 
-# Check if program is running as administrator
-"""
-Checks if the script is running with administrative privileges (required on Windows).
-"""
-if platform.system() == "Windows":
-    import ctypes
+    The ledger is the record of programmed YubiKeys: each enrollment is committed to it as soon as
+    it completes, and the output file in CSV format is written again right after. Changes made to
+    the output file by hand (or an output file written by an earlier version of this script) are
+    applied to the ledger when it is opened (see Ledger.sync_csv()).
 
-    if ctypes.windll.shell32.IsUserAnAdmin() != 0:
-        pass
-    else:
-        click.clear()
-        banner()
-        click.pause(
-            "🛑 Program is not running as administrator (press any key to exit)"
-        )
-        click.clear()
-        # Exit program in 3 seconds
-        for i in range(3, 0, -1):  # Countdown from 3 seconds
-            click.secho(f"Exiting program in {i} seconds...")
-            time.sleep(1)
-            click.clear()
-        click.clear()
-        sys.exit(1)
-else:
-    pass
+    Returns:
+        Ledger: The ledger.
+    """
+    global ledger
+    if ledger is None:
+        ledger = Ledger(ledger_file, output_file)
+        ledger.sync_csv()
+    return ledger
 
 
-# Check for config file
-"""
-This is the JSON file containing details of the Microsoft Entra ID app registration
-necessary to connect and provision our user(s). See readme.md for more information!
-"""
-script_dir = os.path.dirname(os.path.abspath(__file__))
-config_file = os.path.join(script_dir, "config.json")
+# Function to connect to Microsoft Graph API
+def connect_to_graph(config):
+    """
+    Sets up the access token for Microsoft Graph API (refreshed automatically before it expires).
 
-if not os.path.exists(config_file):
-    banner()
-    click.pause("🛑 Config file not found (press any key to continue)")
-    click.clear()
-    # Prompt for config file path if not found
-    banner()
-    config_file = click.prompt("Please provide a path to the config file", type=str)
+    The first access token is fetched in the background, while the operator inserts the first
+    YubiKey; requests to Microsoft Graph API wait for it (or fetch it again if it failed).
 
-try:
-    with open(config_file, "r", encoding="utf8") as f:
-        config = json.load(f)
-except FileNotFoundError:
-    banner()
-    click.pause(f"🛑 Config file not found (press any key to exit)")
-    click.clear()
-    # Exit program in 3 seconds
-    for i in range(3, 0, -1):  # Countdown from 3 seconds
-        click.secho(f"Exiting program in {i} seconds...")
-        time.sleep(1)
-        click.clear()
-    click.clear()
-    sys.exit(1)
-except json.JSONDecodeError:
-    banner()
-    click.pause("🛑 Error decoding JSON (press any key to exit)")
-    click.clear()
-    # Exit program in 3 seconds
-    for i in range(3, 0, -1):  # Countdown from 3 seconds
-        click.secho(f"Exiting program in {i} seconds...")
-        time.sleep(1)
-        click.clear()
-    click.clear()
-    sys.exit(1)
-else:
-    pass
+    The optional config attributes 'graph_endpoint' and 'login_endpoint' replace the endpoints of
+    Microsoft Graph API and its token endpoint (e.g., to use a mock of Microsoft Graph API), and
+    'challenge_timeout' the validity of challenges in minutes (see challenge_timeout), and 'directory_cache'
+    whether users are cached (see sync_directory()).
 
+    Args:
+        config (dict): The config as returned by load_config().
 
-# Config attributes we need
-client_id = config["client_id"]
-client_secret = config["client_secret"]
-tenant_id = config["tenant_id"]
+    Returns:
+        concurrent.futures.Future: Completes when the first access token has been fetched.
+    """
+    global graph_endpoint, login_endpoint, challenge_timeout, directory_cache
+    graph_endpoint = config.get("graph_endpoint", graph_endpoint).rstrip("/")
+    login_endpoint = config.get("login_endpoint", login_endpoint).rstrip("/")
+    challenge_timeout = int(config.get("challenge_timeout", challenge_timeout))
+    directory_cache = bool(config.get("directory_cache", directory_cache))
+
+    graph.token_provider = TokenProvider(
+        config["client_id"], config["client_secret"], config["tenant_id"], graph, login_endpoint
+    )
+    return graph_executor.submit(graph.token_provider.get_token)
 
 
-# Check for output file
+# Locks shared by parallel enrollment workers (multi-device mode)
 """
-Programmed YubiKeys will be written to an output file in CSV format.
-If the file exists, new entries will be appended. If not, a new file will be created.
+When several YubiKeys are enrolled at once, console output and enumeration of
+attached YubiKeys are serialised so that workers do not interleave.
 """
-csv_headers = ['Name', 'UPN', 'Model', 'Serial number', 'PIN', 'PIN change required', 'Secure Transport Mode']
+console_lock = threading.Lock()
+device_lock = threading.Lock()
 
-# Check if file exists, if not create it with headers
-if not os.path.exists('output.csv'):
-    with open('output.csv', 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=csv_headers)
-        writer.writeheader()
+# Cache of device info read from attached YubiKeys, keyed by HID device path
+device_info_cache = {}
 
+# Functions called with the progress messages of YubiKeys attached to the station (e.g., by the enrollment service)
+station_listeners = []
 
-# Disable warnings(!)
-# See: https://urllib3.readthedocs.io/en/latest/advanced-usage.html#tls-warnings
-requests.packages.urllib3.disable_warnings()
 
+# Function to print progress of a YubiKey enrolled in multi-device mode
+def station_echo(serial_number, message):
+    """
+    Prints a progress message prefixed with the serial number of the YubiKey it concerns.
 
-# Connect to Microsoft Graph API and get access token
-access_token = get_access_token_for_microsoft_graph(client_id, client_secret, tenant_id)
+    Args:
+        serial_number (int): The serial number of the YubiKey.
+        message (str): The message to print.
+    """
+    with console_lock:
+        click.secho(f"[{serial_number}] {message}")
+    for listener in station_listeners:
+        listener(serial_number, message)
 
 
-# Function that runs the entire YubiKey programming and registration sequence
-def yubikey_eob_registration(config):
+# Function to prompt user for touching the YubiKey
+def prompt_for_touch():
+    """
+    Prompts the user to touch the inserted YubiKey.
 
-    # Function to write configuration of YubiKey to file
-    def write_csv():
-        """
-        Writes programmed YubiKey information to a CSV file.
-        The data is appended to the 'output.csv' file.
-        """
-        with open('output.csv', 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=csv_headers)
-            writer.writerow({
-                'Name': user_display_name,
-                'UPN': user_name,
-                'Model': device.name,
-                'Serial number': serial_number,
-                'PIN': pin,
-                'PIN change required': pin_change,
-                'Secure Transport Mode': nfc_restricted
-            })
+    Clears the screen and displays a message instructing the user to touch the YubiKey.
 
-    
-    # Function to prompt user for touching the YubiKey
-    def prompt_for_touch():
-        """
-        Prompts the user to touch the inserted YubiKey.
+    Raises:
+        OSError: If clearing the screen fails.
 
-        Clears the screen and displays a message instructing the user to touch the YubiKey.
+    Example:
+        prompt_for_touch() OR prompt_timeout()
+    """
+    try:
+        banner()
+        click.echo("Touch YubiKey...", err=True)
+    except Exception:
+        sys.stderr.write("Touch YubiKey...")
 
-        Raises:
-            OSError: If clearing the screen fails.
 
-        Example:
-            prompt_for_touch() OR prompt_timeout()
-        """
-        try:
-            banner()
-            click.echo("Touch YubiKey...", err=True)
-        except Exception:
-            sys.stderr.write("Touch YubiKey...")
+# Function for touch timeout during prompt
+@contextmanager
+def prompt_timeout(timeout=0.5, prompt=prompt_for_touch):
+    """
+    Context manager providing a timeout for a prompt (touch) operation.
 
-    
-    # Function for touch timeout during prompt
-    @contextmanager
-    def prompt_timeout(timeout=0.5):
-        """
-        Context manager providing a timeout for a prompt (touch) operation.
+    Sets a timeout for a prompt operation. If the operation exceeds the specified
+    timeout, it is automatically canceled. Timeout duration is in seconds.
 
-        Sets a timeout for a prompt operation. If the operation exceeds the specified
-        timeout, it is automatically canceled. Timeout duration is in seconds.
+    Args:
+        timeout (float, optional): Duration of the timeout in seconds. Default is 0.5 seconds.
+        prompt (callable, optional): Function displaying the prompt. Default is prompt_for_touch.
 
-        Args:
-            timeout (float, optional): Duration of the timeout in seconds. Default is 0.5 seconds.
+    Example: prompt_timeout()
 
-        Example: prompt_timeout()
+    """
+    timer = Timer(timeout, prompt)
+    try:
+        timer.start()
+        yield None
+    finally:
+        timer.cancel()
 
-        """
-        timer = Timer(timeout, prompt_for_touch)
-        try:
-            timer.start()
-            yield None
-        finally:
-            timer.cancel()
 
-    
-    # Function to handle removal and reinsertion of YubiKey
-    def prompt_re_insert():
-        """
-        Continuously checks for the re-insertion of a YubiKey after it has been removed.
+# Device backend providing the YubiKeys attached to the station over USB
+class YubiKeyBackend:
+    """
+    Provides the YubiKeys attached to the station (see list_yubikeys()).
 
-        This function monitors the connected FIDO devices by calling the list_ctap_devices()
-        function periodically. If a device is removed, it waits for it to be re-inserted.
+    Another backend (e.g., SimulatedStation in simulator.py) can be used instead with use_device_backend().
+    A backend lists the attached YubiKeys, may provide a socket notifying about devices being inserted
+    and removed, and opens management sessions (for Secure Transport Mode). A backend that may fail to
+    read some of the attached devices lists the others and keeps those it skipped in 'skipped'.
+    """
 
-        Returns:
-            Union[FidoConnection, None]: An instance of FidoConnection representing the
-            re-inserted FIDO device if found, or None if no device is re-inserted.
-        """
+    def __init__(self):
+        self.skipped = []
 
-        removed = False
-        while True:
-            sleep(0.5)
-            keys = list_ctap_devices()
-            if not keys:
-                removed = True
-            if removed and len(keys) == 1:
-                return keys[0].open_connection(FidoConnection)
-
-    
-    # Function to reset the FIDO application of a YubiKey
-    def reset_yubikey():
+    def list_yubikeys(self):
         """
-        Resets the FIDO application (U2F and FIDO2) of a YubiKey.
+        Lists the YubiKeys currently attached to the station, keyed by serial number.
 
-        This function guides the user through the process of resetting the FIDO application on a YubiKey.
-        It displays a warning and then performs the reset if the YubiKey matches the expected serial number.
+        Device info is only read from YubiKeys that have not been seen before (by HID device path),
+        so repeated calls do not interrupt YubiKeys that are busy being programmed by another worker.
+        A device whose info cannot be read (e.g., udev has not yet granted access to a new device) is
+        left out and its fingerprint kept in 'skipped', so that it is read again by the next call.
 
-        Args:
-            None
-        Raises:
-            SystemExit: If no YubiKey is re-inserted, the function exits with a status code of 1.
+        Returns:
+            dict: A dictionary mapping serial numbers to YubiKey devices. YubiKeys without a
+            serial number (e.g., Security Key Series Consumer Edition) are keyed by None.
         """
-        banner()
-        # Warn user of FIDO2 application reset
-        if click.confirm(
-            "YubiKey will be reset. Do you want to continue?", default=True
-        ):
-            click.clear()
-        else:
-            # Exit program in 3 seconds
-            for i in range(3, 0, -1):  # Countdown from 3 seconds
-                banner()
-                click.secho(f"Exiting program in {i} seconds...")
-                time.sleep(1)
-                click.clear()
-                click.clear()
-            sys.exit(1)
+        from ykman import scripting as s
+        from ykman.device import list_ctap_devices
+        from yubikit.core.fido import FidoConnection
+        from yubikit.management import ManagementSession
+
+        yubikeys = {}
+        skipped = []
+        with device_lock:
+            devices = list_ctap_devices()
+            # Forget device paths that are no longer attached (they may be reused by another YubiKey)
+            for fingerprint in set(device_info_cache) - {dev.fingerprint for dev in devices}:
+                del device_info_cache[fingerprint]
+            for dev in devices:
+                if dev.fingerprint not in device_info_cache:
+                    try:
+                        with dev.open_connection(FidoConnection) as connection:
+                            device_info_cache[dev.fingerprint] = ManagementSession(
+                                connection
+                            ).read_device_info()
+                    except Exception:
+                        skipped.append(dev.fingerprint)
+                        continue
+                device = s.ScriptingDevice(dev, device_info_cache[dev.fingerprint])
+                yubikeys[device.info.serial] = device
+            self.skipped = skipped
+        return yubikeys
+
+    def open_event_socket(self):
+        return open_uevent_socket()
+
+    def management_session(self, connection):
+        from yubikit.management import ManagementSession
+
+        return ManagementSession(connection)
+
+
+# Backend providing the YubiKeys attached to the station
+device_backend = YubiKeyBackend()
+
+
+# Function to replace the device backend (e.g., with simulated YubiKeys)
+def use_device_backend(backend):
+    """
+    Replaces the backend providing the YubiKeys attached to the station.
 
-        # Now reset the YubiKey FIDO application
-        banner()
-        click.echo("Remove and re-insert YubiKey...")
+    If the backend has an 'on_change' attribute, it is set to re-scan the attached YubiKeys,
+    so that the backend can report YubiKeys being inserted and removed.
 
-        connection = prompt_re_insert()
+    Args:
+        backend: The device backend (see YubiKeyBackend).
+    """
+    global device_backend
+    device_backend = backend
+    device_watcher.backend = backend
+    if hasattr(backend, "on_change"):
+        backend.on_change = device_watcher.rescan
 
-        # Read serial number of (re)inserted YubiKey to perform comparison
-        reinserted_device = ManagementSession(connection).read_device_info().serial
 
-        if reinserted_device:
-            if reinserted_device == serial_number:
-                with prompt_timeout():
-                    Ctap2(connection).reset()
-                banner()
-                click.secho("Reset successful.")
-                time.sleep(1)
-            else:
-                
-                # Check if the (re)inserted YubiKey has a different serial number than expected
-                if reinserted_device != serial_number:
-                    banner()
-                    click.pause(f"🛑 Expected Serial Number '{serial_number}', but found '{reinserted_device}' (press any key to continue...)")
-                    # Call reset_yubikey again to restart the process if the serial number is incorrect
-                    reset_yubikey()
-        else:
-            banner()
-            #click.echo("No YubiKey re-inserted. Exiting...")
-            click.pause(f"🛑 Expected Serial Number '{serial_number}', but no Serial Number was detected (press any key to continue...)")
-            # Call reset_yubikey again to restart the process if the serial number is incorrect
-            reset_yubikey()
+# Function to list the YubiKeys attached to the station
+def list_yubikeys():
+    """
+    Lists the YubiKeys currently attached to the station, keyed by serial number.
 
-        click.clear()
+    Returns:
+        dict: A dictionary mapping serial numbers to YubiKey devices (see YubiKeyBackend.list_yubikeys()).
+    """
+    return device_backend.list_yubikeys()
 
-    
-    # Function to hold dictionary of banned FIDO2 PIN codes
-    """
-    This list contains disallowed PINs as per Yubico's 2024 PIN complexity rules. For more information: 
-    https://docs.yubico.com/hardware/yubikey/yk-tech-manual/5.7-firmware-specifics.html#pin-complexity
-    
-    NOTE: This script currently does not enforce PIN complexity or PIN length. Instead it makes sure the 
-    random PIN generated complies with these settings, if set prior. Note also that if PIN length is '4'
-    then the check against the list of disallowed PINs is "less" relevant. Lastly, since we are generating
-    numerical PINs it is not necessary to disallow alphanumerical PINs.
-    """
-    disallowed_pins = [
-        "123456",
-        "123123",
-        "654321",
-        "123321",
-        "112233",
-        "121212",
-        "520520",
-        "123654",
-        "159753",
-        
-    ] # Add more as you see fit!
-
-    
-    # Function to generate random FIDO2 PIN codes
-    def generate_random_pin():
-        """
-        Generates a random numerical PIN.
 
-        This function utilizes the secrets module to securely generate a random PIN.
-        The PIN consists of numerical digits (0-9) and does not contain any letters or special characters.
-        Trivial PINs (e.g., all digits are the same) and PINs in the banned list are disallowed.
+# Session with one YubiKey, shared by all steps of its enrollment
+class KeySession:
+    """
+    Open FIDO connection to one YubiKey, shared by all steps of its enrollment.
 
-        Returns:
-            str: A string representing the generated PIN.
+    The YubiKey is enumerated and opened once, and its device info (serial number, model, firmware
+    version) and CTAP2 info (options such as 'clientPin' and 'setMinPINLength') are read once,
+    instead of every step enumerating and opening the YubiKey again. After a reset (which requires
+    the YubiKey to be re-inserted), the session is moved to the new connection with reconnect().
+    """
+
+    def __init__(self, device):
         """
-        while True:
-            digits = "".join(
-                secrets.choice(string.digits) for _ in range(pin_length)
-            )  # PIN will be 4 digits (change to 6 if needed)
-            # Check if PIN is not trivial and not in banned list
-            if len(set(digits)) != 1 and digits not in disallowed_pins:
-                return digits
-
-    
-    # Function to set PIN on the YubiKey
-    def set_fido_pin(pin):
+        Args:
+            device (ScriptingDevice): The YubiKey, as returned by list_yubikeys().
         """
-        Set the FIDO2 PIN on the inserted YubiKey.
+        self.device = device
+        self.connection = device.fido()
+        self._ctap = None
 
-        If a PIN is already set, the function will first reset the FIDO2 applet before setting a new PIN.
-        If no PIN is set, it will directly set a new PIN.
+    def __enter__(self):
+        return self
 
-        Args:
-            pin (str): The desired PIN to be set on the YubiKey.
+    def __exit__(self, typ, value, traceback):
+        self.close()
 
-        Raises:
-            Exception: If there is an error while setting the PIN or resetting the FIDO2 applet.
-        """
+    @property
+    def serial_number(self):
+        return self.device.info.serial
 
-        devices = list(CtapHidDevice.list_devices())
-        ctap = Ctap2(devices[0])
+    @property
+    def info(self):
+        """DeviceInfo of the YubiKey (read when it was inserted)."""
+        return self.device.info
 
-        # Determine PIN status of inserted YubiKey
-        if ctap.info.options.get("clientPin"):
+    @property
+    def name(self):
+        return self.device.name
 
-            # Call reset of the FIDO2 applet if PIN is already set
-            reset_yubikey()
-            # Reconnect to YubiKey
-            devices = list(CtapHidDevice.list_devices())
-            ctap = Ctap2(devices[0])
-            # Set a random PIN
-            client_pin = ClientPin(ctap)
-            client_pin.set_pin(pin)
+    @property
+    def ctap(self):
+        """CTAP2 session with the YubiKey (its info is read once, when first used)."""
+        if self._ctap is None:
+            from fido2.ctap2 import Ctap2
 
-        else:
-            # Reconnect to YubiKey
-            devices = list(CtapHidDevice.list_devices())
-            ctap = Ctap2(devices[0])
-            # Set a random PIN
-            client_pin = ClientPin(ctap)
-            client_pin.set_pin(pin)
-
-    
-    # Function to get FIDO credentials authentication options
-    def get_fido2_creation_options(userID, access_token):
+            self._ctap = Ctap2(self.connection)
+        return self._ctap
+
+    def reset(self):
         """
-        Retrieve FIDO2 credential creation options for a user from the Microsoft Graph API.
+        Resets the FIDO application of the YubiKey (its CTAP2 info is read again when next used).
+        """
+        self.ctap.reset()
+        self._ctap = None
 
-        Sends a GET request to the FIDO2 credential creation options endpoint, passing the user ID and an access token for authentication.
-        The challenge timeout value is retrieved from a configuration file and included as a query parameter.
+    def reconnect(self, device):
+        """
+        Moves the session to a new connection, e.g. after the YubiKey has been re-inserted.
 
         Args:
-            userID (str): The ID of the user for whom to retrieve the FIDO2 credential creation options.
-            access_token (str): A valid access token for authentication with the Microsoft Graph API.
-
-        Returns:
-            tuple: A tuple containing a boolean indicating success or failure and either the FIDO2 credential creation options or None.
+            device (ScriptingDevice): The re-inserted YubiKey.
         """
-        headers = set_http_headers(access_token)
-        params = {"challenge_timeout": 5}  # Five minute timeout
+        self.close()
+        self.device = device
+        self.connection = device.fido()
+        self._ctap = None
 
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
-        fido_credentials_endpoint = (
-            "https://graph.microsoft.com/beta/users/"
-            + userID
-            + "/authentication/fido2Methods/creationOptions"
-        )
 
-        response = requests.get(
-            fido_credentials_endpoint, headers=headers, params=params, verify=False
-        )
-        if response.status_code == 200:
-            creation_options = response.json()
+# Watcher shared by all functions waiting for YubiKeys to be inserted or removed
+device_watcher = DeviceWatcher(device_backend)
 
-            return True, creation_options
-        else:
-            return False, None
 
-    
-    # Function to convert from Base64
-    def base64url_to_bytearray(b64url_string):
-        """
-        Convert a Base64 URL-safe string to a bytearray.
+# Function to handle removal and reinsertion of YubiKey
+def prompt_re_insert(removals):
+    """
+    Waits for the re-insertion of a YubiKey after it has been removed.
 
-        Args:
-            b64url_string (str): The Base64 URL-safe string to be converted.
+    This function uses the device watcher to wait until a YubiKey has been removed
+    and then for a single YubiKey to be inserted.
 
-        Returns:
-            bytearray: The decoded bytes from the input string.
-        """
-        temp = b64url_string.replace("_", "/").replace("-", "+")
-        return bytearray(base64.urlsafe_b64decode(temp + "=" * (4 - len(temp) % 4)))
+    Args:
+        removals (int): The removal count (device_watcher.removal_count()) before asking for the re-insert.
 
-    
-    # Define function
-    def build_creation_options(challenge, userId, displayName, name):
-        """
-        Build the PublicKeyCredentialCreationOptions object for WebAuthn registration.
+    Returns:
+        ScriptingDevice: The re-inserted YubiKey.
+    """
+    return device_watcher.wait_for_re_insert(removals)
 
-        Args:
-            challenge (str): A base64url-encoded challenge string.
-            userId (str): A base64url-encoded user ID string.
-            displayName (str): The user's display name.
-            name (str): The user's name.
 
-        Returns:
-            dict: The PublicKeyCredentialCreationOptions object for WebAuthn registration.
-        """
-        public_key_credential_creation_options = {
-            "publicKey": {
-                "challenge": base64url_to_bytearray(challenge),
-                "timeout": 0,
-                "attestation": "direct",
-                "rp": {"id": "login.microsoft.com", "name": "Microsoft"},
-                "user": {
-                    "id": base64url_to_bytearray(userId),
-                    "displayName": displayName,
-                    "name": name,
-                },
-                "pubKeyCredParams": [
-                    {"type": "public-key", "alg": -7},
-                    {"type": "public-key", "alg": -257},
-                ],
-                "excludeCredentials": [],
-                "authenticatorSelection": {
-                    "authenticatorAttachment": "cross-platform",
-                    "requireResidentKey": True,
-                    "userVerification": "required",
-                },
-                "extensions": {
-                    "hmacCreateSecret": True,
-                    "enforceCredentialProtectionPolicy": True,
-                    "credentialProtectionPolicy": CredProtectExtension.POLICY.OPTIONAL,
-                },
-            }
-        }
+# Function to handle removal and reinsertion of a specific YubiKey on a multi-device station
+def wait_for_re_insert(serial_number, removals):
+    """
+    Waits for the YubiKey with the given serial number to be removed and re-inserted.
 
-        return public_key_credential_creation_options
+    Unlike prompt_re_insert(), other YubiKeys may remain attached to the station.
 
-    # Handle user interaction during credential creation
-    class CliInteraction(UserInteraction):
-        """
-        Handle user interaction during WebAuthn credential creation.
+    Args:
+        serial_number (int): The serial number of the YubiKey.
+        removals (int): The removal count (device_watcher.removal_count(serial_number)) before asking for the re-insert.
 
-        Implements the `UserInteraction` interface and provides methods for:
-        - Prompting the user to touch their authenticator (e.g., YubiKey)
-        - Requesting a PIN
-        - Requesting user verification (UV) when necessary during the WebAuthn registration process
-        """
+    Returns:
+        ScriptingDevice: The re-inserted YubiKey.
+    """
+    return device_watcher.wait_for_re_insert(removals, serial_number)
 
-        def prompt_up(self):
-            banner()
-            click.secho("Touch YubiKey...")
 
-        def request_pin(self, permissions, rp_id):
-            return pin
+# Function to reset the FIDO application of a YubiKey
+def reset_yubikey(key):
+    """
+    Resets the FIDO application (U2F and FIDO2) of a YubiKey.
 
-        def request_uv(self, permissions, rp_id):
-            banner()
-            print("User Verification required.")
-            return True
+    This function guides the user through the process of resetting the FIDO application on a YubiKey.
+    It displays a warning and then performs the reset if the YubiKey matches the expected serial number.
 
-    
-    # Function to create and activate YubiKey in Microsoft Entra ID
-    def create_and_activate_fido_method(
-        credential_id,
-        client_extensions,
-        user_name,
-        attestation,
-        client_data,
-        serial_number,
-        access_token,
+    Args:
+        key (KeySession): The session with the YubiKey to reset (reconnected to the re-inserted YubiKey).
+    Raises:
+        SystemExit: If no YubiKey is re-inserted, the function exits with a status code of 1.
+    """
+    banner()
+    # Warn user of FIDO2 application reset
+    if click.confirm(
+        "YubiKey will be reset. Do you want to continue?", default=True
     ):
-        """
-        Create and activate a FIDO2 authentication method for a user in Microsoft Entra ID.
-
-        Sends a POST request to the FIDO2 authentication method creation endpoint with the provided parameters,
-        including the credential ID, attestation object, client data, and client extension results.
-
-        Args:
-            credential_id (str): The credential ID of the FIDO2 authentication method.
-            client_extensions (str): The client extension results encoded as a base64 string.
-            user_name (str): The user's name.
-            attestation (str): The attestation object.
-            client_data (str): The client data.
-            serial_number (str): The serial number of the security key.
-            access_token (str): The access token for authentication.
-
-        Returns:
-            tuple: A tuple containing a boolean indicating success or failure and either the created method ID or an empty list.
-        """
-        headers = set_http_headers(access_token)
+        click.clear()
+    else:
+        # Exit program in 3 seconds
+        for i in range(3, 0, -1):  # Countdown from 3 seconds
+            banner()
+            click.secho(f"Exiting program in {i} seconds...")
+            time.sleep(1)
+            click.clear()
+            click.clear()
+        sys.exit(1)
 
-        fido_credentials_endpoint = (
-            "https://graph.microsoft.com/beta/users/"
-            + user_name
-            + "/authentication/fido2Methods"
-        )
+    # Now reset the YubiKey FIDO application
+    serial_number = key.serial_number
+    removals = device_watcher.removal_count()
+    key.close()
+    banner()
+    click.echo("Remove and re-insert YubiKey...")
 
-        body = {
-            "publicKeyCredential": {
-                "id": credential_id,
-                "response": {
-                    "attestationObject": attestation,
-                    "clientDataJSON": client_data,
-                },
-                "clientExtensionResults": json.loads(
-                    base64.b64decode(str(client_extensions)).decode("utf-8")
-                ),
-            },
-            "displayName": "YubiKey with S/N: "
-            + str(serial_number),
-        }
+    device = prompt_re_insert(removals)
 
-        response = requests.post(
-            fido_credentials_endpoint, json=body, headers=headers, verify=False
-        )
+    # Read serial number of (re)inserted YubiKey to perform comparison
+    reinserted_device = device.info.serial
 
-        if response.status_code == 201:
-            create_response = response.json()
-            return True, create_response["id"]
+    if reinserted_device:
+        if reinserted_device == serial_number:
+            key.reconnect(device)
+            with prompt_timeout(), telemetry.span("reset"):
+                key.reset()
+            banner()
+            click.secho("Reset successful.")
+            time.sleep(1)
         else:
-            return False, []
 
-    
-    # Function to handle credential creation on YubiKey
-    def create_credentials_on_security_key(
-        user_id, challenge, user_display_name, user_name
-    ):
-        """
-        Create WebAuthn credentials on a security key (e.g., YubiKey) during the registration process.
+            # Check if the (re)inserted YubiKey has a different serial number than expected
+            if reinserted_device != serial_number:
+                banner()
+                click.pause(f"🛑 Expected Serial Number '{serial_number}', but found '{reinserted_device}' (press any key to continue...)")
+                # Call reset_yubikey again to restart the process if the serial number is incorrect
+                reset_yubikey(key)
+    else:
+        banner()
+        #click.echo("No YubiKey re-inserted. Exiting...")
+        click.pause(f"🛑 Expected Serial Number '{serial_number}', but no Serial Number was detected (press any key to continue...)")
+        # Call reset_yubikey again to restart the process if the serial number is incorrect
+        reset_yubikey(key)
 
-        Retrieves the first available CTAP HID device, creates a Fido2Client instance, builds the PublicKeyCredentialCreationOptions
-        object, and calls the `make_credential` method to create the credentials on the security key.
+    click.clear()
 
-        Args:
-            user_id (str): The user's ID.
-            challenge (str): The challenge string.
-            user_display_name (str): The user's display name.
-            user_name (str): The user's name.
 
-        Returns:
-            tuple: The encoded attestation object, client data, credential ID, and client extension results.
-        """
-        dev = list(CtapHidDevice.list_devices())[0]
+# Function to reset the FIDO application of a YubiKey on a multi-device station
+def reset_yubikey_on_station(key):
+    """
+    Resets the FIDO application (U2F and FIDO2) of one of several attached YubiKeys.
 
-        client = Fido2Client(
-            dev,
-            "https://login.microsoft.com",
-            user_interaction=CliInteraction(),
-        )
+    The operator is asked to remove and re-insert the YubiKey, which is then reset while
+    the remaining YubiKeys on the station keep being programmed.
 
-        pkcco = build_creation_options(challenge, user_id, user_display_name, user_name)
+    Args:
+        key (KeySession): The session with the YubiKey to reset (reconnected to the re-inserted YubiKey).
+    """
+    serial_number = key.serial_number
+    removals = device_watcher.removal_count(serial_number)
+    key.close()
+    station_echo(serial_number, "YubiKey will be reset. Remove and re-insert YubiKey...")
+    key.reconnect(wait_for_re_insert(serial_number, removals))
+    with prompt_timeout(
+        prompt=lambda: station_echo(serial_number, "Touch YubiKey...")
+    ), telemetry.span("reset"):
+        key.reset()
+    station_echo(serial_number, "Reset successful.")
+
+
+# Function to hold dictionary of banned FIDO2 PIN codes
+"""
+This list contains disallowed PINs as per Yubico's 2024 PIN complexity rules. For more information:
+https://docs.yubico.com/hardware/yubikey/yk-tech-manual/5.7-firmware-specifics.html#pin-complexity
 
-        result = client.make_credential(pkcco["publicKey"])
+NOTE: This script currently does not enforce PIN complexity or PIN length. Instead it makes sure the
+random PIN generated complies with these settings, if set prior. Note also that if PIN length is '4'
+then the check against the list of disallowed PINs is "less" relevant. Lastly, since we are generating
+numerical PINs it is not necessary to disallow alphanumerical PINs.
+"""
+disallowed_pins = [
+    "123456",
+    "123123",
+    "654321",
+    "123321",
+    "112233",
+    "121212",
+    "520520",
+    "123654",
+    "159753",
+
+] # Add more as you see fit!
+
+
+# Function to generate random FIDO2 PIN codes
+def generate_random_pin():
+    """
+    Generates a random numerical PIN.
 
-        attestation_obj = result["attestationObject"]
-        attestation = websafe_encode(attestation_obj)
+    This function utilizes the secrets module to securely generate a random PIN.
+    The PIN consists of numerical digits (0-9) and does not contain any letters or special characters.
+    Trivial PINs (e.g., all digits are the same) and PINs in the banned list are disallowed.
 
-        client_data = result["clientData"].b64
+    Returns:
+        str: A string representing the generated PIN.
+    """
+    while True:
+        digits = "".join(
+            secrets.choice(string.digits) for _ in range(pin_length)
+        )  # PIN will be 4 digits (change to 6 if needed)
+        # Check if PIN is not trivial and not in banned list
+        if len(set(digits)) != 1 and digits not in disallowed_pins:
+            return digits
 
-        credential_id = websafe_encode(
-            result.attestation_object.auth_data.credential_data.credential_id
-        )
 
-        client_extenstion_results = websafe_encode(
-            json.dumps(result.attestation_object.auth_data.extensions).encode("utf-8")
-        )
+# Function to clean up a YubiKey with a known PIN instead of resetting it
+def clean_fido_credentials(key, pin, known_pins):
+    """
+    Deletes the login.microsoft.com credentials of an earlier enrollment from a YubiKey whose PIN is known,
+    and changes its PIN.
+
+    This replaces the reset of a re-issued YubiKey, for which the operator has to remove, re-insert and touch it.
+    The YubiKey is only cleaned if its authenticator config is still what an enrollment sets up (no minimum PIN
+    length above pin_length, no 'alwaysUv' and no enterprise attestation) and it holds no credentials of other
+    relying parties, which a reset would delete but this function does not. A PIN/UV auth token with the
+    CREDENTIAL_MGMT permission is obtained with one of the known PINs before anything is changed, the stale
+    credentials are deleted with CTAP2 credential management, and only then is the PIN changed to the new PIN.
+    (A YubiKey whose PIN must be changed before any token is issued has its PIN changed first.) At most two known
+    PINs are tried, and none if three or fewer PIN retries are left, so that the YubiKey is never blocked.
 
-        return (
-            attestation,
-            client_data,
-            credential_id,
-            client_extenstion_results,
-        )
+    Args:
+        key (KeySession): The session with the YubiKey.
+        pin (str): The new PIN.
+        known_pins (list): The PINs possibly set on the YubiKey, most recent first (see Ledger.known_pins()).
 
-    
-    # Function to fetch a Microsoft Entra ID user to be enrolled with a YubiKey
-    def get_user_id(user_principal_name, access_token):
-        """
-        Fetches a Microsoft Entra ID user to be enrolled with a YubiKey.
+    Returns:
+        bool: True if the new PIN is set and the credentials are deleted, False if the YubiKey must be reset
+            instead (e.g., none of the known PINs is set, its config differs, or it holds other credentials).
+    """
+    from fido2.ctap import CtapError
+    from fido2.ctap2 import ClientPin, CredentialManagement
 
-        This function retrieves a user's profile from the Microsoft Graph API based on the provided User Principal Name (UPN).
-        If the UPN is non-existent, it prompts the user to provide a valid UPN until a successful response is received or the
-        user cancels the operation.
+    info = key.ctap.info
+    if not known_pins or not CredentialManagement.is_supported(info):
+        return False
+    if info.min_pin_length > pin_length or info.options.get("alwaysUv") or info.options.get("ep"):
+        return False
+
+    client_pin = ClientPin(key.ctap)
+    permission = ClientPin.PERMISSION.CREDENTIAL_MGMT
+    rp_id_hash = hashlib.sha256(b"login.microsoft.com").digest()
+    try:
+        for current_pin in known_pins[:2]:
+            if client_pin.get_pin_retries()[0] <= 3:
+                return False
+            try:
+                if info.force_pin_change:
+                    # No token is issued before the PIN is changed
+                    client_pin.change_pin(current_pin, pin)
+                    current_pin = pin
+                token = client_pin.get_pin_token(current_pin, permission)
+                break
+            except CtapError as e:
+                if e.code != CtapError.ERR.PIN_INVALID:
+                    raise
+        else:
+            return False
+
+        credential_management = CredentialManagement(key.ctap, client_pin.protocol, token)
+        rps = credential_management.enumerate_rps()
+        if any(rp[CredentialManagement.RESULT.RP_ID_HASH] != rp_id_hash for rp in rps):
+            return False
+        if rps:
+            for credential in credential_management.enumerate_creds(rp_id_hash):
+                credential_management.delete_cred(credential[CredentialManagement.RESULT.CREDENTIAL_ID])
+
+        if current_pin != pin:
+            client_pin.change_pin(current_pin, pin)
+    except CtapError:
+        # E.g., the new PIN is shorter than the minimum PIN length set on the YubiKey
+        return False
+    return True
+
+
+# Function to set PIN on the YubiKey
+def set_fido_pin(pin, key, reset=reset_yubikey):
+    """
+    Set the FIDO2 PIN on the inserted YubiKey.
+
+    If a PIN is already set and known from the ledger (see Ledger.known_pins()), the PIN is changed and the
+    stale credentials are deleted (see clean_fido_credentials()). Otherwise, if a PIN is already set, the function
+    will first reset the FIDO2 applet before setting a new PIN. If no PIN is set, it will directly set a new PIN.
+
+    Args:
+        pin (str): The desired PIN to be set on the YubiKey.
+        key (KeySession): The session with the YubiKey.
+        reset (callable, optional): Function resetting the YubiKey. Default is reset_yubikey.
+
+    Raises:
+        Exception: If there is an error while setting the PIN or resetting the FIDO2 applet.
+    """
+
+    from fido2.ctap2 import ClientPin
+
+    # Determine PIN status of inserted YubiKey
+    if key.ctap.info.options.get("clientPin"):
+
+        # Change the PIN instead if the current PIN is known (the PIN of this enrollment is not set yet)
+        known_pins = [known_pin for known_pin in ledger.known_pins(key.serial_number) if known_pin != pin] if ledger else []
+        if known_pins:
+            with telemetry.span("cleanup") as span:
+                cleaned = clean_fido_credentials(key, pin, known_pins)
+                if not cleaned:
+                    span["outcome"] = "failed"
+            if cleaned:
+                return
+
+        # Call reset of the FIDO2 applet if PIN is already set
+        reset(key)
+
+    # Set a random PIN
+    client_pin = ClientPin(key.ctap)
+    client_pin.set_pin(pin)
+
+
+# Function to check whether a PIN is set on a YubiKey
+def verify_fido_pin(pin, key):
+    """
+    Checks whether the given PIN is the FIDO2 PIN of the YubiKey.
+
+    Used when resuming an enrollment that was interrupted around setting the PIN. A wrong PIN
+    uses up one of the YubiKey's PIN retries.
+
+    Args:
+        pin (str): The PIN to check.
+        key (KeySession): The session with the YubiKey.
+
+    Returns:
+        bool: True if the PIN is set on the YubiKey, False otherwise.
+    """
+    from fido2.ctap import CtapError
+    from fido2.ctap2 import ClientPin
+
+    if not key.ctap.info.options.get("clientPin"):
+        return False
+    try:
+        ClientPin(key.ctap).get_pin_token(pin)
+    except CtapError as e:
+        if e.code in (CtapError.ERR.PIN_INVALID, CtapError.ERR.PIN_BLOCKED, CtapError.ERR.PIN_AUTH_BLOCKED):
+            return False
+        raise
+    return True
+
+
+# Function to get FIDO credentials authentication options
+def get_fido2_creation_options(userID, timeout=None):
+    """
+    Retrieve FIDO2 credential creation options for a user from the Microsoft Graph API.
+
+    Sends a GET request to the FIDO2 credential creation options endpoint, passing the user ID.
+    The challenge timeout value is retrieved from a configuration file and included as a query parameter.
+
+    Args:
+        userID (str): The ID of the user for whom to retrieve the FIDO2 credential creation options.
+        timeout (int, optional): Minutes the challenge is valid. Default is challenge_timeout.
+
+    Returns:
+        tuple: A tuple containing a boolean indicating success or failure and either the FIDO2 credential creation options or None.
+    """
+    params = {"challenge_timeout": timeout or challenge_timeout}
+
+
+    fido_credentials_endpoint = (
+        graph_endpoint + "/users/"
+        + userID
+        + "/authentication/fido2Methods/creationOptions"
+    )
+
+    response = graph.get(
+        fido_credentials_endpoint, params=params
+    )
+    if response.status_code == 200:
+        creation_options = response.json()
+
+        return True, creation_options
+    else:
+        return False, None
+
+
+# Function to parse a date and time returned by Microsoft Graph API
+def parse_graph_datetime(value):
+    """
+    Parses a date and time in the ISO 8601 format used by Microsoft Graph API (e.g., '2024-08-17T12:00:00.1234567Z').
+
+    Args:
+        value (str): The date and time as returned by Microsoft Graph API.
+
+    Returns:
+        datetime.datetime: The date and time (UTC).
+    """
+    # Fractional seconds are dropped, as Graph may return more digits than Python can parse
+    value = value.rstrip("Z").split(".")[0]
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc)
+
+
+# Cache of FIDO2 credential creation options fetched ahead of time
+class CreationOptionsCache:
+    """
+    Fetches FIDO2 credential creation options in the background and keeps them until their challenge times out.
+
+    Options are fetched with prefetch() as soon as a user is known, so the request to Microsoft Graph API
+    overlaps with resetting the YubiKey and setting its PIN. take() then hands them out without waiting.
+    Each challenge can only be used for one credential, so taken options are removed from the cache.
+
+    In offline mode, options are not fetched but taken from those stored in the ledger by the 'prefetch' command.
+    """
+
+    def __init__(self, margin=30):
+        """
+        Args:
+            margin (int, optional): Seconds of validity options must have left to be handed out. Default is 30 seconds.
+        """
+        self.margin = margin
+        self.offline = False
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def prefetch(self, user_id):
+        """
+        Starts fetching the FIDO2 credential creation options for a user, unless already fetched.
+
+        Args:
+            user_id (str): The ID of the user.
+        """
+        if self.offline:
+            return
+        with self._lock:
+            if user_id not in self._futures:
+                self._futures[user_id] = graph_executor.submit(
+                    telemetry.propagate(get_fido2_creation_options), user_id
+                )
+
+    def take(self, user_id):
+        """
+        Returns the FIDO2 credential creation options for a user, fetching new ones if none
+        were prefetched or the prefetched challenge is about to time out.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Returns:
+            tuple: A tuple containing a boolean indicating success or failure and either the FIDO2 credential creation options or None.
+        """
+        if self.offline:
+            user_profile, options = ledger.creation_options.stored(user_id)
+            if options is None or not self.is_valid(options):
+                return False, None
+            return True, options
+
+        with self._lock:
+            future = self._futures.pop(user_id, None)
+        if future is not None:
+            try:
+                status, options = future.result()
+            except requests.RequestException:
+                status, options = False, None
+            if status and self.is_valid(options):
+                return status, options
+        return get_fido2_creation_options(user_id)
+
+    def is_valid(self, options):
+        """
+        Checks whether the challenge of FIDO2 credential creation options is valid for at least the margin.
+
+        Args:
+            options (dict): The FIDO2 credential creation options.
+
+        Returns:
+            bool: True if the challenge can still be used, False otherwise.
+        """
+        expiry = parse_graph_datetime(options["challengeTimeoutDateTime"])
+        remaining = expiry - datetime.datetime.now(datetime.timezone.utc)
+        return remaining.total_seconds() > self.margin
+
+
+# Shared cache of FIDO2 credential creation options
+creation_options_cache = CreationOptionsCache()
+
+
+# Function to prefetch a user and the FIDO2 credential creation options for the user
+def prefetch_user(user_principal_name):
+    """
+    Looks up a user and starts fetching the FIDO2 credential creation options for the user.
+
+    Meant to be submitted to graph_executor as soon as the User Principal Name is known.
+
+    Args:
+        user_principal_name (str): The User Principal Name of the target user.
+
+    Returns:
+        dict: The user's profile, or None if the user could not be found.
+    """
+    user_profile, status_code = fetch_user(user_principal_name)
+    if user_profile:
+        creation_options_cache.prefetch(user_profile["id"])
+    return user_profile
+
+
+# Function to convert from Base64
+def base64url_to_bytearray(b64url_string):
+    """
+    Convert a Base64 URL-safe string to a bytearray.
+
+    Args:
+        b64url_string (str): The Base64 URL-safe string to be converted.
+
+    Returns:
+        bytearray: The decoded bytes from the input string.
+    """
+    temp = b64url_string.replace("_", "/").replace("-", "+")
+    return bytearray(base64.urlsafe_b64decode(temp + "=" * (4 - len(temp) % 4)))
+
+
+# Define function
+def build_creation_options(challenge, userId, displayName, name):
+    """
+    Build the PublicKeyCredentialCreationOptions object for WebAuthn registration.
+
+    Args:
+        challenge (str): A base64url-encoded challenge string.
+        userId (str): A base64url-encoded user ID string.
+        displayName (str): The user's display name.
+        name (str): The user's name.
+
+    Returns:
+        dict: The PublicKeyCredentialCreationOptions object for WebAuthn registration.
+    """
+    from fido2.ctap2.extensions import CredProtectExtension
+
+    public_key_credential_creation_options = {
+        "publicKey": {
+            "challenge": base64url_to_bytearray(challenge),
+            "timeout": 0,
+            "attestation": "direct",
+            "rp": {"id": "login.microsoft.com", "name": "Microsoft"},
+            "user": {
+                "id": base64url_to_bytearray(userId),
+                "displayName": displayName,
+                "name": name,
+            },
+            "pubKeyCredParams": [
+                {"type": "public-key", "alg": -7},
+                {"type": "public-key", "alg": -257},
+            ],
+            "excludeCredentials": [],
+            "authenticatorSelection": {
+                "authenticatorAttachment": "cross-platform",
+                "requireResidentKey": True,
+                "userVerification": "required",
+            },
+            "extensions": {
+                "hmacCreateSecret": True,
+                "enforceCredentialProtectionPolicy": True,
+                "credentialProtectionPolicy": CredProtectExtension.POLICY.OPTIONAL,
+            },
+        }
+    }
+
+    return public_key_credential_creation_options
+
+# Handle user interaction during credential creation
+class CliInteraction:
+    """
+    Handle user interaction during WebAuthn credential creation.
+
+    Implements the `UserInteraction` interface of fido2 (without importing it) and provides methods for:
+    - Prompting the user to touch their authenticator (e.g., YubiKey)
+    - Requesting a PIN
+    - Requesting user verification (UV) when necessary during the WebAuthn registration process
+
+    When a serial number is given (multi-device mode), prompts are printed with station_echo()
+    instead of redrawing the banner.
+    """
+
+    def __init__(self, pin, serial_number=None):
+        self.pin = pin
+        self.serial_number = serial_number
+
+    def prompt_up(self):
+        if self.serial_number:
+            station_echo(self.serial_number, "Touch YubiKey...")
+        else:
+            banner()
+            click.secho("Touch YubiKey...")
+
+    def request_pin(self, permissions, rp_id):
+        return self.pin
+
+    def request_uv(self, permissions, rp_id):
+        if self.serial_number:
+            station_echo(self.serial_number, "User Verification required.")
+        else:
+            banner()
+            print("User Verification required.")
+        return True
+
+
+# Function to create and activate YubiKey in Microsoft Entra ID
+def create_and_activate_fido_method(
+    credential_id,
+    client_extensions,
+    user_name,
+    attestation,
+    client_data,
+    serial_number,
+):
+    """
+    Create and activate a FIDO2 authentication method for a user in Microsoft Entra ID.
+
+    Sends a POST request to the FIDO2 authentication method creation endpoint with the provided parameters,
+    including the credential ID, attestation object, client data, and client extension results.
+
+    Args:
+        credential_id (str): The credential ID of the FIDO2 authentication method.
+        client_extensions (str): The client extension results encoded as a base64 string.
+        user_name (str): The user's name.
+        attestation (str): The attestation object.
+        client_data (str): The client data.
+        serial_number (str): The serial number of the security key.
+
+    Returns:
+        tuple: A tuple containing a boolean indicating success or failure and either the created method ID or the HTTP status code.
+    """
+    fido_credentials_endpoint = (
+        graph_endpoint + "/users/"
+        + user_name
+        + "/authentication/fido2Methods"
+    )
+
+    body = {
+        "publicKeyCredential": {
+            "id": credential_id,
+            "response": {
+                "attestationObject": attestation,
+                "clientDataJSON": client_data,
+            },
+            "clientExtensionResults": json.loads(
+                base64.b64decode(str(client_extensions)).decode("utf-8")
+            ),
+        },
+        "displayName": "YubiKey with S/N: "
+        + str(serial_number),
+    }
+
+    response = graph.post(
+        fido_credentials_endpoint, json=body
+    )
+
+    if response.status_code == 201:
+        create_response = response.json()
+        return True, create_response["id"]
+    else:
+        return False, response.status_code
+
+
+# Background worker retrying registrations in Microsoft Entra ID that failed
+class RegistrationQueue:
+    """
+    Retries queued registrations of FIDO2 methods (see RegistrationStore.queue()) in the background.
+
+    When Microsoft Graph API fails to register a credential, the enrollment of the YubiKey is completed
+    anyway and the attestation is queued in the ledger database, so a transient outage neither stops the
+    station nor leaves an unregistered YubiKey unnoticed. The worker posts each queued attestation again with
+    exponential backoff until it is registered, rejected (HTTP 4xx, status 'failed') or its challenge has
+    timed out (status 'expired'). YubiKeys whose registration failed or expired stay in the ledger with that
+    registration status, but are no longer considered enrolled, so that they (and their users) are enrolled again.
+    Queued registrations survive restarts and can be inspected and drained with the 'queue' command.
+
+    Credentials created in offline mode are queued with status 'offline'; they are not retried in the
+    background but uploaded on request (see upload()).
+    """
+
+    def __init__(self, base=30, cap=900):
+        """
+        Args:
+            base (float, optional): Backoff after the first failed retry in seconds. Default is 30 seconds.
+            cap (float, optional): Maximum backoff in seconds. Default is 15 minutes.
+        """
+        self.base = base
+        self.cap = cap
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts retrying queued registrations in a background thread (once).
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="registration-queue", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """
+        Wakes the background thread up after a registration has been queued.
+        """
+        self._wake.set()
+
+    def drain(self, force=False):
+        """
+        Attempts the pending registrations that are due.
+
+        Args:
+            force (bool, optional): Whether to attempt all pending registrations, ignoring their backoff. Default is False.
+
+        Returns:
+            list: The attempted registrations (see RegistrationStore.queued()) with their new 'status'.
+        """
+        now = time.time()
+        attempted = []
+        for registration in ledger.registrations.queued("pending"):
+            if force or registration["next_attempt"] <= now:
+                attempted.append(self.attempt(registration))
+        return attempted
+
+    def upload(self):
+        """
+        Attempts all pending registrations and the credentials created offline at once, ignoring their backoff.
+
+        The registrations are posted concurrently on graph_executor (within the rate limit of Microsoft Graph API).
+
+        Returns:
+            list: The attempted registrations (see RegistrationStore.queued()) with their new 'status'.
+        """
+        registrations = ledger.registrations.queued("pending") + ledger.registrations.queued("offline")
+        return list(graph_executor.map(self.attempt, registrations))
+
+    def attempt(self, registration):
+        """
+        Posts a queued attestation to Microsoft Graph API once and records the outcome.
+
+        Args:
+            registration (dict): The queued registration (see RegistrationStore.queued()).
+
+        Returns:
+            dict: The registration with its new 'status', 'attempts' and 'last_error'.
+        """
+        serial_number = registration["serial_number"]
+        attempts = registration["attempts"] + 1
+        next_attempt = 0
+        auth_method = None
+
+        with telemetry.span("queued_registration", serial=serial_number, upn=registration["upn"]) as span:
+            expiry = parse_graph_datetime(registration["challenge_timeout"])
+            if expiry <= datetime.datetime.now(datetime.timezone.utc):
+                status, error = "expired", "Challenge timed out, enroll the YubiKey again"
+            else:
+                try:
+                    activated, result = create_and_activate_fido_method(
+                        registration["credential_id"],
+                        registration["extensions"],
+                        registration["upn"],
+                        registration["attestation"],
+                        registration["client_data"],
+                        serial_number,
+                    )
+                except requests.RequestException as e:
+                    activated, result = False, None
+                    error = str(e)
+                if activated:
+                    status, error, auth_method = "registered", None, result
+                elif result is not None and 400 <= result < 500 and result not in (408, 429):
+                    status, error = "failed", f"HTTP {result}"
+                else:
+                    status = "pending"
+                    error = f"HTTP {result}" if result is not None else error
+                    next_attempt = time.time() + get_retry_delay(None, attempts - 1, self.base, self.cap)
+            span["outcome"] = "ok" if status == "registered" else status
+
+        ledger.registrations.update(serial_number, status, attempts, next_attempt, error, auth_method)
+        if status != "pending":
+            station_echo(serial_number, f"Queued registration for '{registration['upn']}': {error or status}.")
+        return {**registration, "status": status, "attempts": attempts, "last_error": error}
+
+    def _run(self):
+        while True:
+            try:
+                self.drain()
+                pending = ledger.registrations.queued("pending")
+            except Exception:
+                pending = []
+            timeout = min((registration["next_attempt"] for registration in pending), default=None)
+            if timeout is not None:
+                timeout = max(timeout - time.time(), 1)
+            else:
+                timeout = self.cap
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+
+# Shared queue of registrations to retry (started by main())
+registration_queue = RegistrationQueue()
+
+
+# Function to queue a registration in Microsoft Entra ID that failed
+def queue_failed_registration(serial_number, user_name, credential, result):
+    """
+    Queues a credential whose registration failed, to be retried in the background (see RegistrationQueue).
+
+    Args:
+        serial_number (int): The serial number of the YubiKey.
+        user_name (str): The User Principal Name of the user.
+        credential (dict): The credential as recorded in the journal (see RegistrationStore.queue()).
+        result (int or Exception): The HTTP status code of the failed request, or the exception it raised.
+
+    Returns:
+        str: Why the registration failed.
+    """
+    error = f"HTTP {result}" if isinstance(result, int) else str(result)
+    ledger.registrations.queue(serial_number, user_name, credential, error)
+    registration_queue.notify()
+    return error
+
+
+# Function to handle credential creation on YubiKey
+def create_credentials_on_security_key(
+    key, user_id, challenge, user_display_name, user_name, user_interaction
+):
+    """
+    Create WebAuthn credentials on a security key (e.g., YubiKey) during the registration process.
+
+    Creates a Fido2Client instance on the session's connection, builds the PublicKeyCredentialCreationOptions
+    object, and calls the `make_credential` method to create the credentials on the security key.
+
+    Args:
+        key (KeySession): The session with the YubiKey.
+        user_id (str): The user's ID.
+        challenge (str): The challenge string.
+        user_display_name (str): The user's display name.
+        user_name (str): The user's name.
+        user_interaction (UserInteraction): Handler for touch and PIN requests (e.g., CliInteraction).
+
+    Returns:
+        tuple: The encoded attestation object, client data, credential ID, and client extension results.
+    """
+    from fido2.client import Fido2Client
+    from fido2.utils import websafe_encode
+
+    client = Fido2Client(
+        key.connection,
+        "https://login.microsoft.com",
+        user_interaction=user_interaction,
+    )
+
+    pkcco = build_creation_options(challenge, user_id, user_display_name, user_name)
+
+    result = client.make_credential(pkcco["publicKey"])
+
+    attestation_obj = result["attestationObject"]
+    attestation = websafe_encode(attestation_obj)
+
+    client_data = result["clientData"].b64
+
+    credential_id = websafe_encode(
+        result.attestation_object.auth_data.credential_data.credential_id
+    )
+
+    client_extenstion_results = websafe_encode(
+        json.dumps(result.attestation_object.auth_data.extensions).encode("utf-8")
+    )
+
+    return (
+        attestation,
+        client_data,
+        credential_id,
+        client_extenstion_results,
+    )
+
+
+# Function to look up a Microsoft Entra ID user without prompting
+def fetch_user(user_principal_name):
+    """
+    Looks up a Microsoft Entra ID user by User Principal Name (UPN).
+
+    Unlike get_user_id(), this function never prompts and can be used in headless (batch) mode.
+    Users found in the directory cache (see sync_directory()) are returned without a request to Microsoft Graph API.
+
+    Args:
+        user_principal_name (str): The User Principal Name of the target user.
+
+    Returns:
+        tuple: A tuple containing the user's profile (or None if the lookup failed) and the HTTP status code of the response.
+    """
+    user_profile = ledger.directory.user(user_principal_name) if directory_cache and ledger else None
+    if user_profile:
+        return user_profile, 200
+
+    params = {"$select": "id,userPrincipalName,displayName"}
+    user_endpoint = (
+        graph_endpoint + "/users/" + user_principal_name + "/"
+    )
+
+    response = graph.get(
+        user_endpoint, params=params
+    )
+    if response.status_code == 200:  # This should be a successful fetch of a user
+        return response.json(), response.status_code
+    else:
+        return None, response.status_code
+
+
+# Function to fetch a Microsoft Entra ID user to be enrolled with a YubiKey
+def get_user_id(user_principal_name):
+    """
+    Fetches a Microsoft Entra ID user to be enrolled with a YubiKey.
+
+    This function retrieves a user's profile from the Microsoft Graph API based on the provided User Principal Name (UPN).
+    If the UPN is non-existent, it prompts the user to provide a valid UPN until a successful response is received or the
+    user cancels the operation.
+
+    Args:
+        user_principal_name (str): The User Principal Name of the target user.
+
+    Returns:
+        tuple: A tuple containing the user's profile and the HTTP status code of the response.
+    """
+    while True:
+        user_profile, status_code = fetch_user(user_principal_name)
+
+        if (
+            status_code == 404
+        ):  # If a non-existing UPN was submitted, we expect a 404 error
+            click.clear()
+            banner()
+            with upn_completion():
+                user_principal_name = click.prompt("User does not exist. Please try again")
+        elif user_profile:
+            return user_profile, status_code
+        else:
+            click.clear()
+            banner()
+            with upn_completion():
+                user_principal_name = click.prompt("An error occurred. Please try again")
+
+
+# Set variable to control whether the users in Microsoft Entra ID are cached (may be overridden in the config file)
+directory_cache = True
+
+
+# Function to synchronise the cache of users in Microsoft Entra ID
+def sync_directory(full=False):
+    """
+    Synchronises the directory cache in the ledger with the users in Microsoft Entra ID (users/delta).
+
+    The first synchronisation pages through all users; each later one starts from the delta link stored by the
+    previous one and only fetches the users added, changed or deleted since. If Microsoft Graph API no longer
+    accepts the delta link (HTTP 410), or a full synchronisation is requested, all users are fetched again and
+    users no longer returned are removed from the cache.
+
+    Args:
+        full (bool, optional): Whether to fetch all users instead of the changes. Default is False.
+
+    Returns:
+        tuple: True and the number of users added, changed or removed, or False and the HTTP status code of the
+            failed request.
+    """
+    url = None if full else ledger.directory.delta_link()
+    synced = time.time() if url is None else None
+    if url is None:
+        url = graph_endpoint + "/users/delta?$select=id,userPrincipalName,displayName"
+
+    changes = 0
+    while True:
+        response = graph.get(url, headers={"Prefer": "odata.maxpagesize=999"})
+        if response.status_code == 410 and synced is None:
+            return sync_directory(full=True)
+        if response.status_code != 200:
+            return False, response.status_code
+        page = response.json()
+        ledger.directory.update(page.get("value", []), synced or time.time())
+        changes += len(page.get("value", []))
+        if "@odata.nextLink" in page:
+            url = page["@odata.nextLink"]
+        else:
+            ledger.directory.complete_sync(page["@odata.deltaLink"], synced)
+            return True, changes
+
+
+# Function to synchronise the cache of users in the background, while the operator is prompted
+def sync_directory_in_background():
+    """
+    Synchronises the directory cache (see sync_directory()) on graph_executor, ignoring failures
+    (users not in the cache are looked up in Microsoft Graph API instead).
+
+    Returns:
+        concurrent.futures.Future: Completes when the synchronisation has finished.
+    """
+    def sync():
+        try:
+            sync_directory()
+        except requests.RequestException:
+            pass
+
+    return graph_executor.submit(telemetry.propagate(sync))
+
+
+# Function to complete User Principal Names typed at a prompt from the cache of users
+@contextmanager
+def upn_completion():
+    """
+    Completes the User Principal Names typed at prompts within the context with the Tab key,
+    from the directory cache (see sync_directory()).
+
+    Requires the readline module; without it (e.g., on Windows), prompts work as before without completion.
+    """
+    if readline is None or ledger is None:
+        yield
+        return
+
+    matches = []
+
+    def complete(text, state):
+        if state == 0:
+            matches[:] = ledger.directory.complete_user_principal_name(text)
+        return matches[state] if state < len(matches) else None
+
+    previous_completer, previous_delims = readline.get_completer(), readline.get_completer_delims()
+    readline.set_completer(complete)
+    readline.set_completer_delims(" \t\n")
+    readline.parse_and_bind("tab: complete")
+    try:
+        yield
+    finally:
+        readline.set_completer(previous_completer)
+        readline.set_completer_delims(previous_delims)
+
+
+# Function to look up many Microsoft Entra ID users (and their FIDO2 methods) in JSON batch requests
+def resolve_users(user_principal_names, fido2_methods=False):
+    """
+    Looks up Microsoft Entra ID users by User Principal Name (UPN) with JSON batch requests.
+
+    Instead of one round trip per user (see fetch_user()), the lookups (and the listings of the FIDO2 methods
+    already registered for the users) are packed into batches of up to GraphClient.batch_size requests, which are
+    sent in parallel on graph_executor. The results of each batch are yielded as soon as it completes.
+
+    Args:
+        user_principal_names (Iterable[str]): The User Principal Names of the users.
+        fido2_methods (bool, optional): Whether to also list the FIDO2 methods of the users. Default is False.
+
+    Yields:
+        tuple: The User Principal Name, the user's profile (or None if the lookup failed), the HTTP status code of
+            the lookup, and the list of FIDO2 methods of the user (or None if not listed or the listing failed).
+    """
+    user_principal_names = list(dict.fromkeys(user_principal_names))
+    users_per_batch = graph.batch_size // 2 if fido2_methods else graph.batch_size
+
+    def resolve(chunk):
+        requests_by_id = {}
+        for index, user_principal_name in enumerate(chunk):
+            user_path = "/users/" + urllib.parse.quote(user_principal_name)
+            requests_by_id[f"{index}"] = {"method": "GET", "url": user_path + "?$select=id,userPrincipalName,displayName"}
+            if fido2_methods:
+                requests_by_id[f"{index}-fido2"] = {"method": "GET", "url": user_path + "/authentication/fido2Methods"}
+        responses = graph.batch(graph_endpoint + "/$batch", requests_by_id)
+
+        results = []
+        for index, user_principal_name in enumerate(chunk):
+            response = responses[f"{index}"]
+            user_profile = response.json() if response.status_code == 200 else None
+            methods = None
+            if user_profile and fido2_methods and responses[f"{index}-fido2"].status_code == 200:
+                methods = responses[f"{index}-fido2"].json().get("value", [])
+            results.append((user_principal_name, user_profile, response.status_code, methods))
+        return results
+
+    futures = [
+        graph_executor.submit(telemetry.propagate(resolve), user_principal_names[start:start + users_per_batch])
+        for start in range(0, len(user_principal_names), users_per_batch)
+    ]
+    for future in as_completed(futures):
+        yield from future.result()
+
+
+# Function to delete the FIDO2 methods of YubiKeys from Microsoft Entra ID
+def revoke_fido2_methods(enrollments):
+    """
+    Deletes the FIDO2 methods registered for YubiKeys with JSON batch requests.
+
+    The deletions are packed into batches of up to GraphClient.batch_size requests, which are sent in parallel on
+    graph_executor (deletions that are throttled are retried by GraphClient.batch()). The results of each batch are
+    yielded as soon as it completes.
+
+    Args:
+        enrollments (Iterable[dict]): The enrollments of the YubiKeys (see Ledger.enrollments_by_serial_number()),
+            each with the 'upn' of the user and the 'auth_method' to delete.
+
+    Yields:
+        tuple: The enrollment and the HTTP status code of the deletion (204 if deleted, 404 if it did not exist).
+    """
+    enrollments = list(enrollments)
+
+    def revoke(chunk):
+        requests_by_id = {
+            f"{index}": {
+                "method": "DELETE",
+                "url": "/users/" + urllib.parse.quote(enrollment["upn"])
+                + "/authentication/fido2Methods/" + urllib.parse.quote(enrollment["auth_method"]),
+            }
+            for index, enrollment in enumerate(chunk)
+        }
+        responses = graph.batch(graph_endpoint + "/$batch", requests_by_id)
+        return [(enrollment, responses[f"{index}"].status_code) for index, enrollment in enumerate(chunk)]
+
+    futures = [
+        graph_executor.submit(telemetry.propagate(revoke), enrollments[start:start + graph.batch_size])
+        for start in range(0, len(enrollments), graph.batch_size)
+    ]
+    for future in as_completed(futures):
+        yield from future.result()
+
+
+# Function to read the inserted YubiKey
+def read_yubikey():
+    """
+    Returns the inserted YubiKey, waiting for a single YubiKey to be inserted if necessary.
+
+    Returns:
+        ScriptingDevice: The inserted YubiKey.
+    """
+    generation, yubikeys = device_watcher.snapshot()
+    if len(yubikeys) != 1:
+        banner()
+        if yubikeys:
+            click.echo("Remove all but one YubiKey (or use --multi)...")
+        else:
+            click.echo("Insert YubiKey...")
+        yubikeys = device_watcher.wait_until(lambda keys: len(keys) == 1)
+    device = next(iter(yubikeys.values()))
+
+    # Handle missing Serial Number (e.g., for Security Key Series Consumer Edition)
+    if device.info.serial is None:
+        banner()
+        click.pause("🛑 This YubiKey DOES NOT have a Serial Number (press any key to exit)")
+        click.clear()
+        sys.exit(1)
+
+    return device
+
+
+# Function to force a PIN change and set the minimum PIN length
+def force_pin_change(key, pin):
+    """
+    Sets the minimum PIN length and forces the user to change the PIN on first use.
+
+    Requires the YubiKey to support the 'setMinPINLength' option (firmware 5.7 or later).
+    A PIN/UV auth token with the AUTHENTICATOR_CFG permission is obtained for the config.
+
+    Args:
+        key (KeySession): The session with the YubiKey.
+        pin (str): The current PIN of the YubiKey.
+    """
+    from fido2.ctap2 import ClientPin, Config
+
+    client_pin = ClientPin(key.ctap)
+    token = client_pin.get_pin_token(
+        pin, ClientPin.PERMISSION.AUTHENTICATOR_CFG
+    )
+    config = Config(key.ctap, client_pin.protocol, token)
+    #config.set_min_pin_length(force_change_pin=True)
+    # Set minimum PIN length and force PIN change
+    config.set_min_pin_length(min_pin_length=pin_length, force_change_pin=True)
+
+
+# Function to enable Secure Transport Mode (restricted NFC)
+def enable_secure_transport_mode(key):
+    """
+    Restricts NFC access to the YubiKey until it is next powered over USB.
+
+    Requires firmware 5.7 or later.
+
+    Args:
+        key (KeySession): The session with the YubiKey.
+    """
+    from yubikit.management import DeviceConfig
+
+    session = device_backend.management_session(key.connection)
+    config = DeviceConfig({}, None, None, None)
+    config.nfc_restricted = True
+    lock_code = None
+
+    session.write_device_config(config, False, lock_code)
+
+
+# Function that runs the remaining stages of an enrollment, recording each one in the journal
+def continue_enrollment(key, state, reset, echo, resume=False):
+    """
+    Runs an enrollment from the last stage recorded in the journal (see Ledger.journal()) without prompts.
+
+    Each stage is committed to the journal before the next one starts, so an enrollment interrupted by a crash
+    continues where it stopped: a YubiKey with its PIN set is not reset again, and a credential that was created
+    but not registered is registered by posting the stored attestation again (or created anew if its challenge
+    has timed out in the meantime). If Microsoft Graph API fails to register the credential, the YubiKey is
+    configured anyway and the registration is queued (see RegistrationQueue, and 'registration_error' in state).
+    In offline mode, Microsoft Graph API is never called: an enrollment that still needs a user or creation options
+    not stored by the 'prefetch' command is left in the journal, to be resumed online.
+
+    Args:
+        key (KeySession): The session with the YubiKey.
+        state (dict): The state of the enrollment, i.e., the 'stage' reached, 'upn', 'pin' and (optionally) 'name',
+            'user_id', 'pin_change' and 'nfc_restricted', as returned by Ledger.journal_state(). Updated as stages complete.
+            If 'prepped' is set, the PIN was set when the YubiKey was prepped (see prep_on_station()) and the
+            YubiKey is only reset if that PIN is no longer set.
+        reset (callable): Function resetting the YubiKey if another PIN is set (e.g., reset_yubikey_on_station).
+        echo (callable): Function reporting progress to the operator.
+        resume (bool, optional): Whether the enrollment is resumed, so the PIN may already be set. Default is False.
+
+    Returns:
+        bool: True if the enrollment completed (possibly with the registration queued), False if the user or
+        the credential creation options could not be retrieved or are not stored offline (the enrollment can be resumed).
+    """
+    from fido2.ctap import CtapError
+
+    serial_number = key.serial_number
+
+    def advance(stage, **data):
+        state.update(data, stage=stage)
+        ledger.journal(serial_number, stage, **data)
+
+    # Look up the user if the enrollment was interrupted before that (recorded along with the PIN below)
+    if "user_id" not in state:
+        if creation_options_cache.offline:
+            # Offline, only users stored by the 'prefetch' command are known
+            user_profile, options = ledger.creation_options.stored(state["upn"])
+            if user_profile is None:
+                echo(f"🛑 No creation options stored for '{state['upn']}', resume the enrollment online.")
+                return False
+        else:
+            user_profile, status_code = fetch_user(state["upn"])
+            if user_profile is None:
+                echo(f"🛑 Could not find user '{state['upn']}' (HTTP {status_code}).")
+                return False
+        state.update(
+            upn=user_profile["userPrincipalName"],
+            name=user_profile["displayName"],
+            user_id=user_profile["id"],
+        )
+
+    # The stored attestation is rejected once its challenge has timed out, so create a new credential instead
+    if state["stage"] == "credential_created":
+        expiry = parse_graph_datetime(state["challenge_timeout"])
+        if expiry <= datetime.datetime.now(datetime.timezone.utc):
+            advance("pin_set")
+
+    # Offline, a credential can only be created with creation options stored by the 'prefetch' command
+    if state["stage"] in ("started", "pin_set") and creation_options_cache.offline:
+        user_profile, options = ledger.creation_options.stored(state["user_id"])
+        if options is None or not creation_options_cache.is_valid(options):
+            echo(f"🛑 No valid creation options stored for '{state['upn']}', resume the enrollment online.")
+            return False
+
+    if state["stage"] == "started":
+        creation_options_cache.prefetch(state["user_id"])
+        with telemetry.span("set_pin"):
+            if not ((resume or state.get("prepped")) and verify_fido_pin(state["pin"], key)):
+                set_fido_pin(state["pin"], key, reset=reset)
+        advance("pin_set", upn=state["upn"], name=state["name"], user_id=state["user_id"])
+        echo(f"PIN set, enrolling '{state['upn']}'...")
+
+    if state["stage"] == "pin_set":
+        with telemetry.span("creation_options") as span:
+            status, options = creation_options_cache.take(state["user_id"])
+            if not status:
+                span["outcome"] = "failed"
+        if not status:
+            echo("🛑 Failed to retrieve credential creation options.")
+            return False
+
+        with telemetry.span("make_credential"):
+            att, clientData, credId, extn = create_credentials_on_security_key(
+                key,
+                options["publicKey"]["user"]["id"],
+                options["publicKey"]["challenge"],
+                state["name"],
+                state["upn"],
+                CliInteraction(state["pin"], serial_number),
+            )
+        advance(
+            "credential_created",
+            attestation=att,
+            client_data=clientData,
+            credential_id=credId,
+            extensions=extn,
+            challenge_timeout=options["challengeTimeoutDateTime"],
+        )
+        if creation_options_cache.offline:
+            ledger.creation_options.delete(state["user_id"])
+
+    # In offline mode, store the credential to be uploaded later (see RegistrationQueue.upload())
+    if state["stage"] == "credential_created" and creation_options_cache.offline:
+        ledger.registrations.queue(serial_number, state["upn"], state, "Created offline", status="offline")
+        echo("Credential stored for upload.")
+        advance("registration_queued", registration_error="offline")
+
+    if state["stage"] == "credential_created":
+        with telemetry.span("activate") as span:
+            try:
+                activated, result = create_and_activate_fido_method(
+                    state["credential_id"],
+                    state["extensions"],
+                    state["upn"],
+                    state["attestation"],
+                    state["client_data"],
+                    serial_number,
+                )
+            except requests.RequestException as e:
+                activated, result = False, e
+            if not activated:
+                span["outcome"] = "failed"
+        if activated:
+            advance("registered", auth_method=result)
+        else:
+            # Finish the YubiKey anyway and retry the registration in the background
+            error = queue_failed_registration(serial_number, state["upn"], state, result)
+            echo(f"⏳ Failed to register YubiKey for '{state['name']}' in Microsoft Entra ID ({error}), queued for retry.")
+            advance("registration_queued", registration_error=error)
+
+    # Force PIN change and enable Secure Transport Mode where supported
+    if state["stage"] in ("registered", "registration_queued"):
+        pin_change = bool(state.get("pin_change", True) and key.ctap.info.options.get("setMinPINLength"))
+        if pin_change:
+            with telemetry.span("min_pin_length"):
+                try:
+                    force_pin_change(key, state["pin"])
+                except CtapError as e:
+                    # The PIN change was already forced before the enrollment was interrupted
+                    if not (resume and e.code == CtapError.ERR.PIN_POLICY_VIOLATION):
+                        raise
+
+        nfc_restricted = bool(state.get("nfc_restricted", True) and key.info.version >= (5, 7))
+        if nfc_restricted:
+            with telemetry.span("secure_transport"):
+                enable_secure_transport_mode(key)
+        advance("configured", pin_change=pin_change, nfc_restricted=nfc_restricted)
+
+    ledger.add(
+        state["name"], state["upn"], key.name, serial_number, state["pin"], state["pin_change"], state["nfc_restricted"],
+        state.get("auth_method"),
+    )
+    return True
+
+
+# Function that resumes an unfinished enrollment of the inserted YubiKey
+def resume_yubikey_enrollment(device, state):
+    """
+    Offers to resume the unfinished enrollment of the inserted YubiKey recorded in the journal.
+
+    Args:
+        device (ScriptingDevice): The inserted YubiKey.
+        state (dict): The state of the enrollment (see Ledger.journal_state()).
+
+    Returns:
+        bool: True if the enrollment was resumed, False if the operator chose to start over.
+    """
+    banner()
+    if not click.confirm(
+        f"This YubiKey was being enrolled for '{state['upn']}' (last completed stage: {state['stage']}). "
+        "Resume the enrollment?",
+        default=True,
+    ):
+        return False
+
+    with KeySession(device) as key, telemetry.span(
+        "enrollment", serial=key.serial_number, upn=state["upn"]
+    ) as enrollment:
+        # Ask for the settings the enrollment did not record yet
+        if state["stage"] != "configured":
+            if "pin_change" not in state:
+                state["pin_change"] = bool(
+                    key.ctap.info.options.get("setMinPINLength")
+                    and click.confirm("Force user to change PIN on first use?", default=True)
+                )
+            if "nfc_restricted" not in state:
+                state["nfc_restricted"] = bool(
+                    key.info.version >= (5, 7) and click.confirm("Configure Secure Transport Mode?", default=True)
+                )
+        completed = continue_enrollment(key, state, reset_yubikey, click.echo, resume=True)
+        if not completed:
+            enrollment["outcome"] = "failed"
+        elif "registration_error" in state:
+            enrollment["outcome"] = "queued"
+
+    banner()
+    if completed and "registration_error" in state:
+        click.pause(
+            f"Completed configuration for '{state['name']}', registration in Microsoft Entra ID is queued "
+            f"({state['registration_error']}) (press any key to continue...)"
+        )
+    elif completed:
+        click.pause(f"Completed configuration for '{state['name']}' (press any key to continue...)")
+    else:
+        click.pause("🛑 Enrollment could not be completed, insert the YubiKey again to retry (press any key to continue...)")
+    return True
+
+
+# Function that runs the entire YubiKey programming and registration sequence
+def yubikey_eob_registration(config):
+
+    # Show banner
+    banner()
+
+    # Loop to continuously check for YubiKey
+    while True:
+        device = read_yubikey()
+        if not is_enrollable(device.info.serial):
+            # If the serial number exists in the ledger (or was not prepped with --bind), inform the user
+            banner()
+            click.pause(
+                f"Insert a {'prepped' if bind_only else 'new'} YubiKey and press any key to continue..."
+            )
+        else:
+            # If the serial number does not exist, break the loop
+            break
+
+    # Offer to resume an interrupted enrollment of the YubiKey
+    state = ledger.journal_state(device.info.serial)
+    if state and resume_yubikey_enrollment(device, state):
+        return
+
+    # Open the YubiKey once for all of the steps below
+    with KeySession(device) as key:
+        serial_number = key.serial_number
+
+        # Prompt for user to provision with YubiKey
+        while True:
+            click.clear()
+            banner()
+            with upn_completion():
+                user_principal_name = input("Provide User Principal Name (UPN) of target user: ")
+            if user_principal_name:  # Check if UPN is not empty
+                break
+            else:
+                click.clear()
+                banner()
+                click.pause("You did not provide any input (press any key to continue...)")
+
+        # Time the stages of the enrollment (see Telemetry)
+        with telemetry.span("enrollment", serial=serial_number, upn=user_principal_name) as enrollment:
+
+            # Look up the user and fetch FIDO2 credential creation options while the YubiKey is being prepared
+            user_lookup = graph_executor.submit(telemetry.propagate(prefetch_user), user_principal_name)
+
+            # Generate a random PIN (a prepped YubiKey keeps the PIN set when it was prepped, see prep_on_station())
+            prepped = ledger.inventory.prepped(serial_number)
+            pin = prepped[0]["pin"] if prepped else generate_random_pin()
+
+            # Record the PIN before setting it, so that an interrupted enrollment can be resumed (see continue_enrollment())
+            ledger.journal(serial_number, "started", upn=user_principal_name, pin=pin, prepped=bool(prepped))
+
+            # Now set the PIN on the YubiKey
+            with telemetry.span("set_pin"):
+                if not (prepped and verify_fido_pin(pin, key)):
+                    set_fido_pin(pin, key)
+
+            # Read the user profile returned from Microsoft Graph API (prompting again if the user was not found)
+            with telemetry.span("user_lookup"):
+                user_profile = user_lookup.result()
+            if user_profile is None:
+                user_profile, status_code = get_user_id(user_principal_name)
+                telemetry.bind(upn=user_profile["userPrincipalName"])
+
+            # Translate attributes to something we can use
+            user_name = user_profile["userPrincipalName"]
+            user_display_name = user_profile["displayName"]
+            ledger.journal(serial_number, "pin_set", upn=user_name, name=user_display_name, user_id=user_profile["id"])
+
+            # Get FIDO2 credential creation options
+            with telemetry.span("creation_options") as span:
+                (status, options) = creation_options_cache.take(user_profile["id"])
+                if not status:
+                    span["outcome"] = "failed"
+            if not status:
+                # The enrollment is resumed from the journal when the YubiKey is inserted again
+                enrollment["outcome"] = "failed"
+                banner()
+                click.pause(
+                    "🛑 Failed to retrieve credential creation options, insert the YubiKey again to retry "
+                    "(press any key to continue...)"
+                )
+                return
+            user_id = options["publicKey"]["user"]["id"]
+            challenge = options["publicKey"]["challenge"]
+            challenge_expiry_time = options["challengeTimeoutDateTime"]
+
+            # Create the creential on the YubiKey
+            with telemetry.span("make_credential"):
+                (
+                    att,
+                    clientData,
+                    credId,
+                    extn,
+                ) = create_credentials_on_security_key(
+                    key, user_id, challenge, user_display_name, user_name, CliInteraction(pin)
+                )
+            credential = {
+                "attestation": att,
+                "client_data": clientData,
+                "credential_id": credId,
+                "extensions": extn,
+                "challenge_timeout": challenge_expiry_time,
+            }
+            ledger.journal(serial_number, "credential_created", **credential)
+
+            # Create the credential in Microsoft Entra ID
+            with telemetry.span("activate") as activation:
+                try:
+                    activated, auth_method = create_and_activate_fido_method(
+                        credId,
+                        extn,
+                        user_name,
+                        att,
+                        clientData,
+                        serial_number,
+                    )
+                except requests.RequestException as e:
+                    activated, auth_method = False, e
+                if not activated:
+                    activation["outcome"] = "failed"
+
+            # If registration failed, finish the YubiKey anyway and retry the registration in the background
+            registration_error = None
+            if activated:
+                ledger.journal(serial_number, "registered", auth_method=auth_method)
+            else:
+                enrollment["outcome"] = "queued"
+                registration_error = queue_failed_registration(serial_number, user_name, credential, auth_method)
+                ledger.journal(serial_number, "registration_queued", registration_error=registration_error)
+                banner()
+                click.pause(
+                    f"⏳ Failed to register YubiKey for '{user_display_name}' in Microsoft Entra ID ({registration_error}), "
+                    "queued for retry (press any key to continue...)"
+                )
+
+            # Force PIN change & set Minimum PIN lenght
+            banner()
+            pin_change = False
+            nfc_restricted = False
+
+            if key.ctap.info.options.get("setMinPINLength") and click.confirm("Force user to change PIN on first use?", default=True):
+                with telemetry.span("min_pin_length"):
+                    force_pin_change(key, pin)
+
+                # Set attribute for CSV output file
+                pin_change = True
+                banner()
+                click.pause(
+                    "PIN set to expire on first use (press any key to continue...)"
+                )
+
+
+            # Enable Secure Transport Mode (restricted NFC)
+            banner()
+            if key.info.version >= (5, 7) and click.confirm("Configure Secure Transport Mode?", default=True):
+                with telemetry.span("secure_transport"):
+                    enable_secure_transport_mode(key)
+                # Set attribute for CSV output file
+                nfc_restricted = True
+                banner()
+                click.pause(
+                    "NFC disabled until powered over USB (press any key to continue...)"
+                    )
+            ledger.journal(serial_number, "configured", pin_change=pin_change, nfc_restricted=nfc_restricted)
+
+
+    # Record relevant attributes in the ledger (and the CSV output file)
+    ledger.add(
+        user_display_name, user_name, key.name, serial_number, pin, pin_change, nfc_restricted,
+        auth_method if activated else None,
+    )
+
+    # Inform user on completion
+    banner()
+    if registration_error:
+        click.pause(
+            f"Completed configuration for '{user_display_name}', registration in Microsoft Entra ID is queued "
+            f"({registration_error}) (press any key to continue...)"
+        )
+    else:
+        click.pause(f"Completed configuration for '{user_display_name}' (press any key to continue...)")
+
+
+# Function that runs the programming and registration sequence for one YubiKey without prompts
+def enroll_on_station(device, user_profile, pin_change, nfc_restricted):
+    """
+    Programs one YubiKey attached to the station and registers it for a user.
+
+    Runs reset (if a PIN is already set), PIN, credential creation, registration in Microsoft Entra ID
+    and (where supported) forced PIN change and Secure Transport Mode without any prompts,
+    so that several workers can run in parallel. Each stage is recorded in the journal (see continue_enrollment()).
+
+    Args:
+        device (ScriptingDevice): The YubiKey to program, as returned by list_yubikeys().
+        user_profile (dict): The profile of the target user as returned by get_user_id().
+        pin_change (bool): Whether to force the user to change the PIN on first use.
+        nfc_restricted (bool): Whether to configure Secure Transport Mode.
+
+    Returns:
+        bool: True if the enrollment completed, False otherwise (e.g., if the FIDO2 method could not be registered).
+    """
+    serial_number = device.info.serial
+    user_name = user_profile["userPrincipalName"]
+    user_display_name = user_profile["displayName"]
+
+    with KeySession(device) as key, telemetry.span("enrollment", serial=serial_number, upn=user_name) as enrollment:
+        # Fetch FIDO2 credential creation options while the YubiKey is being prepared
+        creation_options_cache.prefetch(user_profile["id"])
+
+        # Record the PIN before setting it, so that an interrupted enrollment can be resumed
+        # (a prepped YubiKey keeps the PIN set when it was prepped, see prep_on_station())
+        prepped = ledger.inventory.prepped(serial_number)
+        state = {
+            "upn": user_name,
+            "name": user_display_name,
+            "user_id": user_profile["id"],
+            "pin": prepped[0]["pin"] if prepped else generate_random_pin(),
+            "pin_change": bool(pin_change),
+            "nfc_restricted": bool(nfc_restricted),
+            "prepped": bool(prepped),
+        }
+        ledger.journal(serial_number, "started", **state)
+        state["stage"] = "started"
+
+        completed = continue_enrollment(
+            key, state, reset_yubikey_on_station, lambda message: station_echo(serial_number, message)
+        )
+        if not completed:
+            enrollment["outcome"] = "failed"
+        elif "registration_error" in state:
+            enrollment["outcome"] = "queued"
+
+    if completed and "registration_error" in state:
+        station_echo(serial_number, f"✅ Completed configuration for '{state['name']}' (registration queued).")
+    elif completed:
+        station_echo(serial_number, f"✅ Completed configuration for '{user_display_name}'.")
+    return completed
+
+
+# Function that resumes an unfinished enrollment of a YubiKey attached to the station without prompts
+def resume_on_station(device, state):
+    """
+    Resumes the unfinished enrollment of a YubiKey attached to the station (see continue_enrollment()).
+
+    Args:
+        device (ScriptingDevice): The YubiKey, as returned by list_yubikeys().
+        state (dict): The state of the enrollment (see Ledger.journal_state()).
+
+    Returns:
+        bool: True if the enrollment completed, False otherwise.
+    """
+    serial_number = device.info.serial
+    station_echo(serial_number, f"Resuming enrollment of '{state['upn']}' (last completed stage: {state['stage']})...")
+    with KeySession(device) as key, telemetry.span("enrollment", serial=serial_number, upn=state["upn"]) as enrollment:
+        completed = continue_enrollment(
+            key, state, reset_yubikey_on_station, lambda message: station_echo(serial_number, message), resume=True
+        )
+        if not completed:
+            enrollment["outcome"] = "failed"
+        elif "registration_error" in state:
+            enrollment["outcome"] = "queued"
+
+    if completed and "registration_error" in state:
+        station_echo(serial_number, f"✅ Completed configuration for '{state['name']}' (registration queued).")
+    elif completed:
+        station_echo(serial_number, f"✅ Completed configuration for '{state['name']}'.")
+    return completed
+
+
+# Function that prepares a YubiKey attached to the station for a later enrollment without prompts
+def prep_on_station(device):
+    """
+    Prepares a YubiKey attached to the station, so that enrolling it later only creates and registers the credential.
+
+    Resets the YubiKey (if a PIN is already set) and sets a random PIN, then records the PIN, firmware version and
+    capabilities of the YubiKey in the prep inventory (see InventoryStore.add()). Secure Transport Mode is
+    configured when the YubiKey is enrolled, as connecting the YubiKey over USB to enroll it lifts the restriction.
+
+    Args:
+        device (ScriptingDevice): The YubiKey to prep, as returned by list_yubikeys().
+
+    Returns:
+        dict: The capabilities of the YubiKey, i.e., whether a PIN change can be forced ('pin_change')
+            and whether Secure Transport Mode can be configured ('secure_transport').
+    """
+    serial_number = device.info.serial
+    with KeySession(device) as key, telemetry.span("prep", serial=serial_number):
+        pin = generate_random_pin()
+        with telemetry.span("set_pin"):
+            set_fido_pin(pin, key, reset=reset_yubikey_on_station)
+        capabilities = {
+            "pin_change": bool(key.ctap.info.options.get("setMinPINLength")),
+            "secure_transport": key.info.version >= (5, 7),
+        }
+        ledger.inventory.add(serial_number, key.name, key.info.version, pin, capabilities)
+
+    station_echo(serial_number, "✅ Prepped.")
+    return capabilities
+
+
+# Function that programs all YubiKeys attached to a multi-device station in parallel
+def multi_device_registration():
+    """
+    Enrolls every YubiKey attached to the station (e.g., via a USB hub) in parallel.
+
+    The operator is asked for the User Principal Name to assign to each attached YubiKey
+    (identified by serial number) and the PIN change and Secure Transport Mode settings for the batch.
+    Each YubiKey is then programmed by its own worker thread.
+    """
+    banner()
+    yubikeys = list_yubikeys()
+
+    if None in yubikeys:
+        click.pause("🛑 A YubiKey WITHOUT a Serial Number is attached (press any key to continue...)")
+        return
+
+    pending = [
+        device
+        for serial_number, device in sorted(yubikeys.items())
+        if is_enrollable(serial_number)
+    ]
+    if not pending:
+        click.pause(f"Insert one or more {'prepped' if bind_only else 'new'} YubiKeys and press any key to continue...")
+        return
+
+    click.secho(f"Found {len(yubikeys)} YubiKey(s), {len(pending)} not yet enrolled.")
+
+    # YubiKeys with an unfinished enrollment are resumed for the user they were being enrolled for
+    resumed, new = [], []
+    for device in pending:
+        state = ledger.journal_state(device.info.serial)
+        if state:
+            click.secho(f"{device}: resuming enrollment of '{state['upn']}'.")
+            resumed.append((device, state))
+        else:
+            new.append(device)
+
+    assignments = []
+    for device in new:
+        user_principal_name = click.prompt(
+            f"Provide User Principal Name (UPN) of target user for {device}"
+        )
+        with telemetry.context(serial=device.info.serial, upn=user_principal_name):
+            user_profile, status_code = get_user_id(user_principal_name)
+            creation_options_cache.prefetch(user_profile["id"])
+        assignments.append((device, user_profile))
+
+    pin_change = click.confirm("Force users to change PIN on first use?", default=True)
+    nfc_restricted = click.confirm("Configure Secure Transport Mode?", default=True)
+    for device, state in resumed:
+        state.setdefault("pin_change", pin_change)
+        state.setdefault("nfc_restricted", nfc_restricted)
+
+    banner()
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        futures = {
+            executor.submit(
+                enroll_on_station, device, user_profile, pin_change, nfc_restricted
+            ): device
+            for device, user_profile in assignments
+        }
+        futures.update(
+            {executor.submit(resume_on_station, device, state): device for device, state in resumed}
+        )
+        for future in as_completed(futures):
+            serial_number = futures[future].info.serial
+            try:
+                results[serial_number] = future.result()
+            except Exception as e:
+                station_echo(serial_number, f"🛑 Enrollment failed: {e}")
+                results[serial_number] = False
+
+    click.pause(
+        f"Completed {sum(results.values())} of {len(results)} enrollment(s) (press any key to continue...)"
+    )
+
+
+# Function to interpret a yes/no column of a manifest file
+def parse_manifest_flag(value, default=True):
+    """
+    Interprets a yes/no value read from a manifest file.
+
+    Args:
+        value (Union[bool, str, None]): The value as read from CSV (string) or JSONL (boolean or string).
+        default (bool, optional): The value to use if the column is missing or empty. Default is True.
+
+    Returns:
+        bool: The interpreted value.
+    """
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("true", "yes", "y", "1")
 
-        Args:
-            user_principal_name (str): The User Principal Name of the target user.
-            access_token (str): A valid access token for the Microsoft Graph API.
 
-        Returns:
-            tuple: A tuple containing the user's profile and the HTTP status code of the response.
-        """
-        while True:
-            headers = set_http_headers(access_token)
-            params = {"$select": "id,userPrincipalName,displayName"}
-            user_endpoint = (
-                "https://graph.microsoft.com/beta/users/" + user_principal_name + "/"
-            )
+# Function to stream users to enroll from a manifest file
+def read_manifest(manifest_file):
+    """
+    Streams the users to enroll from a manifest file in CSV or JSONL format.
 
-            response = requests.get(
-                user_endpoint, headers=headers, params=params, verify=False
-            )
-            status_code = response.status_code
+    Each entry must hold a 'UPN' and may hold 'PIN change required' and 'Secure Transport Mode'
+    (the same column names as in 'output.csv'). Both options default to True. Files with a '.jsonl'
+    extension are read as one JSON object per line, all other files as CSV with a header row.
 
-            if (
-                status_code == 404
-            ):  # If a non-existing UPN was submitted, we expect a 404 error
-                click.clear()
-                banner()
-                user_principal_name = click.prompt("User does not exist. Please try again")
-            elif status_code == 200:  # This should be a successful fetch of a user
-                user_profile = response.json()
-                return user_profile, status_code
-            else:
-                click.clear()
-                banner()
-                user_principal_name = click.prompt("An error occurred. Please try again")
-                
+    Args:
+        manifest_file (str): Path to the manifest file.
 
-    # Show banner
-    banner()
+    Yields:
+        dict: An entry with the keys 'UPN', 'PIN change required' and 'Secure Transport Mode'.
+    """
+    with open(manifest_file, "r", encoding="utf8", newline="") as f:
+        if manifest_file.lower().endswith(".jsonl"):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for row in rows:
+            user_principal_name = (row.get("UPN") or "").strip()
+            if not user_principal_name:
+                continue
+            yield {
+                "UPN": user_principal_name,
+                "PIN change required": parse_manifest_flag(row.get("PIN change required")),
+                "Secure Transport Mode": parse_manifest_flag(row.get("Secure Transport Mode")),
+            }
 
-    # Function to read the YubiKey serial number
-    def read_serial_number():
-        device = s.single()
-        serial_number = device.info.serial      
 
-        # Handle missing Serial Number (e.g., for Security Key Series Consumer Edition)
-        if serial_number is None:
-            banner()
-            click.pause("🛑 This YubiKey DOES NOT have a Serial Number (press any key to exit)")
-            click.clear()
-            sys.exit(1)
-        
-        return serial_number
+# Function to find a Microsoft Entra ID group by object ID or display name
+def find_group(group):
+    """
+    Looks up a Microsoft Entra ID group.
 
+    Args:
+        group (str): The object ID or the display name of the group.
 
-    # Function to check if the serial number is already in the CSV file
-    def is_serial_number_in_file(serial_number):
-        """
-        Check if a serial number is present in the 'output.csv' file.
+    Returns:
+        tuple: The group (a dict with the "id" and "displayName"), or None if no single group was found,
+            and the HTTP status code of the response (or 300 if several groups have the display name).
+    """
+    params = {"$select": "id,displayName"}
+    try:
+        uuid.UUID(group)
+    except ValueError:
+        params["$filter"] = "displayName eq '" + group.replace("'", "''") + "'"
+        response = graph.get(graph_endpoint + "/groups", params=params)
+        if response.status_code != 200:
+            return None, response.status_code
+        groups = response.json().get("value", [])
+        if len(groups) != 1:
+            return None, 404 if not groups else 300
+        return groups[0], response.status_code
+
+    response = graph.get(graph_endpoint + "/groups/" + group, params=params)
+    if response.status_code == 200:
+        return response.json(), response.status_code
+    return None, response.status_code
+
+
+# Function to enumerate the users in a Microsoft Entra ID group
+def group_members(group_id):
+    """
+    Streams the users in a Microsoft Entra ID group, including the members of nested groups.
 
-        This function helps avoid programming errors where a user attempts to program a YubiKey that has
-        already been programmed. It searches the 'output.csv' file for the provided serial number and
-        returns True if the serial number is found, False otherwise.
+    The members are fetched page by page (following @odata.nextLink) as the caller consumes them,
+    so enrollment can start with the first page instead of waiting for the whole membership list.
 
-        Args:
-            serial_number (str): The serial number to search for in the 'output.csv' file.
+    Args:
+        group_id (str): The object ID of the group.
 
-        Returns:
-            bool: True if the serial number is found in the file, False otherwise.
-        """
-        try:
-            with open('output.csv', 'r', newline='') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    if row['Serial number'] == str(serial_number):
-                        return True
-        except FileNotFoundError:
-            return False
+    Yields:
+        dict: The profile of a user (as returned by fetch_user()).
+
+    Raises:
+        requests.HTTPError: If a page could not be fetched.
+    """
+    url = graph_endpoint + "/groups/" + group_id + "/transitiveMembers/microsoft.graph.user"
+    params = {"$select": "id,userPrincipalName,displayName", "$top": 999, "$count": "true"}
+    while url:
+        # The OData cast to users is an advanced query
+        response = graph.get(url, params=params, headers={"ConsistencyLevel": "eventual"})
+        response.raise_for_status()
+        page = response.json()
+        yield from page.get("value", [])
+        url, params = page.get("@odata.nextLink"), None
+
+
+# Function to list the FIDO2 security keys registered for users
+def list_fido2_methods(users):
+    """
+    Streams the users with the FIDO2 methods registered for them in Microsoft Entra ID.
+
+    The FIDO2 methods of the users are listed in JSON batch requests (see GraphClient.batch()) sent in
+    parallel on graph_executor; users are yielded as their batch completes.
+
+    Args:
+        users (list): The profiles of the users (as returned by fetch_user()).
+
+    Yields:
+        tuple: The profile of a user and the list of FIDO2 methods of the user (or None if the listing failed).
+    """
+    def check(chunk):
+        responses = graph.batch(
+            graph_endpoint + "/$batch",
+            {
+                f"{index}": {"method": "GET", "url": f"/users/{user['id']}/authentication/fido2Methods"}
+                for index, user in enumerate(chunk)
+            },
+        )
+        return [
+            (user, responses[f"{index}"].json().get("value", []) if responses[f"{index}"].status_code == 200 else None)
+            for index, user in enumerate(chunk)
+        ]
+
+    futures = [
+        graph_executor.submit(telemetry.propagate(check), users[start:start + graph.batch_size])
+        for start in range(0, len(users), graph.batch_size)
+    ]
+    for future in as_completed(futures):
+        yield from future.result()
+
+
+# Function to check whether a user is still to be enrolled
+def is_user_enrollable(user_principal_name, fido2_methods):
+    """
+    Checks whether a user of a manifest or a group is still to be enrolled, and reports the users who are not.
+
+    Users recorded in the ledger are not enrolled again, and neither are users who already have a FIDO2
+    security key registered in Microsoft Entra ID.
+
+    Args:
+        user_principal_name (str): The User Principal Name of the user.
+        fido2_methods (list): The FIDO2 methods of the user (see list_fido2_methods()), or None if unknown.
+
+    Returns:
+        bool: True if the user is to be enrolled, False otherwise.
+    """
+    if ledger.has_user(user_principal_name):
         return False
+    if fido2_methods:
+        click.secho(
+            f"'{user_principal_name}' already has {len(fido2_methods)} FIDO2 security key(s) registered, skipping."
+        )
+        return False
+    return True
 
-    # Loop to continuously check for YubiKey
-    while True:
-        serial_number = read_serial_number()
-        if is_serial_number_in_file(serial_number):
-            # If the serial number exists in the output.csv file, inform the user
-            banner()
-            click.pause(
-                "Insert a new YubiKey and press any key to continue..."
-            )
-        else:
-            # If the serial number does not exist, break the loop
-            break
-        time.sleep(1)  # Add a short delay to prevent the loop from consuming too much CPU
 
-    # Read the YubiKey serial number (again)
-    serial_number = read_serial_number()
+# Function to read the users to enroll from Microsoft Entra ID groups
+def read_groups(groups, page_size=GraphClient.batch_size):
+    """
+    Streams the users to enroll from Microsoft Entra ID groups, as entries like those of read_manifest().
 
-    # Generate a random PIN
-    pin = generate_random_pin()
+    Members of the groups (see group_members()) are filtered as they are fetched: users already seen in another
+    group are skipped, and the FIDO2 methods of the others are listed (see list_fido2_methods()) a page at a time,
+    as soon as the page is filled, for is_user_enrollable(). Both options of the entries are True.
+
+    Args:
+        groups (Iterable[str]): The object IDs or display names of the groups.
+        page_size (int, optional): Number of members checked for FIDO2 methods at a time. Default is one JSON
+            batch request (GraphClient.batch_size).
+
+    Yields:
+        dict: An entry with the keys 'UPN', 'PIN change required' and 'Secure Transport Mode',
+            and the user's profile under 'profile'.
+    """
+    seen = set()
+    for group in groups:
+        group_profile, status_code = find_group(group)
+        if group_profile is None:
+            click.secho(f"🛑 Could not find a single group '{group}' (HTTP {status_code}), skipping.")
+            continue
+        click.secho(f"Enrolling members of '{group_profile['displayName']}'...")
+
+        members = group_members(group_profile["id"])
+        while True:
+            page = []
+            try:
+                for user in members:
+                    if user["id"] in seen or ledger.has_user(user["userPrincipalName"]):
+                        continue
+                    seen.add(user["id"])
+                    page.append(user)
+                    if len(page) == page_size:
+                        break
+            except requests.RequestException as e:
+                click.secho(f"🛑 Could not fetch all members of '{group_profile['displayName']}': {e}")
+                members = iter(())
+            if not page:
+                break
+            for user_profile, methods in list_fido2_methods(page):
+                if not is_user_enrollable(user_profile["userPrincipalName"], methods):
+                    continue
+                yield {
+                    "UPN": user_profile["userPrincipalName"],
+                    "PIN change required": True,
+                    "Secure Transport Mode": True,
+                    "profile": user_profile,
+                }
+
+
+# Set variable to control whether only prepped YubiKeys are enrolled (set by the --bind option)
+bind_only = False
+
+
+# Function to check whether a YubiKey is still to be enrolled
+def is_enrollable(serial_number):
+    """
+    Checks whether a YubiKey is still to be enrolled.
+
+    A YubiKey recorded in the ledger is not enrolled again. With the --bind option, only YubiKeys in the
+    prep inventory (see the 'prep' command) and YubiKeys with an unfinished enrollment are enrolled.
+
+    Args:
+        serial_number (int): The serial number of the YubiKey.
+
+    Returns:
+        bool: True if the YubiKey is to be enrolled, False otherwise.
+    """
+    if ledger.has_serial_number(serial_number):
+        return False
+    return not bind_only or bool(ledger.inventory.prepped(serial_number)) or ledger.journal_state(serial_number) is not None
+
+
+# Function to wait for new (not yet enrolled) YubiKeys to be inserted
+def wait_for_new_yubikeys(multi=False, accept=None):
+    """
+    Waits until one or more YubiKeys that are not yet recorded in the ledger are attached.
 
-    # Now set the PIN on the YubiKey
-    set_fido_pin(pin)
+    In multi-device mode the set of attached YubiKeys must be unchanged for one second
+    before it is returned, so that an operator filling a USB hub is not interrupted after the first key.
 
-    # Prompt for user to provision with YubiKey
+    Args:
+        multi (bool, optional): Whether to return all new YubiKeys instead of just one. Default is False.
+        accept (callable, optional): Function checking whether a YubiKey (by serial number) is new.
+            Default is is_enrollable().
+
+    Returns:
+        list: The new YubiKeys (ScriptingDevice) to program.
+    """
+    accept = accept or is_enrollable
     while True:
-        click.clear()
-        banner()
-        user_principal_name = input("Provide User Principal Name (UPN) of target user: ")
-        if user_principal_name:  # Check if UPN is not empty
-            break
-        else:
-            click.clear()
-            banner()
-            click.pause("You did not provide any input (press any key to continue...)")
-            
+        generation, yubikeys = device_watcher.snapshot()
+        pending = [
+            yubikeys[serial_number]
+            for serial_number in sorted(serial for serial in yubikeys if serial is not None)
+            if accept(serial_number)
+        ]
+        if pending and not multi:
+            return pending[:1]
+        if pending and not device_watcher.wait_for_change(generation, timeout=1.0):
+            return pending
+        if not pending:
+            device_watcher.wait_for_change(generation)
+
+
+# Function that enrolls the users listed in a manifest file without prompts
+def batch_registration(manifest_file=None, multi=False, groups=(), jobs=None):
+    """
+    Enrolls the users listed in a manifest file (see read_manifest()), the members of groups
+    (see read_groups()) or the users leased from a coordinator (see LeasedJobs), without prompting.
+
+    Each user is paired with the next YubiKey inserted (or, in multi-device mode, with the next
+    YubiKey attached to the station), so the operator only has to insert, touch and remove YubiKeys.
+    Users already recorded in the ledger are skipped, so an interrupted batch can simply be restarted.
+    All other users in a manifest are looked up upfront (see resolve_users()), so unknown users are reported before
+    the first YubiKey is inserted. Like members of groups, users who already have FIDO2 security keys registered are
+    reported and skipped (see is_user_enrollable()). Members of
+    groups are streamed instead, so enrollment starts while the rest of the members are still being fetched, and users
+    are leased from a coordinator one at a time, so that several stations can work through the same list.
+    YubiKeys with an unfinished enrollment in the journal are resumed when inserted (see continue_enrollment()),
+    and their users are not paired with another YubiKey.
+
+    Args:
+        manifest_file (str, optional): Path to the manifest file.
+        multi (bool, optional): Whether to program all attached YubiKeys in parallel. Default is False.
+        groups (Iterable[str], optional): The object IDs or display names of groups to enroll instead of a manifest.
+        jobs (LeasedJobs, optional): The jobs leased from a coordinator to enroll instead of a manifest. The outcome
+            of every enrollment is reported to the coordinator.
+    """
+    if jobs:
+        source = "the coordinator"
+        entries = []
+        remaining = jobs.entries()
+    elif groups:
+        source = ", ".join(f"'{group}'" for group in groups)
+        entries = []
+        remaining = read_groups(groups)
+    else:
+        source = f"'{manifest_file}'"
+        entries = list(read_manifest(manifest_file))
+        remaining = iter(entries)
+    results = {}
+
+    # Record the outcome of the enrollment of a user (and report it to the coordinator)
+    def record(entry, completed, error=None):
+        results[entry["UPN"]] = completed
+        if jobs:
+            jobs.report(entry["UPN"], completed, error)
+
+    # YubiKeys whose enrollment was interrupted, by the User Principal Name they were being enrolled for
+    unfinished = {state["upn"].lower(): serial_number for serial_number, state in ledger.unfinished().items()}
+    awaiting = set()  # Users in the manifest whose YubiKey is to be inserted again to resume
+
+    # Profiles of the users looked up upfront, and the users skipped (by lowercase User Principal Name)
+    resolved = {}
+    skipped = set()
+
+    # Resolve the next users in the manifest (skipping enrolled and unknown users)
+    assignments_ahead = []
+
+    def next_assignments(count):
+        assignments = assignments_ahead[:count]
+        del assignments_ahead[:count]
+        if len(assignments) == count:
+            return assignments
+        for entry in remaining:
+            if entry["UPN"] in results or entry["UPN"].lower() in skipped:
+                continue
+            if ledger.has_user(entry["UPN"]):
+                if jobs:
+                    jobs.report(entry["UPN"], True)
+                continue
+            if entry["UPN"].lower() in unfinished:
+                click.secho(
+                    f"'{entry['UPN']}' has an unfinished enrollment on YubiKey {unfinished[entry['UPN'].lower()]}, "
+                    "insert it to resume."
+                )
+                awaiting.add(entry["UPN"].lower())
+                continue
+            if creation_options_cache.offline:
+                # Offline, only users with stored creation options (see the 'prefetch' command) can be enrolled
+                user_profile, options = ledger.creation_options.stored(entry["UPN"])
+                if user_profile is None or not creation_options_cache.is_valid(options):
+                    click.secho(f"🛑 No valid creation options stored for '{entry['UPN']}', skipping.")
+                    results[entry["UPN"]] = False
+                    continue
+                assignments.append((user_profile, entry))
+                if len(assignments) == count:
+                    break
+                continue
+            user_profile = entry.get("profile") or resolved.get(entry["UPN"].lower())
+            if user_profile is None:
+                user_profile, status_code = fetch_user(entry["UPN"])
+            if user_profile is None:
+                click.secho(f"🛑 Could not find user '{entry['UPN']}' (HTTP {status_code}), skipping.")
+                record(entry, False, f"User not found (HTTP {status_code}).")
+                continue
+            assignments.append((user_profile, entry))
+            if len(assignments) == count:
+                break
+        return assignments
 
-    # Read the user profile returned from Microsoft Graph API
-    user_profile, status_code = get_user_id(user_principal_name, access_token)
+    banner()
+    click.secho(f"Enrolling users from {source}...")
+
+    # Look up all users to enroll in JSON batch requests, so unknown users are flagged before the first YubiKey
+    if not creation_options_cache.offline:
+        pending = [
+            entry["UPN"] for entry in entries
+            if not ledger.has_user(entry["UPN"]) and entry["UPN"].lower() not in unfinished
+        ]
+        for user_principal_name, user_profile, status_code, methods in resolve_users(pending, fido2_methods=True):
+            if status_code == 404:
+                click.secho(f"🛑 Could not find user '{user_principal_name}', skipping.")
+                results[user_principal_name] = False
+            elif user_profile and not is_user_enrollable(user_principal_name, methods):
+                skipped.add(user_principal_name.lower())
+            elif user_profile:
+                resolved[user_principal_name.lower()] = user_profile
+    while True:
+        # Stop once every user has been enrolled (or skipped) instead of waiting for another YubiKey
+        if not assignments_ahead:
+            assignments_ahead.extend(next_assignments(1))
+            if not assignments_ahead and not awaiting:
+                break
+        click.secho("Insert YubiKey(s)...")
+        devices = wait_for_new_yubikeys(multi)
+
+        # Resume interrupted enrollments, pair the other YubiKeys with the next users
+        resumed, new = [], []
+        for device in devices:
+            state = ledger.journal_state(device.info.serial)
+            if state:
+                awaiting.discard(state["upn"].lower())
+                resumed.append((device, state))
+            else:
+                new.append(device)
+        assignments = next_assignments(len(new))
+        if not assignments and not resumed:
+            break
 
-    # Get FIDO2 credential creation options
-    (status, options) = get_fido2_creation_options(user_profile["id"], access_token)
+        with ThreadPoolExecutor(max_workers=len(assignments) + len(resumed)) as executor:
+            futures = {
+                executor.submit(
+                    enroll_on_station,
+                    device,
+                    user_profile,
+                    entry["PIN change required"],
+                    entry["Secure Transport Mode"],
+                ): (device, entry)
+                for device, (user_profile, entry) in zip(new, assignments)
+            }
+            futures.update({
+                executor.submit(resume_on_station, device, state): (device, {"UPN": state["upn"]})
+                for device, state in resumed
+            })
+            for future in as_completed(futures):
+                device, entry = futures[future]
+                try:
+                    record(entry, future.result())
+                except Exception as e:
+                    station_echo(device.info.serial, f"🛑 Enrollment of '{entry['UPN']}' failed: {e}")
+                    record(entry, False, f"Enrollment failed: {e}")
+
+        if len(assignments) < len(new):
+            break
+        click.secho("Remove programmed YubiKey(s)...")
+        programmed = [device for device, state in resumed] + new[:len(assignments)]
+        device_watcher.wait_for_removal([device.info.serial for device in programmed])
 
-    # Translate attributes to something we can use
-    user_name = user_profile["userPrincipalName"]
-    user_display_name = user_profile["displayName"]
-    user_id = options["publicKey"]["user"]["id"]
-    challenge = options["publicKey"]["challenge"]
-    challenge_expiry_time = options["challengeTimeoutDateTime"]
-
-    # Create the creential on the YubiKey
-    (
-        att,
-        clientData,
-        credId,
-        extn,
-    ) = create_credentials_on_security_key(
-        user_id, challenge, user_display_name, user_name
+    click.secho(
+        f"Completed {sum(results.values())} of {len(results)} enrollment(s) from {source}."
     )
 
-    # Create the credential in Microsoft Entra ID
-    serial_number = read_serial_number()
-    activated, auth_method = create_and_activate_fido_method(
-        credId,
-        extn,
-        user_name,
-        att,
-        clientData,
-        serial_number,
-        access_token,
+
+# Set variable to control how many finished jobs the enrollment service keeps (the oldest are forgotten)
+service_job_history = 1000
+
+
+# Function to create the enrollment service of the 'serve' command
+def create_enrollment_service():
+    """
+    Creates the enrollment service running jobs on the YubiKeys attached to the station (see EnrollmentService).
+
+    Returns:
+        EnrollmentService: The enrollment service (not yet started), recording enrollments in the ledger.
+    """
+    return EnrollmentService(
+        device_watcher,
+        open_ledger(),
+        telemetry,
+        enroll=enroll_on_station,
+        resume=resume_on_station,
+        fetch_user=fetch_user,
+        is_enrollable=is_enrollable,
+        bind_only=bind_only,
+        job_history=service_job_history,
     )
 
-    
-    # Force PIN change & set Minimum PIN lenght
-    banner()
-    pin_change = False
-    nfc_restricted = False
-
-    
-    device = s.single()
-    with device.fido() as connection:
-        ctap = Ctap2(connection)
-
-        if ctap.info.options.get("setMinPINLength") and click.confirm("Force user to change PIN on first use?", default=True):
-            client_pin = ClientPin(ctap)
-            token = client_pin.get_pin_token(
-                pin, ClientPin.PERMISSION.AUTHENTICATOR_CFG
-            )
-            config = Config(ctap, client_pin.protocol, token)
-            #config.set_min_pin_length(force_change_pin=True)
-            # Set minimum PIN length and force PIN change
-            config.set_min_pin_length(min_pin_length=pin_length, force_change_pin=True)
 
-            # Set attribute for CSV output file
-            pin_change = True
-            banner()
-            click.pause(
-                "PIN set to expire on first use (press any key to continue...)"
-            )
+# Set variable to control the file benchmark results are appended to
+benchmark_file = "benchmark.jsonl"
 
-    
-        # Enable Secure Transport Mode (restricted NFC)
-        banner()
-        session = ManagementSession(connection)
-        info = session.read_device_info()
-        if info.version >= (5, 7) and click.confirm("Configure Secure Transport Mode?", default=True):
-            config = DeviceConfig({}, None, None, None)
-            config.nfc_restricted = True
-            lock_code = None
-            
-            session.write_device_config(config, False, lock_code)
-            # Set attribute for CSV output file
-            nfc_restricted = True
-            banner()
-            click.pause(
-                "NFC disabled until powered over USB (press any key to continue...)"
-                )
+# Function to time every stage of programming and registering one YubiKey
+def benchmark_enrollment(key, user_principal_name, timings, configure=True, cleanup=False):
+    """
+    Programs and registers one YubiKey like enroll_on_station(), timing each stage.
+
+    The cached access token is used, as in an enrollment (token acquisition is timed once per run by the
+    'benchmark' command). Stages that do not apply to the YubiKey (a reset if no PIN is set, firmware 5.7
+    features) are not timed.
+
+    Args:
+        key (KeySession): The session with the YubiKey.
+        user_principal_name (str): The User Principal Name of the user to register the YubiKey for.
+        timings (dict): Dictionary mapping stage names to lists of durations in seconds, appended to.
+        configure (bool, optional): Whether to force a PIN change and enable Secure Transport Mode. Default is True.
+        cleanup (bool, optional): Whether to delete the registered FIDO2 method again (untimed). Default is False.
+    """
+    @contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        yield
+        timings.setdefault(name, []).append(time.perf_counter() - start)
 
+    serial_number = key.serial_number
+    started = time.perf_counter()
 
-    # Write CSV output file containing relevant attributes
-    write_csv()
+    with stage("get_user_id"):
+        user_profile, status_code = fetch_user(user_principal_name)
+    if user_profile is None:
+        raise click.ClickException(f"Could not find user '{user_principal_name}' (HTTP {status_code})")
 
-    # Inform user on completion
-    banner()
-    click.pause(f"Completed configuration for '{user_display_name}' (press any key to continue...)")
-    
-    
+    with stage("creation_options"):
+        status, options = get_fido2_creation_options(user_profile["id"])
+    if not status:
+        raise click.ClickException("Failed to retrieve credential creation options")
+
+    if key.ctap.info.options.get("clientPin"):
+        with stage("reset"):
+            reset_yubikey_on_station(key)
+
+    pin = generate_random_pin()
+    with stage("set_pin"):
+        set_fido_pin(pin, key, reset=reset_yubikey_on_station)
+
+    with stage("make_credential"):
+        att, clientData, credId, extn = create_credentials_on_security_key(
+            key,
+            options["publicKey"]["user"]["id"],
+            options["publicKey"]["challenge"],
+            user_profile["displayName"],
+            user_profile["userPrincipalName"],
+            CliInteraction(pin, serial_number),
+        )
+
+    with stage("activate"):
+        activated, auth_method = create_and_activate_fido_method(
+            credId, extn, user_profile["userPrincipalName"], att, clientData, serial_number
+        )
+    if not activated:
+        raise click.ClickException("Failed to register the YubiKey in Microsoft Entra ID")
+
+    try:
+        if configure and key.ctap.info.options.get("setMinPINLength"):
+            with stage("min_pin_length"):
+                force_pin_change(key, pin)
+
+        if configure and key.info.version >= (5, 7):
+            with stage("secure_transport"):
+                enable_secure_transport_mode(key)
+
+        timings.setdefault("total", []).append(time.perf_counter() - started)
+    finally:
+        # Do not leave an authenticator registered for the user per run of the benchmark
+        if cleanup:
+            enrollment = {"upn": user_profile["userPrincipalName"], "auth_method": auth_method}
+            for enrollment, status_code in revoke_fido2_methods([enrollment]):
+                if status_code not in (204, 404):
+                    click.secho(f"🛑 Failed to delete the FIDO2 method '{auth_method}' (HTTP {status_code}).")
+
+
+# Function to replace the YubiKeys and Microsoft Graph API with simulated ones
+def start_simulation(count, slots=1, pin=None, latency=0.0, touch_delay=0.0):
+    """
+    Replaces the attached YubiKeys with simulated ones and Microsoft Graph API with a local mock (see simulator.py).
+
+    The simulated YubiKeys are recorded in a separate ledger and output file (simulation.db and simulation.csv).
+
+    Args:
+        count (int): The number of simulated YubiKeys to enroll.
+        slots (int, optional): The number of simulated YubiKeys inserted at the same time. Default is 1.
+        pin (str, optional): A PIN already set on the simulated YubiKeys (so that they are reset). Default is no PIN.
+        latency (float, optional): Seconds each response of the mock of Microsoft Graph API is delayed. Default is 0.
+        touch_delay (float, optional): Seconds the simulated operator takes to touch a YubiKey. Default is 0.
+
+    Returns:
+        dict: A config pointing at the mock of Microsoft Graph API (see load_config()).
+    """
+    global ledger_file, output_file
+    import simulator
+
+    ledger_file = "simulation.db"
+    output_file = "simulation.csv"
+    use_device_backend(
+        simulator.SimulatedStation(count, slots=slots, pin=pin, touch_delay=touch_delay)
+    )
+    return simulator.MockGraphServer(group_size=count, latency=latency).start().config()
+
+
+@click.group(invoke_without_command=True)
+@click.option(
+    "--multi",
+    is_flag=True,
+    help="Enroll all YubiKeys attached to the station in parallel.",
+)
+@click.option(
+    "--manifest",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Enroll the users listed in a CSV or JSONL manifest file without prompting.",
+)
+@click.option(
+    "--group",
+    "groups",
+    multiple=True,
+    metavar="GROUP",
+    help="Enroll the members of a Microsoft Entra ID group (object ID or display name) without prompting. Repeatable.",
+)
+@click.option(
+    "--coordinator",
+    metavar="LOCATION",
+    help="Enroll users leased from a coordinator (see the 'coordinator' command) without prompting: "
+    "the path to a shared coordinator database or the URL of a coordinator service.",
+)
+@click.option(
+    "--simulate",
+    type=click.IntRange(min=1),
+    metavar="COUNT",
+    help="Enroll COUNT simulated YubiKeys against a local mock of Microsoft Graph API (no hardware or tenant needed). "
+    "Also applies to the 'serve' command.",
+)
+@click.option(
+    "--offline",
+    is_flag=True,
+    help="Enroll the users in the manifest without network, using creation options stored by the 'prefetch' command.",
+)
+@click.option(
+    "--bind",
+    is_flag=True,
+    help="Only enroll YubiKeys prepped with the 'prep' command (which skips their reset and PIN).",
+)
+@click.option(
+    "--events",
+    "events_file",
+    type=click.Path(dir_okay=False),
+    help="Append a JSON Lines event for every enrollment stage and request to Microsoft Graph API to this file.",
+)
+@click.option(
+    "--metrics",
+    "metrics_file",
+    type=click.Path(dir_okay=False),
+    help="Write enrollment and Microsoft Graph API metrics in the Prometheus text format to this file.",
+)
+@click.pass_context
+def main(ctx, multi, manifest, groups, coordinator, simulate, offline, bind, events_file, metrics_file):
+    """
+    Security Key Enrollment-On-Behalf-Of (EOBO) for Microsoft Entra ID.
+
+    Without a command, YubiKeys are programmed and registered for users interactively.
+    """
+    telemetry.events_file = events_file
+    telemetry.metrics_file = metrics_file
+    ctx.ensure_object(dict)["simulate"] = simulate
+
+    if ctx.invoked_subcommand is not None:
+        return
+    if offline and not manifest:
+        raise click.UsageError("--offline requires --manifest")
+    if sum(map(bool, (manifest, groups, coordinator))) > 1:
+        raise click.UsageError("--manifest, --group and --coordinator cannot be combined")
+
+    global bind_only
+    bind_only = bind
+
+    if simulate:
+        config = start_simulation(simulate, slots=simulate if multi else 1)
+    else:
+        check_administrator()
+        config = load_config()
+    open_ledger()
+    if offline:
+        # Credentials are queued for upload instead of being registered (see RegistrationQueue.upload())
+        creation_options_cache.offline = True
+    else:
+        connect_to_graph(config)
+        registration_queue.start()
+
+    if manifest or groups or coordinator:
+        jobs = LeasedJobs(open_coordinator(coordinator), ledger, telemetry.station) if coordinator else None
+        try:
+            batch_registration(manifest, multi, groups, jobs)
+        finally:
+            if jobs:
+                jobs.close()
+        telemetry.write_metrics()
+        pending = ledger.registrations.queued("pending") + ledger.registrations.queued("offline")
+        if pending:
+            click.secho(f"⏳ {len(pending)} registration(s) still queued, run the 'queue --drain' command to upload them.")
+        return
+
+    # Refresh the cache of users typed in at the prompt (see sync_directory())
+    if directory_cache and not multi:
+        sync_directory_in_background()
 
-def main():
     while True:
-        # Program a YubiKey
-        yubikey_eob_registration(Config)
+        # Program a YubiKey (or all attached YubiKeys)
+        if multi:
+            multi_device_registration()
+        else:
+            yubikey_eob_registration(config)
 
         # Ask the user if they want to program another YubiKey
         banner()
         if not click.confirm("Do you want to enroll another user?", default=False):
+            telemetry.write_metrics()
+
+            # Warn about registrations that are still to be retried
+            pending = ledger.registrations.queued("pending")
+            if pending:
+                banner()
+                click.pause(
+                    f"⏳ {len(pending)} registration(s) still queued, run the 'queue --drain' command "
+                    "to retry them (press any key to exit...)"
+                )
+
             # Exit program in 3 seconds
             for i in range(3, 0, -1):  # Countdown from 3 seconds
                 banner()
@@ -1020,6 +3006,473 @@ def main():
             sys.exit(1)
 
 
+@main.command()
+@click.argument("csv_file", default=output_file, type=click.Path(dir_okay=False))
+@click.option(
+    "--method-ids",
+    is_flag=True,
+    help="Add a 'FIDO2 method ID' column with the ID of each security key in Microsoft Entra ID.",
+)
+@click.option(
+    "--registration-status",
+    is_flag=True,
+    help="Add a 'Registration' column with the status of each security key's registration in Microsoft Entra ID "
+    "(including those whose registration failed or expired).",
+)
+def export(csv_file, method_ids, registration_status):
+    """
+    Export all programmed YubiKeys to a CSV file (default: output.csv).
+    """
+    count = open_ledger().export_csv(csv_file, method_ids, registration_status)
+    click.secho(f"Exported {count} YubiKey(s) to '{csv_file}'.")
+
+
+@main.command()
+@click.argument("manifest_file", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--challenge-timeout",
+    "timeout",
+    type=click.IntRange(5, 43200),
+    help="Minutes the challenges are valid (default: challenge_timeout in config.json, or 5). "
+    "Credentials must be uploaded within this time.",
+)
+def prefetch(manifest_file, timeout):
+    """
+    Fetch credential creation options for the users in a manifest file, for offline enrollment (--offline).
+    """
+    config = load_config()
+    open_ledger()
+    connect_to_graph(config)
+
+    # Returns the challenge timeout of the stored options, or None if they could not be fetched
+    def fetch(user_profile):
+        status, options = get_fido2_creation_options(user_profile["id"], timeout)
+        if not status:
+            return None
+        ledger.creation_options.store(user_profile, options)
+        return options["challengeTimeoutDateTime"]
+
+    entries = [entry for entry in read_manifest(manifest_file) if not ledger.has_user(entry["UPN"])]
+    user_profiles = []
+    for user_principal_name, user_profile, status_code, methods in resolve_users(entry["UPN"] for entry in entries):
+        if user_profile is None:
+            click.secho(f"🛑 '{user_principal_name}': user not found (HTTP {status_code}).")
+        else:
+            user_profiles.append(user_profile)
+
+    stored = []
+    for user_profile, expiry in zip(user_profiles, graph_executor.map(fetch, user_profiles)):
+        if expiry is None:
+            click.secho(f"🛑 '{user_profile['userPrincipalName']}': failed to retrieve credential creation options.")
+        else:
+            stored.append(expiry)
+    click.secho(f"Stored creation options for {len(stored)} of {len(entries)} user(s).")
+    if stored:
+        click.secho(f"Upload the credentials (with the 'queue --drain' command) before {min(stored)}.")
+
+
+@main.command()
+@click.option("--count", type=click.IntRange(min=1), help="Stop after prepping this many YubiKeys (default: until interrupted).")
+@click.option("--list", "show", is_flag=True, help="List the prepped YubiKeys not yet enrolled instead.")
+def prep(count, show):
+    """
+    Prepare YubiKeys (reset and PIN) at a USB hub, to be enrolled in seconds later (--bind).
+    """
+    open_ledger()
+    if show:
+        inventory = ledger.inventory.prepped()
+        for prepped in inventory:
+            capabilities = ", ".join(name for name, supported in prepped["capabilities"].items() if supported)
+            click.secho(
+                f"{prepped['serial_number']}  {prepped['model']} ({prepped['firmware']})  "
+                f"{capabilities or '-'}  {prepped['prepped_at']}"
+            )
+        click.secho(f"{len(inventory)} prepped YubiKey(s) not yet enrolled.")
+        return
+
+    check_administrator()
+
+    # YubiKeys enrolled, prepped or with an unfinished enrollment are left alone
+    def accept(serial_number):
+        return not (
+            ledger.has_serial_number(serial_number)
+            or ledger.inventory.prepped(serial_number)
+            or ledger.journal_state(serial_number)
+        )
+
+    banner()
+    prepped = 0
+    while count is None or prepped < count:
+        click.secho("Insert YubiKey(s) to prep...")
+        devices = wait_for_new_yubikeys(multi=True, accept=accept)
+        if count is not None:
+            devices = devices[:count - prepped]
+
+        with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+            futures = {executor.submit(prep_on_station, device): device for device in devices}
+            for future in as_completed(futures):
+                serial_number = futures[future].info.serial
+                try:
+                    future.result()
+                    prepped += 1
+                except Exception as e:
+                    station_echo(serial_number, f"🛑 Prep failed: {e}")
+
+        click.secho(f"{prepped} YubiKey(s) prepped. Remove prepped YubiKey(s)...")
+        device_watcher.wait_for_removal([device.info.serial for device in devices])
+    telemetry.write_metrics()
+
+
+@main.command()
+@click.option("--full", is_flag=True, help="Fetch all users again instead of the changes since the last synchronisation.")
+def directory(full):
+    """
+    Synchronise the cache of users used to validate and complete UPNs at the prompt.
+    """
+    config = load_config()
+    open_ledger()
+    connect_to_graph(config)
+
+    synced, result = sync_directory(full)
+    if synced:
+        click.secho(f"Synchronised {result} change(s), {ledger.directory.size()} user(s) cached.")
+    else:
+        click.secho(f"🛑 Failed to synchronise users (HTTP {result}).")
+
+
+@main.command()
+@click.option("--drain", is_flag=True, help="Retry all pending registrations and upload credentials created offline now.")
+@click.option("--all", "show_all", is_flag=True, help="Also show registrations that have completed.")
+def queue(drain, show_all):
+    """
+    Show (and drain) the queue of registrations in Microsoft Entra ID that failed and are retried.
+
+    With --drain, all pending registrations and the credentials created in offline mode are uploaded at once.
+    """
+    open_ledger()
+    if drain:
+        connect_to_graph(load_config())
+        attempted = registration_queue.upload()
+        registered = sum(registration["status"] == "registered" for registration in attempted)
+        click.secho(f"Registered {registered} of {len(attempted)} queued registration(s).")
+
+    registrations = [
+        registration for registration in ledger.registrations.queued()
+        if show_all or registration["status"] != "registered"
+    ]
+    if not registrations:
+        click.secho("No queued registrations.")
+        return
+    click.secho(f"{'Serial number':<14} {'UPN':<40} {'Status':<11} {'Attempts':>8}  {'Next attempt':<19}  Last error")
+    for registration in registrations:
+        next_attempt = ""
+        if registration["status"] == "pending":
+            next_attempt = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(registration["next_attempt"]))
+        click.secho(
+            f"{registration['serial_number']:<14} {registration['upn']:<40} {registration['status']:<11} "
+            f"{registration['attempts']:>8}  {next_attempt:<19}  {registration['last_error'] or ''}"
+        )
+
+
+@main.command()
+@click.option("--host", default="127.0.0.1", show_default=True, help="Address to listen on.")
+@click.option("--port", type=click.IntRange(0, 65535), default=8765, show_default=True, help="Port to listen on.")
+@click.option(
+    "--token",
+    envvar="SK_ENTRA_ID_TOKEN",
+    help="Require this bearer token on every request (required when not listening on localhost).",
+)
+@click.pass_context
+def serve(ctx, host, port, token):
+    """
+    Run as a service enrolling the jobs submitted to a local HTTP API.
+
+    The token for Microsoft Graph API, the connections to it and the watcher of attached YubiKeys are kept warm
+    between enrollments. Submit a job with POST /jobs, follow it with GET /jobs/{id}/events.
+    """
+    try:
+        check_listen_address(host, token)
+    except ValueError as e:
+        raise click.UsageError(f"{e} Give --token (or set SK_ENTRA_ID_TOKEN).")
+    simulate = ctx.obj.get("simulate")
+    if simulate:
+        config = start_simulation(simulate, slots=simulate)
+    else:
+        check_administrator()
+        config = load_config()
+    open_ledger()
+    connect_to_graph(config)
+    registration_queue.start()
+    if directory_cache:
+        sync_directory_in_background()
+
+    service = create_enrollment_service()
+    station_listeners.append(service.publish)
+    service.start()
+    server = create_api_server(service, host, port, token)
+    click.secho(f"Listening on http://{host}:{server.server_address[1]} (press Ctrl+C to stop)...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        telemetry.write_metrics()
+
+
+@main.group("coordinator")
+@click.option(
+    "--location",
+    default="coordinator.db",
+    show_default=True,
+    help="Coordinator database (e.g., on a share all stations can write to), or URL of a coordinator service.",
+)
+@click.pass_context
+def coordinator_command(ctx, location):
+    """
+    Distribute the users to enroll to several stations (run with --coordinator) and merge their enrollments.
+    """
+    ctx.obj["location"] = location
+
+
+@coordinator_command.command("add")
+@click.argument("manifest_file", type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def coordinator_add(ctx, manifest_file):
+    """
+    Add the users listed in a manifest file as jobs (users with a failed job are queued again).
+    """
+    added = open_coordinator(ctx.obj["location"]).add(read_manifest(manifest_file))
+    click.secho(f"Added {added} job(s).")
+
+
+@coordinator_command.command("status")
+@click.pass_context
+def coordinator_status(ctx):
+    """
+    Show the progress of the jobs, the enrollments by station and the failed jobs.
+    """
+    status = open_coordinator(ctx.obj["location"]).status()
+    click.secho(", ".join(f"{count} {state}" for state, count in sorted(status["jobs"].items())) or "No jobs.")
+    for station, count in sorted(status["stations"].items()):
+        click.secho(f"{station:<30} {count:>6} enrollment(s)")
+    for job in status["failed"]:
+        click.secho(f"🛑 {job['upn']} ({job['station']}): {job['error']}")
+
+
+@coordinator_command.command("export")
+@click.argument("csv_file", default="coordinator.csv", type=click.Path(dir_okay=False))
+@click.option(
+    "--pins",
+    is_flag=True,
+    help="Include the PINs (a coordinator service only returns them when it requires a token).",
+)
+@click.pass_context
+def coordinator_export(ctx, csv_file, pins):
+    """
+    Export the enrollments of all stations to a CSV file (default: coordinator.csv).
+    """
+    enrollments = open_coordinator(ctx.obj["location"]).enrollments(pins)
+    with open(csv_file, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=csv_headers + ['FIDO2 method ID', 'Station'])
+        writer.writeheader()
+        for enrollment in enrollments:
+            writer.writerow({
+                'Name': enrollment['name'],
+                'UPN': enrollment['upn'],
+                'Model': enrollment['model'],
+                'Serial number': enrollment['serial_number'],
+                'PIN': enrollment.get('pin', ''),
+                'PIN change required': bool(enrollment['pin_change']),
+                'Secure Transport Mode': bool(enrollment['nfc_restricted']),
+                'FIDO2 method ID': enrollment['auth_method'] or '',
+                'Station': enrollment['station'],
+            })
+    click.secho(f"Exported {len(enrollments)} YubiKey(s) to '{csv_file}'.")
+
+
+@coordinator_command.command("serve")
+@click.option(
+    "--host",
+    default="127.0.0.1",
+    show_default=True,
+    help="Address to listen on (e.g., 0.0.0.0 to serve other stations, which requires --token).",
+)
+@click.option("--port", type=click.IntRange(0, 65535), default=8766, show_default=True, help="Port to listen on.")
+@click.option("--token", envvar="SK_ENTRA_ID_TOKEN", help="Require this bearer token on every request.")
+@click.pass_context
+def coordinator_serve(ctx, host, port, token):
+    """
+    Serve the coordinator database to the stations over HTTP.
+    """
+    try:
+        server = create_coordinator_server(Coordinator(ctx.obj["location"]), host, port, token)
+    except ValueError as e:
+        raise click.UsageError(f"{e} Give --token (or set SK_ENTRA_ID_TOKEN).")
+    click.secho(f"Coordinator listening on http://{host}:{server.server_address[1]} (press Ctrl+C to stop)...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@main.command()
+@click.argument("serial_numbers", nargs=-1, type=int)
+@click.option(
+    "--file",
+    "serials_file",
+    type=click.File("r", encoding="utf8"),
+    help="Read the serial numbers from a file (one per line, or a CSV file with a 'Serial number' column).",
+)
+@click.option("--yes", is_flag=True, help="Revoke without asking for confirmation.")
+def revoke(serial_numbers, serials_file, yes):
+    """
+    Delete the FIDO2 methods of lost or stolen YubiKeys (by serial number) from Microsoft Entra ID.
+
+    The FIDO2 method of each YubiKey is taken from the ledger. For YubiKeys enrolled before the ID of the FIDO2 method
+    was recorded, the FIDO2 methods of the user are listed and matched by the serial number in their display name.
+    """
+    serial_numbers = list(serial_numbers)
+    if serials_file:
+        lines = serials_file.read().splitlines()
+        if lines and "Serial number" in lines[0]:
+            lines = [row.get("Serial number") or "" for row in csv.DictReader(lines)]
+        serial_numbers += [int(line.strip()) for line in lines if line.strip().isdigit()]
+    if not serial_numbers:
+        raise click.UsageError("Give the serial numbers of the YubiKeys to revoke (or --file)")
+
+    open_ledger()
+    enrollments = ledger.enrollments_by_serial_number(serial_numbers)
+    for serial_number in dict.fromkeys(serial_numbers):
+        if serial_number not in enrollments:
+            click.secho(f"🛑 YubiKey {serial_number} is not recorded in '{ledger_file}', skipping.")
+    if not enrollments:
+        return
+    if not yes:
+        click.confirm(
+            f"The FIDO2 methods of {len(enrollments)} YubiKey(s) will be deleted from Microsoft Entra ID. "
+            "Do you want to continue?",
+            abort=True,
+        )
+    connect_to_graph(load_config())
+
+    # Find the FIDO2 methods not recorded in the ledger by their display name (see create_and_activate_fido_method())
+    revocations = [enrollment for enrollment in enrollments.values() if enrollment["auth_method"]]
+    unrecorded = {}
+    for enrollment in enrollments.values():
+        if not enrollment["auth_method"]:
+            unrecorded.setdefault(enrollment["upn"].lower(), []).append(enrollment)
+    for user_principal_name, user_profile, status_code, methods in resolve_users(
+        [records[0]["upn"] for records in unrecorded.values()], fido2_methods=True
+    ):
+        for enrollment in unrecorded[user_principal_name.lower()]:
+            matches = [
+                method["id"] for method in methods or ()
+                if method.get("displayName") == f"YubiKey with S/N: {enrollment['serial_number']}"
+            ]
+            if methods is None:
+                click.secho(
+                    f"🛑 YubiKey {enrollment['serial_number']}: failed to list the FIDO2 methods of "
+                    f"'{user_principal_name}' (HTTP {status_code})."
+                )
+            elif not matches:
+                click.secho(f"YubiKey {enrollment['serial_number']}: no FIDO2 method registered for '{user_principal_name}'.")
+                ledger.revocations.record(enrollment["serial_number"], enrollment["upn"], None)
+                ledger.remove(enrollment["serial_number"])
+            revocations += [{**enrollment, "auth_method": method_id} for method_id in matches]
+
+    revoked = set()
+    for enrollment, status_code in revoke_fido2_methods(revocations):
+        if status_code in (204, 404):
+            ledger.revocations.record(enrollment["serial_number"], enrollment["upn"], enrollment["auth_method"])
+            ledger.remove(enrollment["serial_number"])
+            revoked.add(enrollment["serial_number"])
+        else:
+            click.secho(
+                f"🛑 YubiKey {enrollment['serial_number']}: failed to delete the FIDO2 method of "
+                f"'{enrollment['upn']}' (HTTP {status_code})."
+            )
+    telemetry.write_metrics()
+    click.secho(f"Revoked {len(revoked)} of {len(enrollments)} YubiKey(s).")
+
+
+@main.command()
+@click.option("--keys", "count", type=click.IntRange(min=1), default=20, show_default=True, help="Number of enrollments to time.")
+@click.option("--hardware", is_flag=True, help="Use the attached YubiKeys and the tenant in config.json instead of the simulator.")
+@click.option("--upn", help="User to register the YubiKeys for (required with --hardware).")
+@click.option("--latency", type=float, default=0.0, show_default=True, help="Simulated Microsoft Graph API round trip in seconds.")
+@click.option("--touch-delay", type=float, default=0.0, show_default=True, help="Simulated touch delay in seconds.")
+@click.option("--results", "results_file", default=benchmark_file, show_default=True, type=click.Path(dir_okay=False), help="File the results are appended to.")
+@click.option(
+    "--configure",
+    is_flag=True,
+    help="With --hardware, also time the forced PIN change and Secure Transport Mode (which are left on the YubiKeys).",
+)
+def benchmark(count, hardware, upn, latency, touch_delay, results_file, configure):
+    """
+    Time each stage of the enrollment, on the attached YubiKeys or simulated ones.
+
+    Simulated YubiKeys arrive with a PIN set, so that the reset is timed too. On hardware, the
+    YubiKeys are reset and registered for the given user, and the same YubiKey may be re-used
+    (the operator is asked to re-insert it for the reset). Each YubiKey is only reset once the operator
+    has confirmed its serial number. Each registration is deleted again once it has been timed, and the
+    forced PIN change and Secure Transport Mode are skipped unless --configure is given.
+    The access token is fetched once, before the enrollments, and timed as a phase of its own.
+    """
+    if hardware:
+        if not upn:
+            raise click.UsageError("--upn is required with --hardware")
+        check_administrator()
+        config = load_config()
+        click.confirm(
+            f"Attached YubiKeys will be reset and registered for '{upn}' (the registrations are deleted afterwards). "
+            "Do you want to continue?",
+            abort=True,
+        )
+        if configure:
+            click.confirm(
+                "The YubiKeys will also require a PIN change and have NFC restricted (Secure Transport Mode) "
+                "until the next reset. Do you want to continue?",
+                abort=True,
+            )
+    else:
+        config = start_simulation(count, pin=generate_random_pin(), latency=latency, touch_delay=touch_delay)
+        upn = upn or "benchmark.user@simulated.onmicrosoft.com"
+    connect_to_graph(config).result()
+
+    # Time the token acquisition once (the enrollments use the cached token, as they do outside the benchmark)
+    graph.token_provider.invalidate(graph.token_provider.get_token())
+    start = time.perf_counter()
+    graph.token_provider.get_token()
+    timings = {"token": [time.perf_counter() - start]}
+
+    confirmed = set()
+    started = time.perf_counter()
+    for i in range(count):
+        click.secho(f"Enrollment {i + 1} of {count}...")
+        yubikeys = device_watcher.wait_until(lambda keys: any(serial is not None for serial in keys))
+        serial_number = min(serial for serial in yubikeys if serial is not None)
+        if hardware and serial_number not in confirmed:
+            # Never reset a YubiKey the operator did not mean to benchmark (e.g., one inserted by mistake)
+            click.confirm(
+                f"YubiKey {serial_number} ({yubikeys[serial_number].name}) will be reset. Do you want to continue?",
+                abort=True,
+            )
+            confirmed.add(serial_number)
+        device = yubikeys[serial_number]
+        with KeySession(device) as key:
+            benchmark_enrollment(key, upn, timings, configure=configure or not hardware, cleanup=hardware)
+    elapsed = time.perf_counter() - started
+
+    if hardware:
+        report_benchmark(timings, elapsed, "hardware", {}, results_file, __version__)
+    else:
+        settings = {"latency": latency, "touch_delay": touch_delay}
+        report_benchmark(timings, elapsed, "simulated", settings, results_file, __version__)
+
+
 # Run script
 if __name__ == "__main__":
     main()
@@ -0,0 +1,280 @@
+######################################################################
+# Telemetry of enrollments for sk-entra-id.py
+######################################################################
+# see readme.md for more info.
+#
+# Times the stages of enrollments and the requests to Microsoft Graph API, writing them as events
+# (JSON Lines) and metrics (Prometheus text format) labelled with the station.
+#
+# BSD 2-Clause License
+# Copyright (c) 2025, swjm.blog
+######################################################################
+
+# Standard Library Imports
+import datetime
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+
+# Timing spans, events and metrics of enrollments
+class Telemetry:
+    """
+    Times the stages of enrollments and the requests to Microsoft Graph API.
+
+    Each stage (see span()) and each request to Microsoft Graph API (see graph_request()) is written
+    as an event to a JSON Lines file and counted in metrics (counters and histograms), which are written
+    to a file in the Prometheus text format (e.g., for the textfile collector of the Prometheus node exporter)
+    whenever an enrollment completes. Every event and metric is labelled with the station (host name), so that
+    the files of several stations can be collected side by side.
+
+    Events carry the serial number of the YubiKey and a hash of the User Principal Name instead of the
+    User Principal Name itself. Both are taken from the fields of the enclosing spans (see context()).
+    """
+
+    # Upper bounds of the histogram buckets in seconds
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    # Metrics written to the metrics file
+    metrics = {
+        "sk_entra_id_stage_duration_seconds": ("histogram", "Duration of enrollment stages."),
+        "sk_entra_id_stages_total": ("counter", "Enrollment stages by outcome."),
+        "sk_entra_id_graph_request_duration_seconds": ("histogram", "Duration of requests to Microsoft Graph API, including retries."),
+        "sk_entra_id_graph_requests_total": ("counter", "Requests to Microsoft Graph API by HTTP status."),
+        "sk_entra_id_graph_retries_total": ("counter", "Retries of requests to Microsoft Graph API."),
+    }
+
+    # Path segments following which an ID (or User Principal Name) is replaced in the endpoint label
+    id_collections = ("users", "groups", "members", "fido2Methods", "methods")
+    id_exceptions = ("creationOptions", "delta", "$count")
+
+    def __init__(self, events_file=None, metrics_file=None, station=None):
+        """
+        Args:
+            events_file (str, optional): Path to the JSON Lines file events are appended to. Default is no events.
+            metrics_file (str, optional): Path to the file metrics are written to. Default is no metrics file.
+            station (str, optional): Name of the station. Default is the host name.
+        """
+        self.events_file = events_file
+        self.metrics_file = metrics_file
+        self.station = station or socket.gethostname()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._events = None
+        self._series = {}
+
+    def _fields(self):
+        return getattr(self._local, "fields", {})
+
+    @contextmanager
+    def context(self, **fields):
+        """
+        Adds fields (e.g., serial=..., upn=...) to all events of the current thread within the block.
+        """
+        previous = self._fields()
+        self._local.fields = {**previous, **fields}
+        try:
+            yield
+        finally:
+            self._local.fields = previous
+
+    def bind(self, **fields):
+        """
+        Adds fields to all further events of the current thread (until the enclosing span or context ends).
+        """
+        self._local.fields = {**self._fields(), **fields}
+
+    def propagate(self, function):
+        """
+        Wraps a function submitted to another thread, so that its events carry the fields of the current thread.
+
+        Args:
+            function (callable): The function to wrap.
+
+        Returns:
+            callable: The wrapped function.
+        """
+        fields = self._fields()
+
+        def run(*args, **kwargs):
+            with self.context(**fields):
+                return function(*args, **kwargs)
+
+        return run
+
+    @contextmanager
+    def span(self, stage, **fields):
+        """
+        Times a stage of an enrollment and records it when the block ends.
+
+        Yields a dict to which the block may add fields for the event; setting 'outcome' (default 'ok',
+        or 'error' if the block raises an exception) to e.g. 'failed' marks the stage as failed.
+        When the outermost span of a thread ends, the metrics file is written.
+
+        Args:
+            stage (str): The name of the stage.
+            **fields: Fields added to the events within the block (see context()).
+        """
+        previous = self._fields()
+        depth = getattr(self._local, "depth", 0)
+        self._local.fields = {**previous, **fields}
+        self._local.depth = depth + 1
+        event = {"stage": stage, "outcome": "ok"}
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException as e:
+            event["outcome"] = "error"
+            event["error"] = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self._record(event, duration)
+            self._observe("sk_entra_id_stage_duration_seconds", duration, stage=stage)
+            self._count("sk_entra_id_stages_total", stage=stage, outcome=event["outcome"])
+            self._local.fields = previous
+            self._local.depth = depth
+            if depth == 0:
+                self.write_metrics()
+
+    def graph_request(self, method, url, response, attempts, duration):
+        """
+        Records a request to Microsoft Graph API (or its token endpoint).
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The request URL.
+            response (requests.Response): The response of the last attempt, or None if no response was received.
+            attempts (int): The number of times the request was sent (1 if it was not retried).
+            duration (float): Seconds from the first attempt until the last response.
+        """
+        endpoint = self.endpoint(url)
+        status = response.status_code if response is not None else None
+        self._record(
+            {"stage": "graph", "method": method, "endpoint": endpoint, "status": status, "attempts": attempts},
+            duration,
+        )
+        self._observe("sk_entra_id_graph_request_duration_seconds", duration, method=method, endpoint=endpoint)
+        self._count(
+            "sk_entra_id_graph_requests_total",
+            method=method, endpoint=endpoint, status=str(status) if status else "error",
+        )
+        if attempts > 1:
+            self._count("sk_entra_id_graph_retries_total", attempts - 1, method=method, endpoint=endpoint)
+
+    def endpoint(self, url):
+        """
+        Returns the endpoint of a request URL without version, query and IDs (e.g., 'users/{id}').
+
+        Args:
+            url (str): The request URL.
+
+        Returns:
+            str: The endpoint.
+        """
+        segments = urllib.parse.urlsplit(url).path.strip("/").split("/")
+        if segments[-1:] == ["token"]:
+            return "token"
+        for version in ("beta", "v1.0"):
+            if version in segments:
+                segments = segments[segments.index(version) + 1:]
+                break
+        endpoint = []
+        for segment in segments:
+            if endpoint[-1:] and endpoint[-1] in self.id_collections and segment not in self.id_exceptions:
+                segment = "{id}"
+            endpoint.append(segment)
+        return "/".join(endpoint)
+
+    def _record(self, event, duration):
+        if not self.events_file:
+            return
+        fields = self._fields()
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "station": self.station,
+            "serial": fields.get("serial"),
+            "upn_hash": self.hash_upn(fields["upn"]) if fields.get("upn") else None,
+            **event,
+            "duration": round(duration, 6),
+        }
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            if self._events is None:
+                self._events = open(self.events_file, "a", encoding="utf8")
+            self._events.write(line)
+            self._events.flush()
+
+    def hash_upn(self, user_principal_name):
+        """
+        Returns a short hash of a User Principal Name identifying the user in events.
+        """
+        return hashlib.sha256(user_principal_name.strip().lower().encode()).hexdigest()[:16]
+
+    def _count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+    def _observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def format_metrics(self):
+        """
+        Returns the metrics in the Prometheus text format.
+
+        Returns:
+            str: The metrics.
+        """
+        def series(name, labels, suffix="", **extra):
+            pairs = [("station", self.station), *labels, *extra.items()]
+            escaped = ",".join(
+                '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for k, v in pairs
+            )
+            return f"{name}{suffix}{{{escaped}}}"
+
+        lines = []
+        with self._lock:
+            for name, (kind, description) in self.metrics.items():
+                entries = sorted((labels, value) for (n, labels), value in self._series.items() if n == name)
+                if not entries:
+                    continue
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in entries:
+                    if kind == "counter":
+                        lines.append(f"{series(name, labels)} {value}")
+                        continue
+                    counts, total, count = value
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        lines.append(f"{series(name, labels, '_bucket', le=f'{bound:g}')} {bucket_count}")
+                    lines.append(f"{series(name, labels, '_bucket', le='+Inf')} {count}")
+                    lines.append(f"{series(name, labels, '_sum')} {total:.6f}")
+                    lines.append(f"{series(name, labels, '_count')} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self):
+        """
+        Writes the metrics to the metrics file (replacing it at once, so collectors never read a partial file).
+        """
+        if not self.metrics_file:
+            return
+        temporary_file = f"{self.metrics_file}.{os.getpid()}.tmp"
+        with self._write_lock:
+            with open(temporary_file, "w", encoding="utf8") as f:
+                f.write(self.format_metrics())
+            os.replace(temporary_file, self.metrics_file)
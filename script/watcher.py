@@ -0,0 +1,277 @@
+######################################################################
+# Watcher of attached YubiKeys for sk-entra-id.py
+######################################################################
+# see readme.md for more info.
+#
+# Keeps track of the YubiKeys attached to the station (re-scanning on device notifications from
+# the Linux kernel, or polling adaptively elsewhere) and wakes up threads waiting for a YubiKey
+# to be inserted or removed.
+#
+# BSD 2-Clause License
+# Copyright (c) 2025, swjm.blog
+######################################################################
+
+# Standard Library Imports
+import select
+import socket
+import sys
+import threading
+
+
+# Function to open a socket receiving device notifications from the Linux kernel
+def open_uevent_socket():
+    """
+    Opens a netlink socket receiving device (uevent) notifications from the Linux kernel.
+
+    Returns:
+        socket.socket: The socket, or None if not running on Linux or the socket cannot be opened.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        uevent_socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, 15)  # NETLINK_KOBJECT_UEVENT
+        uevent_socket.bind((0, 1))  # Multicast group of kernel uevents
+        return uevent_socket
+    except (AttributeError, OSError):
+        return None
+
+
+# Watcher reporting YubiKeys being inserted and removed
+class DeviceWatcher:
+    """
+    Keeps track of the YubiKeys attached to the station and wakes up waiting threads as soon as one is inserted or removed.
+
+    On Linux, the attached YubiKeys are re-scanned whenever the kernel reports a hidraw device being
+    added or removed (netlink uevents), with a few quick follow-up scans to cover the time udev needs to
+    grant access to a new device. The follow-up scans go on (backing off to max_interval) until a scan
+    has read every attached device. Elsewhere (or if the socket cannot be opened), the watcher polls
+    adaptively while threads are waiting for a change (see the wait_* methods): quickly right after a change
+    and then backing off to max_interval. While no thread is waiting, it only polls every idle_interval.
+
+    The watcher thread is started on first use.
+    """
+
+    def __init__(self, backend, min_interval=0.05, max_interval=0.5, idle_interval=5.0):
+        """
+        Args:
+            backend: The device backend listing the attached YubiKeys (see YubiKeyBackend in sk-entra-id.py).
+                May be replaced before the watcher thread is started.
+            min_interval (float, optional): Seconds between scans right after a change. Default is 0.05 seconds.
+            max_interval (float, optional): Maximum seconds between scans when polling. Default is 0.5 seconds.
+            idle_interval (float, optional): Seconds between scans without device notifications, or when polling while
+                no thread is waiting for a change. Default is 5 seconds.
+        """
+        self.backend = backend
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_interval = idle_interval
+        self._condition = threading.Condition()
+        self._yubikeys = {}
+        self._generation = 0
+        self._removals = {}
+        self._waiters = 0
+        self._wake = threading.Event()
+        self._thread = None
+        self._socket = None
+        self._scan_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the watcher thread (unless already started) and waits for the first scan.
+        """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._socket = self.backend.open_event_socket()
+            self._thread = threading.Thread(target=self._run, name="device-watcher", daemon=True)
+            self._thread.start()
+            self._condition.wait_for(lambda: self._generation > 0)
+
+    def snapshot(self):
+        """
+        Returns the YubiKeys currently attached.
+
+        Returns:
+            tuple: The generation (incremented on every change) and a dictionary mapping
+            serial numbers to YubiKey devices.
+        """
+        self.start()
+        with self._condition:
+            return self._generation, dict(self._yubikeys)
+
+    def wait_for_change(self, generation, timeout=None):
+        """
+        Waits until the attached YubiKeys differ from the given generation.
+
+        Args:
+            generation (int): The generation returned by snapshot().
+            timeout (float, optional): Maximum number of seconds to wait. Default is to wait forever.
+
+        Returns:
+            bool: True if the attached YubiKeys changed, False on timeout.
+        """
+        self.start()
+        with self._condition:
+            return self._wait_for(lambda: self._generation != generation, timeout)
+
+    def wait_until(self, predicate, timeout=None):
+        """
+        Waits until the attached YubiKeys satisfy a condition.
+
+        Args:
+            predicate (callable): Function taking the dictionary of attached YubiKeys and returning a boolean.
+            timeout (float, optional): Maximum number of seconds to wait. Default is to wait forever.
+
+        Returns:
+            dict: The attached YubiKeys satisfying the condition, or None on timeout.
+        """
+        self.start()
+        with self._condition:
+            if self._wait_for(lambda: predicate(self._yubikeys), timeout):
+                return dict(self._yubikeys)
+            return None
+
+    def removal_count(self, serial_number=None):
+        """
+        Returns how often a YubiKey has been removed, to be passed to wait_for_re_insert().
+
+        Args:
+            serial_number (int, optional): The serial number of the YubiKey. Default is any YubiKey.
+
+        Returns:
+            int: The number of removals seen so far.
+        """
+        self.start()
+        with self._condition:
+            if serial_number is None:
+                return sum(self._removals.values())
+            return self._removals.get(serial_number, 0)
+
+    def wait_for_re_insert(self, removals, serial_number=None, timeout=None):
+        """
+        Waits until a YubiKey has been removed (since removal_count() returned `removals`) and inserted again.
+
+        Comparing removal counts instead of waiting for the YubiKey to be absent means a removal is
+        not missed if the YubiKey is re-inserted before waiting starts.
+
+        Args:
+            removals (int): The removal count returned by removal_count() before asking for the re-insert.
+            serial_number (int, optional): The serial number of the YubiKey. Default is to wait for
+                any single YubiKey to be attached.
+            timeout (float, optional): Maximum number of seconds to wait. Default is to wait forever.
+
+        Returns:
+            ScriptingDevice: The re-inserted YubiKey, or None on timeout.
+        """
+        def re_inserted():
+            if serial_number is None:
+                return sum(self._removals.values()) > removals and len(self._yubikeys) == 1
+            return self._removals.get(serial_number, 0) > removals and serial_number in self._yubikeys
+
+        self.start()
+        with self._condition:
+            if not self._wait_for(re_inserted, timeout):
+                return None
+            if serial_number is None:
+                return next(iter(self._yubikeys.values()))
+            return self._yubikeys[serial_number]
+
+    def wait_for_insert(self, serial_number, timeout=None):
+        """
+        Waits until the YubiKey with the given serial number is attached.
+
+        Args:
+            serial_number (int): The serial number of the YubiKey.
+            timeout (float, optional): Maximum number of seconds to wait. Default is to wait forever.
+
+        Returns:
+            ScriptingDevice: The attached YubiKey, or None on timeout.
+        """
+        yubikeys = self.wait_until(lambda keys: serial_number in keys, timeout)
+        return yubikeys[serial_number] if yubikeys is not None else None
+
+    def wait_for_removal(self, serial_numbers, timeout=None):
+        """
+        Waits until none of the YubiKeys with the given serial numbers are attached.
+
+        Args:
+            serial_numbers (Iterable[int]): The serial numbers of the YubiKeys.
+            timeout (float, optional): Maximum number of seconds to wait. Default is to wait forever.
+
+        Returns:
+            bool: True if the YubiKeys were removed, False on timeout.
+        """
+        serial_numbers = set(serial_numbers)
+        return self.wait_until(lambda keys: not serial_numbers & set(keys), timeout) is not None
+
+    def rescan(self):
+        """
+        Re-scans the attached YubiKeys right away (e.g., when the device backend reports a change).
+        """
+        if self._thread is not None:
+            self._scan()
+
+    def _wait_for(self, predicate, timeout):
+        # Waits on the condition (held by the caller), waking the watcher thread up to poll quickly meanwhile
+        self._waiters += 1
+        self._wake.set()
+        try:
+            return self._condition.wait_for(predicate, timeout)
+        finally:
+            self._waiters -= 1
+
+    def _scan(self):
+        # Returns whether the attached YubiKeys changed, and whether every attached device could be read
+        with self._scan_lock:
+            try:
+                yubikeys = self.backend.list_yubikeys()
+            except Exception:
+                # E.g., the devices cannot be enumerated at the moment
+                return False, False
+            return self._update(yubikeys), not getattr(self.backend, "skipped", None)
+
+    def _update(self, yubikeys):
+        with self._condition:
+            before = {serial: device.fingerprint for serial, device in self._yubikeys.items()}
+            after = {serial: device.fingerprint for serial, device in yubikeys.items()}
+            if before == after and self._generation > 0:
+                return False
+            for serial_number in set(before) - set(after):
+                self._removals[serial_number] = self._removals.get(serial_number, 0) + 1
+            self._yubikeys = yubikeys
+            self._generation += 1
+            self._condition.notify_all()
+            return True
+
+    def _receive_hidraw_event(self, timeout):
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        hidraw_event = False
+        while readable:
+            try:
+                message = self._socket.recv(8192, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            hidraw_event = hidraw_event or b"SUBSYSTEM=hidraw" in message
+        return hidraw_event
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            changed, complete = self._scan()
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+
+            if self._socket is not None:
+                # Keep scanning quickly for a moment after an event (and until every device could be read),
+                # then wait for the next one
+                timeout = interval if interval < self.max_interval or not complete else self.idle_interval
+                if self._receive_hidraw_event(timeout):
+                    interval = self.min_interval
+            else:
+                # Poll quickly only while a thread is waiting for a change (or a device could not be read)
+                self._wake.clear()
+                with self._condition:
+                    waiting = self._waiters > 0
+                self._wake.wait(interval if waiting or not complete else self.idle_interval)
@@ -0,0 +1,93 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+script_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "script")
+sys.path.insert(0, script_dir)
+
+import graph  # noqa: E402
+import simulator  # noqa: E402
+
+
+@pytest.fixture
+def sk(tmp_path, monkeypatch):
+    """sk-entra-id.py, loaded afresh for each test (its state is kept in module globals), run in a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location("sk_entra_id", os.path.join(script_dir, "sk-entra-id.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.check_administrator = lambda: None
+    yield module
+    module.graph_executor.shutdown(wait=False)
+
+
+@pytest.fixture
+def server(sk):
+    """A mock of Microsoft Graph API, with sk-entra-id.py connected to it."""
+    server = simulator.MockGraphServer().start()
+    sk.connect_to_graph(server.config()).result()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def ledger(sk):
+    return sk.open_ledger()
+
+
+@pytest.fixture
+def station(sk):
+    """A station with three simulated YubiKeys (one inserted at a time) used by sk-entra-id.py."""
+    station = simulator.SimulatedStation(3)
+    sk.use_device_backend(station)
+    return station
+
+
+@pytest.fixture
+def no_retry_delay(sk, monkeypatch):
+    """Retries requests to Microsoft Graph API immediately. Returns the attempts passed to get_retry_delay()."""
+    attempts = []
+
+    def get_retry_delay(response, attempt, base=1, cap=60):
+        attempts.append(attempt)
+        return 0
+
+    monkeypatch.setattr(graph, "get_retry_delay", get_retry_delay)
+    return attempts
+
+
+def fail_requests(monkeypatch, server, status, method, suffix, times=None):
+    """
+    Makes the mock of Microsoft Graph API fail matching requests (also within JSON batch requests).
+
+    Args:
+        monkeypatch: The monkeypatch fixture.
+        server (MockGraphServer): The mock of Microsoft Graph API.
+        status (int): The HTTP status code of the failed responses.
+        method (str): The HTTP method of the requests to fail.
+        suffix (str): The end of the path of the requests to fail.
+        times (int, optional): How many requests to fail. Default is all of them.
+
+    Returns:
+        list: The paths of the failed requests.
+    """
+    failed = []
+    route = server._route
+
+    def fail(request_method, url, body):
+        if request_method == method and url.path.endswith(suffix) and (times is None or len(failed) < times):
+            failed.append(url.path)
+            return server._error(status, "Simulated", f"Simulated HTTP {status}.")
+        return route(request_method, url, body)
+
+    monkeypatch.setattr(server, "_route", fail)
+    return failed
+
+
+def start_enrollment(ledger, serial_number, upn, pin="1357"):
+    """Journals the start of an enrollment (as enroll_on_station() does) without the forced PIN change and Secure
+    Transport Mode, which stay on the YubiKey. Returns its state (see Ledger.journal_state())."""
+    ledger.journal(serial_number, "started", upn=upn, pin=pin, pin_change=False, nfc_restricted=False)
+    return ledger.journal_state(serial_number)
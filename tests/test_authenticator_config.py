@@ -0,0 +1,20 @@
+from conftest import start_enrollment
+
+
+def test_forced_pin_change(sk, server, ledger, station):
+    device = station.list_yubikeys()[station.attached[0].info.serial]
+    ledger.journal(
+        device.info.serial, "started", upn="alice@example.com", pin="1357", pin_change=True, nfc_restricted=False
+    )
+    with sk.KeySession(device) as key:
+        assert sk.continue_enrollment(key, ledger.journal_state(key.serial_number), sk.reset_yubikey_on_station, print)
+    assert device.authenticator.force_pin_change
+    assert device.authenticator.min_pin_length == sk.pin_length
+
+
+def test_no_forced_pin_change(sk, server, ledger, station):
+    device = station.list_yubikeys()[station.attached[0].info.serial]
+    state = start_enrollment(ledger, device.info.serial, "alice@example.com")
+    with sk.KeySession(device) as key:
+        assert sk.continue_enrollment(key, state, sk.reset_yubikey_on_station, print)
+    assert not device.authenticator.force_pin_change
@@ -0,0 +1,30 @@
+from click.testing import CliRunner
+
+
+def test_enrollments_reuse_the_token(sk, server, station):
+    timings = {}
+    for _ in range(2):
+        device = station.list_yubikeys()[station.attached[0].info.serial]
+        with sk.KeySession(device) as key:
+            sk.benchmark_enrollment(key, "alice@example.com", timings)
+    assert server.requests.count(("POST", f"/{server.tenant_id}/oauth2/v2.0/token")) == 1
+    assert len(timings["total"]) == 2
+    assert "token" not in timings
+
+
+def test_hardware_benchmark_confirms_each_yubikey(sk, server, station, monkeypatch):
+    monkeypatch.setattr(sk, "load_config", lambda config_file=None: server.config())
+    serial_number = station.attached[0].info.serial
+    result = CliRunner().invoke(
+        sk.main, ["benchmark", "--hardware", "--upn", "alice@example.com", "--keys", "1"], input="y\nn\n"
+    )
+    assert f"YubiKey {serial_number} (YubiKey 5 NFC) will be reset." in result.output
+    assert result.exit_code == 1
+    assert station.attached[0].authenticator.created == 0
+
+    result = CliRunner().invoke(
+        sk.main, ["benchmark", "--hardware", "--upn", "alice@example.com", "--keys", "1"], input="y\ny\n"
+    )
+    assert result.exception is None, result.output
+    assert station.removed[0].authenticator.created == 1
+    assert "token                 1" in result.output
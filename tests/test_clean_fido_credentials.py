@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+import simulator
+from conftest import start_enrollment
+
+
+@pytest.fixture
+def device(sk, server, ledger):
+    """A YubiKey enrolled for a user with the PIN 1357 (so it holds a discoverable credential). Tests open a session
+    of their own, which reads the CTAP2 info after they changed the simulated authenticator."""
+    station = simulator.SimulatedStation(1, pin="1357")
+    sk.use_device_backend(station)
+    device = station.list_yubikeys()[station.attached[0].info.serial]
+    state = start_enrollment(ledger, device.info.serial, "alice@example.com")
+    with sk.KeySession(device) as key:
+        assert sk.continue_enrollment(key, state, sk.reset_yubikey_on_station, print, resume=True)
+        assert len(device.authenticator.credentials) == 1
+        yield device
+
+
+def test_clean_with_known_pin(sk, device):
+    authenticator = device.authenticator
+    with sk.KeySession(device) as key:
+        assert sk.clean_fido_credentials(key, "2468", ["0000", "1357"])
+        assert authenticator.credentials == []
+        assert authenticator.pin_retries == 8
+        assert sk.verify_fido_pin("2468", key)
+
+
+def test_clean_after_forced_pin_change(sk, device):
+    authenticator = device.authenticator
+    authenticator.force_pin_change = True
+    with sk.KeySession(device) as key:
+        assert sk.clean_fido_credentials(key, "2468", ["1357"])
+        assert authenticator.credentials == []
+        assert not authenticator.force_pin_change
+        assert sk.verify_fido_pin("2468", key)
+
+
+def test_credentials_of_other_sites_are_kept(sk, device):
+    authenticator = device.authenticator
+    authenticator.credentials.append(
+        {**authenticator.credentials[0], "rp": {"id": "example.com"}, "credential_id": os.urandom(64)}
+    )
+    with sk.KeySession(device) as key:
+        assert not sk.clean_fido_credentials(key, "2468", ["1357"])
+        assert len(authenticator.credentials) == 2
+        assert sk.verify_fido_pin("1357", key)
+
+
+@pytest.mark.parametrize("setting, value", [("always_uv", True), ("enterprise_attestation", True), ("min_pin_length", 8)])
+def test_changed_config_needs_reset(sk, device, setting, value):
+    authenticator = device.authenticator
+    setattr(authenticator, setting, value)
+    with sk.KeySession(device) as key:
+        assert not sk.clean_fido_credentials(key, "2468", ["1357"])
+    assert len(authenticator.credentials) == 1
+    assert authenticator.pin_retries == 8
+
+
+def test_unknown_pins_are_tried_at_most_twice(sk, device):
+    authenticator = device.authenticator
+    with sk.KeySession(device) as key:
+        assert not sk.clean_fido_credentials(key, "2468", ["0000", "1111", "1357"])
+        assert len(authenticator.credentials) == 1
+        assert authenticator.pin_retries == 6
+        assert not sk.clean_fido_credentials(key, "2468", [])
+
+
+def test_no_pin_is_tried_with_three_retries_left(sk, device):
+    authenticator = device.authenticator
+    authenticator.pin_retries = 3
+    with sk.KeySession(device) as key:
+        assert not sk.clean_fido_credentials(key, "2468", ["1357"])
+    assert len(authenticator.credentials) == 1
+    assert authenticator.pin_retries == 3
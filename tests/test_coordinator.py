@@ -0,0 +1,117 @@
+import threading
+
+import pytest
+import requests
+
+from coordinator import RemoteCoordinator
+
+
+@pytest.fixture
+def coordinator(sk, tmp_path):
+    coordinator = sk.Coordinator(str(tmp_path / "coordinator.db"))
+    coordinator.add(
+        {"UPN": f"user{i}@example.com", "PIN change required": True, "Secure Transport Mode": False} for i in range(3)
+    )
+    return coordinator
+
+
+def record(upn, serial_number):
+    return {
+        "upn": upn, "name": upn.split("@")[0], "model": "YubiKey 5 NFC", "serial_number": serial_number,
+        "pin": "1357", "pin_change": True, "nfc_restricted": False, "auth_method": f"method-{serial_number}",
+    }
+
+
+def test_lease(coordinator):
+    assert coordinator.add([{"UPN": "USER0@example.com", "PIN change required": True, "Secure Transport Mode": True}]) == 0
+    assert coordinator.lease("a", count=2) == [
+        {"upn": "user0@example.com", "pin_change": True, "nfc_restricted": False},
+        {"upn": "user1@example.com", "pin_change": True, "nfc_restricted": False},
+    ]
+    assert [job["upn"] for job in coordinator.lease("b", count=2)] == ["user2@example.com"]
+    assert coordinator.lease("c") == []
+    assert coordinator.status()["jobs"] == {"leased": 3}
+
+
+def test_expired_lease_is_handed_out_again(coordinator):
+    coordinator.lease("a", count=3, duration=-1)
+    assert [job["upn"] for job in coordinator.lease("b")] == ["user0@example.com"]
+    assert coordinator.renew("a", ["user0@example.com", "user1@example.com"]) == ["user1@example.com"]
+    assert coordinator.renew("b", ["user0@example.com"]) == ["user0@example.com"]
+
+
+def test_reclaim(coordinator):
+    coordinator.lease("a", count=2)
+    coordinator.lease("b")
+    assert [job["upn"] for job in coordinator.reclaim("a")] == ["user0@example.com", "user1@example.com"]
+    assert coordinator.reclaim("c") == []
+
+
+def test_release_and_fail(coordinator):
+    coordinator.lease("a", count=2)
+    coordinator.release("a", "user0@example.com")
+    coordinator.fail("a", "user1@example.com", "No YubiKey")
+    assert [job["upn"] for job in coordinator.lease("b", count=3)] == ["user0@example.com", "user2@example.com"]
+    assert coordinator.status()["failed"] == [{"upn": "user1@example.com", "station": "a", "error": "No YubiKey"}]
+
+
+def test_complete(coordinator):
+    coordinator.lease("a", duration=-1)
+    coordinator.lease("b")
+
+    # The enrollment is accepted from the station whose lease expired, and reported again without effect
+    assert coordinator.complete("a", record("user0@example.com", 1001)) == {"accepted": True}
+    assert coordinator.complete("a", record("user0@example.com", 1001)) == {"accepted": True}
+    assert coordinator.status()["jobs"] == {"completed": 1, "pending": 2}
+    assert coordinator.renew("b", ["user0@example.com"]) == []
+
+    # Only the first YubiKey of a user is accepted
+    assert coordinator.complete("b", record("user0@example.com", 1002)) == {
+        "accepted": False, "upn": "user0@example.com", "station": "a", "serial_number": 1001
+    }
+    [enrollment] = coordinator.enrollments()
+    assert enrollment["serial_number"] == 1001
+    assert enrollment["station"] == "a"
+    assert "pin" not in enrollment
+    assert coordinator.enrollments(pins=True)[0]["pin"] == "1357"
+
+
+def test_complete_rejects_serial_number_of_another_user(coordinator):
+    coordinator.lease("a", count=2)
+    assert coordinator.complete("a", record("user0@example.com", 1001)) == {"accepted": True}
+    assert coordinator.complete("a", record("user1@example.com", 1001)) == {
+        "accepted": False, "upn": "user0@example.com", "station": "a", "serial_number": 1001
+    }
+    assert [enrollment["upn"] for enrollment in coordinator.enrollments()] == ["user0@example.com"]
+    [failed] = coordinator.status()["failed"]
+    assert failed["upn"] == "user1@example.com"
+    assert "1001" in failed["error"]
+
+
+@pytest.mark.parametrize("token", [None, "secret"])
+def test_served_coordinator(sk, coordinator, token):
+    server = sk.create_coordinator_server(coordinator, port=0, token=token)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        remote = RemoteCoordinator(url, token)
+        assert [job["upn"] for job in remote.lease("a", count=2)] == ["user0@example.com", "user1@example.com"]
+        assert remote.complete("a", record("user0@example.com", 1001)) == {"accepted": True}
+        assert remote.status()["jobs"] == {"completed": 1, "leased": 1, "pending": 1}
+        assert "pin" not in remote.enrollments()[0]
+        if token is None:
+            # Without a token, nobody on the host may read the PINs
+            with pytest.raises(requests.HTTPError, match="403"):
+                remote.enrollments(pins=True)
+        else:
+            assert remote.enrollments(pins=True)[0]["pin"] == "1357"
+            with pytest.raises(requests.HTTPError, match="401"):
+                RemoteCoordinator(url, "wrong").status()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_served_coordinator_requires_token_off_loopback(sk, coordinator):
+    with pytest.raises(ValueError):
+        sk.create_coordinator_server(coordinator, host="0.0.0.0", port=0)
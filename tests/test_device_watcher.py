@@ -0,0 +1,91 @@
+import socket
+import threading
+import time
+
+import pytest
+
+
+class PolledBackend:
+    """Device backend without device notifications (as on Windows and macOS), counting the scans."""
+
+    def __init__(self):
+        self.yubikeys = {}
+        self.scans = 0
+
+    def list_yubikeys(self):
+        self.scans += 1
+        return dict(self.yubikeys)
+
+    def open_event_socket(self):
+        return None
+
+
+class NotifyingBackend(PolledBackend):
+    """Device backend with device notifications (as on Linux), failing to read new devices for a while."""
+
+    def __init__(self):
+        super().__init__()
+        self.unreadable = set()
+        self.skipped = []
+        self.kernel, self.watcher = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def list_yubikeys(self):
+        self.scans += 1
+        attached = dict(self.yubikeys)
+        self.skipped = [device.fingerprint for device in attached.values() if device.fingerprint in self.unreadable]
+        return {serial: device for serial, device in attached.items() if device.fingerprint not in self.skipped}
+
+    def open_event_socket(self):
+        return self.watcher
+
+    def insert(self, serial_number):
+        self.yubikeys[serial_number] = Device(str(serial_number))
+        self.kernel.send(b"add@/devices/hidraw0\0ACTION=add\0SUBSYSTEM=hidraw\0")
+
+
+class Device:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+
+
+@pytest.fixture
+def backend(sk):
+    backend = PolledBackend()
+    sk.use_device_backend(backend)
+    return backend
+
+
+def test_polls_slowly_while_nobody_waits(sk, backend):
+    watcher = sk.DeviceWatcher(backend, min_interval=0.01, max_interval=0.02, idle_interval=5)
+    generation, yubikeys = watcher.snapshot()
+    time.sleep(0.5)
+    assert backend.scans <= 2
+
+    # A thread waiting for a change wakes the watcher up, which then polls quickly until it has found the change
+    threading.Timer(0.2, backend.yubikeys.update, [{1001: Device("1001")}]).start()
+    assert watcher.wait_for_change(generation, timeout=2)
+    assert 5 < backend.scans < 100
+    assert 1001 in watcher.snapshot()[1]
+
+    scans = backend.scans
+    time.sleep(0.5)
+    assert backend.scans <= scans + 2
+
+
+def test_scans_until_new_device_can_be_read(sk):
+    backend = NotifyingBackend()
+    sk.use_device_backend(backend)
+    watcher = sk.DeviceWatcher(backend, min_interval=0.01, max_interval=0.02, idle_interval=5)
+    generation, yubikeys = watcher.snapshot()
+
+    # The device cannot be read right after the event (udev still applying permissions), but a few scans later
+    backend.unreadable.add("1001")
+    backend.insert(1001)
+    threading.Timer(0.5, backend.unreadable.clear).start()
+    assert watcher.wait_until(lambda yubikeys: 1001 in yubikeys, timeout=2)
+
+    # Once every device was read, the watcher waits for the next event
+    time.sleep(0.3)
+    scans = backend.scans
+    time.sleep(0.5)
+    assert backend.scans == scans
@@ -0,0 +1,37 @@
+import pytest
+
+import simulator
+
+
+@pytest.fixture
+def directory(sk, ledger):
+    """A mock of Microsoft Graph API with four users (returned two per page of users/delta), with sk-entra-id.py
+    connected to it."""
+    server = simulator.MockGraphServer(
+        users=["alice@example.com", "albert@example.com", "bob@example.com", "carol@example.com"], page_size=2
+    ).start()
+    sk.connect_to_graph(server.config()).result()
+    yield server
+    server.stop()
+
+
+def test_cached_users_are_looked_up_without_requests(sk, ledger, directory):
+    assert sk.sync_directory() == (True, 4)
+    assert ledger.directory.size() == 4
+    assert ledger.directory.complete_user_principal_name("AL") == ["albert@example.com", "alice@example.com"]
+
+    requests = len(directory.requests)
+    user_profile, status_code = sk.fetch_user("bob@example.com")
+    assert (user_profile["userPrincipalName"], status_code) == ("bob@example.com", 200)
+    assert len(directory.requests) == requests
+
+
+def test_only_changes_are_synchronised(sk, ledger, directory):
+    sk.sync_directory()
+    directory.remove_user("bob@example.com")
+    assert sk.sync_directory() == (True, 1)
+    assert ledger.directory.size() == 3
+    assert ledger.directory.user("bob@example.com") is None
+
+    # Without the cache, the user is looked up in Microsoft Graph API (where the user no longer exists)
+    assert sk.fetch_user("bob@example.com") == (None, 404)
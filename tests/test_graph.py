@@ -0,0 +1,92 @@
+import pytest
+import requests
+
+from conftest import fail_requests
+
+
+def response_with(headers):
+    response = requests.Response()
+    response.status_code = 429
+    response.headers.update(headers)
+    return response
+
+
+def test_retry_delay_honours_retry_after(sk):
+    assert sk.get_retry_delay(response_with({"Retry-After": "7"}), 0) == 7
+    assert sk.get_retry_delay(response_with({"Retry-After": "Thu, 01 Jan 1970 00:00:00 GMT"}), 0) == 0
+    for attempt in range(10):
+        assert 0 <= sk.get_retry_delay(None, attempt, base=1, cap=8) <= min(8, 2 ** attempt)
+
+
+def test_request_retries_throttled_request(sk, server, no_retry_delay, monkeypatch):
+    failed = fail_requests(monkeypatch, server, 429, "GET", "/alice@example.com", times=2)
+    paused = []
+    monkeypatch.setattr(sk.graph.rate_limiter, "pause", paused.append)
+
+    response = sk.graph.get(f"{sk.graph_endpoint}/users/alice@example.com")
+    assert response.status_code == 200
+    assert len(failed) == 2
+    assert no_retry_delay == [0, 1]
+    assert paused == [0, 0]
+
+
+def test_request_records_attempts(sk, server, no_retry_delay, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(
+        sk.telemetry, "graph_request", lambda method, url, response, attempts, duration: recorded.append(attempts)
+    )
+    sk.graph.get(f"{sk.graph_endpoint}/users/alice@example.com")
+    fail_requests(monkeypatch, server, 429, "GET", "/alice@example.com", times=2)
+    sk.graph.get(f"{sk.graph_endpoint}/users/alice@example.com")
+    assert recorded == [1, 3]
+
+
+def test_request_gives_up_after_max_retries(sk, server, no_retry_delay, monkeypatch):
+    failed = fail_requests(monkeypatch, server, 503, "GET", "/alice@example.com")
+    response = sk.graph.get(f"{sk.graph_endpoint}/users/alice@example.com")
+    assert response.status_code == 503
+    assert len(failed) == sk.graph.max_retries + 1
+
+
+def test_request_does_not_retry_client_errors(sk, server, no_retry_delay, monkeypatch):
+    failed = fail_requests(monkeypatch, server, 400, "GET", "/alice@example.com")
+    assert sk.graph.get(f"{sk.graph_endpoint}/users/alice@example.com").status_code == 400
+    assert len(failed) == 1
+
+
+def test_batch_resends_throttled_requests(sk, server, no_retry_delay, monkeypatch):
+    failed = fail_requests(monkeypatch, server, 429, "GET", "/user3@example.com", times=2)
+    paused = []
+    monkeypatch.setattr(sk.graph.rate_limiter, "pause", paused.append)
+    batches = []
+    post = sk.graph.post
+    monkeypatch.setattr(sk.graph, "post", lambda url, json: batches.append(json["requests"]) or post(url, json=json))
+
+    requests_by_id = {str(i): {"method": "GET", "url": f"/users/user{i}@example.com"} for i in range(20)}
+    responses = sk.graph.batch(f"{sk.graph_endpoint}/$batch", requests_by_id)
+    assert {request_id: response.status_code for request_id, response in responses.items()} == dict.fromkeys(
+        requests_by_id, 200
+    )
+    assert responses["3"].json()["userPrincipalName"] == "user3@example.com"
+    assert paused == [0, 0]
+
+    # Only the throttled request is sent again
+    assert failed == ["/beta/users/user3@example.com"] * 2
+    assert [len(batch) for batch in batches] == [20, 1, 1]
+    assert batches[1] == [{"id": "3", **requests_by_id["3"]}]
+
+
+def test_batch_returns_failed_requests(sk, server, no_retry_delay, monkeypatch):
+    fail_requests(monkeypatch, server, 503, "GET", "/user1@example.com")
+    responses = sk.graph.batch(
+        f"{sk.graph_endpoint}/$batch",
+        {"0": {"method": "GET", "url": "/users/user0@example.com"}, "1": {"method": "GET", "url": "/users/user1@example.com"}},
+    )
+    assert responses["0"].status_code == 200
+    assert responses["1"].status_code == 503
+    assert len(no_retry_delay) == sk.graph.max_retries
+
+
+def test_batch_size_is_limited(sk, server):
+    with pytest.raises(ValueError):
+        sk.graph.batch(f"{sk.graph_endpoint}/$batch", {str(i): {"method": "GET", "url": "/users/a@b"} for i in range(21)})
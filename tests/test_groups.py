@@ -0,0 +1,28 @@
+def test_members_are_checked_page_by_page(sk, server, ledger):
+    server.group_size = 50
+    group = server.find_group("Support")
+    members = [server.users[user_id] for user_id in group["members"]]
+    ledger.add("Member 2", members[1]["userPrincipalName"], "YubiKey 5 NFC", 1001, "1357", True, True)
+    server.methods[members[2]["id"]] = {"method-1": {"id": "method-1"}}
+
+    entries = sk.read_groups(["Support"])
+    first = next(entries)
+    assert first["UPN"] == members[0]["userPrincipalName"]
+    assert server.requests.count(("POST", "/beta/$batch")) == 1
+
+    upns = [first["UPN"]] + [entry["UPN"] for entry in entries]
+    assert upns == [member["userPrincipalName"] for member in members[:1] + members[3:]]
+    assert server.requests.count(("POST", "/beta/$batch")) == 3
+
+
+def test_users_with_fido2_methods_are_skipped(sk, server, ledger, station, tmp_path, capsys):
+    (tmp_path / "users.csv").write_text("UPN\nalice@example.com\nbob@example.com\n")
+    alice = server.find_user("alice@example.com")
+    server.methods[alice["id"]] = {"method-1": {"id": "method-1"}}
+
+    sk.batch_registration("users.csv")
+    output = capsys.readouterr().out
+    assert "'alice@example.com' already has 1 FIDO2 security key(s) registered, skipping." in output
+    assert "Completed 1 of 1 enrollment(s)" in output
+    assert not ledger.has_user("alice@example.com")
+    assert ledger.has_user("bob@example.com")
@@ -0,0 +1,13 @@
+from click.testing import CliRunner
+
+from conftest import fail_requests
+
+
+def test_failed_creation_options_leave_enrollment_to_resume(sk, server, ledger, station, monkeypatch):
+    failed = fail_requests(monkeypatch, server, 400, "GET", "/creationOptions")
+    serial_number = station.attached[0].info.serial
+    with CliRunner().isolation(input="alice@example.com\n"):
+        sk.yubikey_eob_registration(server.config())
+    assert failed
+    assert ledger.journal_state(serial_number)["stage"] == "pin_set"
+    assert not ledger.has_serial_number(serial_number)
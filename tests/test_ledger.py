@@ -0,0 +1,190 @@
+import pytest
+from click.testing import CliRunner
+
+from conftest import start_enrollment
+
+
+def test_add_and_remove(ledger):
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", 1001, "1357", True, False, "method-1")
+    assert ledger.has_serial_number(1001)
+    assert ledger.has_user("ALICE@example.com")
+    assert ledger.enrollment("alice@example.com")["auth_method"] == "method-1"
+
+    ledger.remove(1001)
+    assert not ledger.has_serial_number(1001)
+    assert not ledger.has_user("alice@example.com")
+
+
+def test_journal_state(ledger):
+    ledger.journal(1001, "started", upn="alice@example.com", pin="1357")
+    ledger.journal(1001, "pin_set", user_id="alice-id")
+    assert ledger.journal_state(1001) == {
+        "stage": "pin_set", "upn": "alice@example.com", "pin": "1357", "user_id": "alice-id"
+    }
+    assert list(ledger.unfinished()) == [1001]
+    assert ledger.known_pins(1001) == ["1357"]
+
+    # A new enrollment of the YubiKey starts from scratch
+    ledger.journal(1001, "started", upn="bob@example.com", pin="2468")
+    assert ledger.journal_state(1001)["upn"] == "bob@example.com"
+    assert "user_id" not in ledger.journal_state(1001)
+
+    ledger.add("Bob", "bob@example.com", "YubiKey 5 NFC", 1001, "2468", True, False)
+    assert ledger.journal_state(1001) is None
+    assert ledger.unfinished() == {}
+
+
+def test_export_csv(ledger):
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", 1001, "1357", True, False, "method-1")
+    ledger.export_csv("export.csv")
+    with open("export.csv") as f:
+        lines = f.read().splitlines()
+    assert lines == ["Name,UPN,Model,Serial number,PIN,PIN change required,Secure Transport Mode",
+                     "Alice,alice@example.com,YubiKey 5 NFC,1001,1357,True,False"]
+
+    ledger.export_csv("export.csv", method_ids=True)
+    with open("export.csv") as f:
+        lines = f.read().splitlines()
+    assert lines[0].endswith(",Secure Transport Mode,FIDO2 method ID")
+    assert lines[1].endswith(",True,False,method-1")
+
+    # The method IDs are imported again with the rest of the records
+    ledger.remove(1001)
+    assert ledger.import_csv("export.csv") == 1
+    assert ledger.enrollment("alice@example.com")["auth_method"] == "method-1"
+
+
+def test_export_registration_status(ledger):
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", 1001, "1357", True, False, "method-1")
+    credential = dict.fromkeys(["credential_id", "attestation", "client_data", "extensions", "challenge_timeout"], "")
+    for serial_number, upn in ((1002, "bob@example.com"), (1003, "carol@example.com")):
+        ledger.registrations.queue(serial_number, upn, credential, "HTTP 503")
+        ledger.add(upn, upn, "YubiKey 5 NFC", serial_number, "2468", True, False)
+    ledger.registrations.update(1003, "failed", 1, last_error="HTTP 400")
+
+    # A queued registration is only told apart on request, and a failed one is only listed on request
+    ledger.export_csv("export.csv")
+    with open("export.csv") as f:
+        lines = f.read().splitlines()
+    assert lines[0].endswith(",Secure Transport Mode")
+    assert [line.split(",")[3] for line in lines[1:]] == ["1001", "1002"]
+
+    assert ledger.export_csv("export.csv", registration_status=True) == 3
+    with open("export.csv") as f:
+        lines = f.read().splitlines()
+    assert lines[0].endswith(",Secure Transport Mode,Registration")
+    assert [line.split(",")[-1] for line in lines[1:]] == ["registered", "pending", "failed"]
+
+    # The status is imported again with the rest of the records
+    ledger.remove(1003)
+    assert ledger.import_csv("export.csv") == 3
+    assert ledger.enrollment("carol@example.com")["registration"] == "failed"
+    assert not ledger.has_user("carol@example.com")
+
+
+def test_csv_output_file_is_kept_up_to_date(sk, ledger):
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", 1001, "1357", True, False, "method-1")
+    ledger.add("Bob", "bob@example.com", "YubiKey 5 NFC", 1002, "2468", True, False)
+    with open(sk.output_file) as f:
+        assert [line.split(",")[1] for line in f.read().splitlines()] == ["UPN", "alice@example.com", "bob@example.com"]
+
+    ledger.remove(1002)
+    with open(sk.output_file) as f:
+        assert [line.split(",")[1] for line in f.read().splitlines()] == ["UPN", "alice@example.com"]
+
+
+def test_csv_output_file_edited_by_hand(sk, ledger):
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", 1001, "1357", True, False, "method-1")
+    ledger.add("Bob", "bob@example.com", "YubiKey 5 NFC", 1002, "2468", True, False)
+
+    # Bob's row is deleted (to enroll him again) and Alice's PIN is edited
+    with open(sk.output_file) as f:
+        header, alice, bob = f.read().splitlines()
+    with open(sk.output_file, "w") as f:
+        f.write(f"{header}\n{alice.replace(',1357,', ',9999,')}\n")
+
+    # The edits are applied when the ledger is opened again, keeping what the CSV file does not hold
+    sk.ledger = None
+    ledger = sk.open_ledger()
+    assert not ledger.has_user("bob@example.com")
+    enrollment = ledger.enrollment("alice@example.com")
+    assert (enrollment["pin"], enrollment["auth_method"]) == ("9999", "method-1")
+    assert not ledger.sync_csv()
+
+
+def test_csv_output_file_of_earlier_version(sk):
+    with open(sk.output_file, "w") as f:
+        f.write("Name,UPN,Model,Serial number,PIN,PIN change required,Secure Transport Mode\n"
+                "Alice,alice@example.com,YubiKey 5 NFC,1001,1357,True,False\n")
+    ledger = sk.open_ledger()
+    assert ledger.has_serial_number(1001)
+
+    # A CSV file the ledger did not write is only imported (it may be older than the ledger), nothing is removed
+    ledger.add("Bob", "bob@example.com", "YubiKey 5 NFC", 1002, "2468", True, False)
+    with ledger.connect() as connection:
+        connection.execute("DELETE FROM csv_export")
+    with open(sk.output_file, "w") as f:
+        f.write("Name,UPN,Model,Serial number,PIN,PIN change required,Secure Transport Mode\n")
+    assert ledger.sync_csv()
+    assert ledger.has_user("alice@example.com") and ledger.has_user("bob@example.com")
+
+
+def test_resume_after_crash(sk, server, ledger, station, monkeypatch):
+    device = station.list_yubikeys()[station.attached[0].info.serial]
+    state = start_enrollment(ledger, device.info.serial, "alice@example.com")
+
+    # The station crashes while registering the credential
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    registration = sk.create_and_activate_fido_method
+    monkeypatch.setattr(sk, "create_and_activate_fido_method", crash)
+    with sk.KeySession(device) as key:
+        with pytest.raises(KeyboardInterrupt):
+            sk.continue_enrollment(key, state, sk.reset_yubikey_on_station, print)
+        state = ledger.journal_state(key.serial_number)
+        assert state["stage"] == "credential_created"
+        assert not ledger.has_serial_number(key.serial_number)
+
+        # Once restarted, the stored attestation is registered instead of creating another credential
+        monkeypatch.setattr(sk, "create_and_activate_fido_method", registration)
+        assert sk.continue_enrollment(key, state, sk.reset_yubikey_on_station, print, resume=True)
+        assert len(device.authenticator.credentials) == 1
+
+    user = server.find_user("alice@example.com")
+    assert len(server.methods[user["id"]]) == 1
+    assert ledger.journal_state(device.info.serial) is None
+    assert ledger.enrollment("alice@example.com")["auth_method"] in server.methods[user["id"]]
+
+
+def test_stores_share_the_database(sk, ledger):
+    ledger.inventory.add(1001, "YubiKey 5 NFC", (5, 7, 1), "2468", {"pin_change": True})
+    assert [yubikey["pin"] for yubikey in ledger.inventory.prepped()] == ["2468"]
+    assert ledger.known_pins(1001) == ["2468"]
+
+    # Enrolling a prepped YubiKey takes it out of the inventory
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", 1001, "1357", True, False, "method-1")
+    assert ledger.inventory.prepped(1001) == []
+
+    # A ledger opened again (e.g., by another worker) finds the records of every store
+    reopened = sk.Ledger(sk.ledger_file)
+    assert reopened.has_user("alice@example.com")
+    assert reopened.known_pins(1001) == ["1357"]
+
+
+def test_revoke(sk, server, ledger, station, monkeypatch):
+    device = station.list_yubikeys()[station.attached[0].info.serial]
+    state = start_enrollment(ledger, device.info.serial, "alice@example.com")
+    with sk.KeySession(device) as key:
+        assert sk.continue_enrollment(key, state, sk.reset_yubikey_on_station, print)
+    auth_method = ledger.enrollment("alice@example.com")["auth_method"]
+
+    monkeypatch.setattr(sk, "load_config", lambda config_file=None: server.config())
+    result = CliRunner().invoke(sk.main, ["revoke", "--yes", str(device.info.serial)])
+    assert result.exception is None, result.output
+    assert "Revoked 1 of 1 YubiKey(s)." in result.output
+    assert server.methods[server.find_user("alice@example.com")["id"]] == {}
+    assert not ledger.has_user("alice@example.com")
+    assert ledger.connect().execute("SELECT serial_number, upn, auth_method FROM revocations").fetchall() == [
+        (device.info.serial, "alice@example.com", auth_method)
+    ]
@@ -0,0 +1,32 @@
+def test_read_csv_manifest(sk, tmp_path):
+    (tmp_path / "users.csv").write_text(
+        "UPN,PIN change required,Secure Transport Mode\n"
+        " alice@example.com ,no,yes\n"
+        ",,\n"
+        "bob@example.com,,\n"
+    )
+    assert list(sk.read_manifest("users.csv")) == [
+        {"UPN": "alice@example.com", "PIN change required": False, "Secure Transport Mode": True},
+        {"UPN": "bob@example.com", "PIN change required": True, "Secure Transport Mode": True},
+    ]
+
+
+def test_read_jsonl_manifest(sk, tmp_path):
+    (tmp_path / "users.jsonl").write_text(
+        '{"UPN": "alice@example.com", "PIN change required": false, "Secure Transport Mode": "no"}\n'
+        "\n"
+        '{"UPN": "bob@example.com"}\n'
+    )
+    assert list(sk.read_manifest("users.jsonl")) == [
+        {"UPN": "alice@example.com", "PIN change required": False, "Secure Transport Mode": False},
+        {"UPN": "bob@example.com", "PIN change required": True, "Secure Transport Mode": True},
+    ]
+
+
+def test_manifest_users_already_enrolled_are_skipped(sk, server, ledger, station, tmp_path, capsys):
+    (tmp_path / "users.csv").write_text("UPN\nalice@example.com\nbob@example.com\n")
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", 1001, "1357", True, False)
+
+    sk.batch_registration("users.csv")
+    assert "Completed 1 of 1 enrollment(s)" in capsys.readouterr().out
+    assert ledger.has_user("bob@example.com")
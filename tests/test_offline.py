@@ -0,0 +1,45 @@
+import pytest
+from click.testing import CliRunner
+
+import simulator
+
+
+@pytest.fixture
+def interrupted(sk, ledger, station, tmp_path):
+    """An interactive enrollment for alice@example.com interrupted before the user was looked up, and a manifest
+    listing her. Returns the serial number of the YubiKey."""
+    serial_number = station.attached[0].info.serial
+    ledger.journal(serial_number, "started", upn="alice@example.com", pin="1357", prepped=False)
+    (tmp_path / "users.csv").write_text("UPN,PIN change required,Secure Transport Mode\nalice@example.com,no,no\n")
+    return serial_number
+
+
+def test_offline_resume_needs_stored_user(sk, ledger, interrupted, monkeypatch):
+    # Microsoft Graph API is unreachable (and never connected to) offline
+    server = simulator.MockGraphServer()
+    monkeypatch.setattr(sk, "load_config", lambda config_file=None: server.config())
+
+    result = CliRunner().invoke(sk.main, ["--offline", "--manifest", "users.csv"])
+    assert result.exception is None, result.output
+    assert "No creation options stored for 'alice@example.com', resume the enrollment online." in result.output
+    assert ledger.journal_state(interrupted)["stage"] == "started"
+    assert not ledger.has_user("alice@example.com")
+    assert server.requests == []
+
+
+def test_offline_resume_with_stored_user(sk, server, ledger, interrupted, monkeypatch):
+    monkeypatch.setattr(sk, "load_config", lambda config_file=None: server.config())
+    result = CliRunner().invoke(sk.main, ["prefetch", "users.csv"])
+    assert "Stored creation options for 1 of 1 user(s)." in result.output
+
+    requests = len(server.requests)
+    result = CliRunner().invoke(sk.main, ["--offline", "--manifest", "users.csv"])
+    assert result.exception is None, result.output
+    assert "Credential stored for upload." in result.output
+    assert len(server.requests) == requests
+    assert ledger.journal_state(interrupted) is None
+    assert ledger.registrations.queued("offline")[0]["serial_number"] == interrupted
+
+    [registration] = sk.registration_queue.upload()
+    assert registration["status"] == "registered"
+    assert ledger.enrollment("alice@example.com")["serial_number"] == interrupted
@@ -0,0 +1,29 @@
+from fido2.utils import sha256
+
+import simulator
+
+
+def test_prep_resets_and_records_the_yubikey(sk, ledger):
+    station = simulator.SimulatedStation(1, pin="1357")
+    sk.use_device_backend(station)
+    device = station.list_yubikeys()[station.attached[0].info.serial]
+
+    assert sk.prep_on_station(device) == {"pin_change": True, "secure_transport": True}
+    [prepped] = ledger.inventory.prepped()
+    assert (prepped["serial_number"], prepped["model"]) == (device.info.serial, "YubiKey 5 NFC")
+
+    # The PIN set before is gone (the YubiKey was reset), the YubiKey has the PIN recorded in the inventory
+    authenticator = station.removed[0].authenticator
+    assert authenticator.pin_hash == sha256(prepped["pin"].encode())[:16]
+    assert ledger.known_pins(device.info.serial) == [prepped["pin"]]
+
+
+def test_bind_only_enrolls_prepped_yubikeys(sk, ledger):
+    ledger.inventory.add(1001, "YubiKey 5 NFC", (5, 7, 1), "2468", {"pin_change": True, "secure_transport": True})
+    ledger.journal(1003, "started", upn="carol@example.com", pin="1357")
+    assert sk.is_enrollable(1002)
+
+    sk.bind_only = True
+    assert sk.is_enrollable(1001)
+    assert not sk.is_enrollable(1002)
+    assert sk.is_enrollable(1003)  # An unfinished enrollment is resumed
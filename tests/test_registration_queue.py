@@ -0,0 +1,107 @@
+import random
+import time
+
+import pytest
+
+from conftest import fail_requests, start_enrollment
+
+
+@pytest.fixture
+def queued(sk, server, ledger, station, monkeypatch):
+    """Enrolls a YubiKey while Microsoft Graph API fails to register it. Returns its serial number."""
+    sk.graph.max_retries = 0
+    failed = fail_requests(monkeypatch, server, 503, "POST", "/fido2Methods", times=1)
+    device = station.list_yubikeys()[station.attached[0].info.serial]
+    state = start_enrollment(ledger, device.info.serial, "alice@example.com")
+    with sk.KeySession(device) as key:
+        assert sk.continue_enrollment(key, state, sk.reset_yubikey_on_station, print)
+    assert len(failed) == 1
+    assert state["stage"] == "configured"
+    assert state["registration_error"] == "HTTP 503"
+    return device.info.serial
+
+
+def test_queued_registration_is_recorded(ledger, queued):
+    assert ledger.has_serial_number(queued)
+    assert ledger.enrollment("alice@example.com")["auth_method"] is None
+    assert ledger.enrollment("alice@example.com")["registration"] == "pending"
+    [registration] = ledger.registrations.queued()
+    assert registration["serial_number"] == queued
+    assert registration["status"] == "pending"
+    assert registration["last_error"] == "HTTP 503"
+
+
+def test_backoff(sk, server, ledger, queued, monkeypatch):
+    registration_queue = sk.RegistrationQueue(base=30, cap=900)
+    route = server._route
+    failed = fail_requests(monkeypatch, server, 503, "POST", "/fido2Methods")
+    monkeypatch.setattr(random, "uniform", lambda a, b: b)  # The longest backoff, without jitter
+
+    # A new registration is due immediately, and attempted again after the backoff
+    start = time.time()
+    [registration] = registration_queue.drain()
+    assert (registration["status"], registration["attempts"]) == ("pending", 1)
+    assert start + 30 <= ledger.registrations.queued()[0]["next_attempt"] <= time.time() + 30
+    assert registration_queue.drain() == []
+    assert len(failed) == 1
+
+    start = time.time()
+    [registration] = registration_queue.drain(force=True)
+    assert (registration["status"], registration["attempts"]) == ("pending", 2)
+    assert start + 60 <= ledger.registrations.queued()[0]["next_attempt"] <= time.time() + 60
+
+    # Once Microsoft Graph API recovers, the credential is registered and its ID recorded
+    monkeypatch.setattr(server, "_route", route)
+    [registration] = registration_queue.drain(force=True)
+    assert (registration["status"], registration["attempts"]) == ("registered", 3)
+    user = server.find_user("alice@example.com")
+    assert list(server.methods[user["id"]]) == [ledger.enrollment("alice@example.com")["auth_method"]]
+    assert ledger.enrollment("alice@example.com")["registration"] == "registered"
+    assert ledger.has_serial_number(queued)
+    assert registration_queue.drain(force=True) == []
+
+
+def test_rejected_registration_fails(sk, server, ledger, queued, monkeypatch):
+    fail_requests(monkeypatch, server, 400, "POST", "/fido2Methods")
+    [registration] = sk.registration_queue.drain()
+    assert (registration["status"], registration["last_error"]) == ("failed", "HTTP 400")
+    assert ledger.registrations.queued("failed")[0]["serial_number"] == queued
+
+    # The record is kept, marked as not registered, and the YubiKey and user are enrolled again
+    assert ledger.enrollment("alice@example.com")["registration"] == "failed"
+    assert not ledger.has_serial_number(queued)
+    assert not ledger.has_user("alice@example.com")
+
+
+@pytest.mark.parametrize("status", [408, 429])
+def test_timed_out_and_throttled_registrations_are_retried(sk, server, ledger, queued, monkeypatch, status):
+    fail_requests(monkeypatch, server, status, "POST", "/fido2Methods")
+    [registration] = sk.registration_queue.drain()
+    assert registration["status"] == "pending"
+    assert ledger.has_serial_number(queued)
+
+
+def test_expired_registration(sk, server, ledger, queued):
+    [registration] = ledger.registrations.queued()
+    requests = len(server.requests)
+    registration = sk.registration_queue.attempt({**registration, "challenge_timeout": "2000-01-01T00:00:00Z"})
+    assert registration["status"] == "expired"
+    assert len(server.requests) == requests
+    assert ledger.registrations.queued("expired")[0]["serial_number"] == queued
+    assert ledger.enrollment("alice@example.com")["registration"] == "expired"
+    assert ledger.known_pins(queued)[0] == "1357"
+    assert not ledger.has_serial_number(queued)
+
+
+def test_failed_registration_is_enrolled_again(sk, server, ledger, queued, monkeypatch):
+    fail_requests(monkeypatch, server, 400, "POST", "/fido2Methods", times=1)
+    sk.registration_queue.drain()
+    ledger.export_csv(sk.output_file)
+    with open(sk.output_file) as f:
+        assert len(f.read().splitlines()) == 1
+
+    # Enrolling the YubiKey again replaces the record
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", queued, "2468", True, False, "method-1")
+    enrollment = ledger.enrollment("alice@example.com")
+    assert (enrollment["registration"], enrollment["pin"]) == ("registered", "2468")
+    assert ledger.has_serial_number(queued)
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+import requests
+from click.testing import CliRunner
+
+
+def test_jobs_for_yubikeys_that_cannot_be_paired_fail(sk, ledger):
+    service = sk.create_enrollment_service()
+    ledger.add("Alice", "alice@example.com", "YubiKey 5 NFC", 1001, "1357", True, True)
+    ledger.journal(1002, "started", upn="bob@example.com", pin="2468")
+
+    job = service.submit("carol@example.com", 1001)
+    assert job["status"] == "failed"
+    assert "already enrolled for 'alice@example.com'" in job["error"]
+    events, finished = service.events(job["id"], timeout=0)
+    assert finished
+
+    job = service.submit("carol@example.com", 1002)
+    assert job["status"] == "failed"
+    assert "unfinished enrollment for 'bob@example.com'" in job["error"]
+
+    # The user of the unfinished enrollment can resume it
+    assert service.submit("BOB@example.com", 1002)["status"] == "queued"
+
+
+def pair(service, yubikeys):
+    # Pairs queued jobs with YubiKeys the way the thread of the service does
+    with service._condition:
+        return service._pair(yubikeys)
+
+
+def test_queued_job_fails_once_its_yubikey_is_enrolled(sk, ledger):
+    service = sk.create_enrollment_service()
+    job = service.submit("carol@example.com", 1003)
+    assert pair(service, {}) == []
+    assert service.job(job["id"])["status"] == "queued"
+
+    ledger.add("Dave", "dave@example.com", "YubiKey 5 NFC", 1003, "1357", True, True)
+    assert pair(service, {}) == []
+    assert service.job(job["id"])["status"] == "failed"
+    assert service.events(job["id"], timeout=0)[1]
+
+
+def test_api_rejects_options_that_are_not_booleans(sk, ledger):
+    service = sk.create_enrollment_service()
+    server = sk.create_api_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/jobs"
+        response = requests.post(url, json={"upn": "alice@example.com", "pin_change": "false"})
+        assert response.status_code == 400
+        assert "pin_change" in response.json()["error"]
+        assert requests.post(url, json={"upn": "alice@example.com", "secure_transport": 0}).status_code == 400
+        assert service.jobs() == []
+
+        response = requests.post(url, json={"upn": "alice@example.com", "pin_change": False})
+        assert response.status_code == 202
+        assert (response.json()["pin_change"], response.json()["nfc_restricted"]) == (False, True)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_serve_requires_token_off_loopback(sk):
+    with pytest.raises(ValueError):
+        sk.create_api_server(sk.create_enrollment_service(), host="0.0.0.0", port=0)
+    result = CliRunner().invoke(sk.main, ["serve", "--host", "0.0.0.0"], env={"SK_ENTRA_ID_TOKEN": None})
+    assert result.exit_code == 2
+    assert "A token is required to listen on '0.0.0.0'." in result.output
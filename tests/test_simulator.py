@@ -0,0 +1,27 @@
+from click.testing import CliRunner
+
+
+def test_simulated_enrollment_end_to_end(sk, tmp_path):
+    (tmp_path / "users.csv").write_text("UPN\nalice@example.com\nbob@example.com\ncarol@example.com\n")
+    result = CliRunner().invoke(sk.main, ["--simulate", "3", "--multi", "--manifest", "users.csv"])
+    assert result.exception is None, result.output
+    assert "Completed 3 of 3 enrollment(s)" in result.output
+
+    # The simulated YubiKeys are recorded apart from the real ones, each with its own PIN
+    assert not (tmp_path / "output.db").exists()
+    with open(tmp_path / "simulation.csv") as f:
+        rows = [line.split(",") for line in f.read().splitlines()[1:]]
+    assert sorted(row[1] for row in rows) == ["alice@example.com", "bob@example.com", "carol@example.com"]
+    assert len({row[3] for row in rows}) == 3
+
+
+def test_simulated_yubikey_is_registered_with_the_mock_server(sk, tmp_path):
+    (tmp_path / "users.csv").write_text("UPN\nalice@example.com\n")
+    result = CliRunner().invoke(sk.main, ["--simulate", "1", "--manifest", "users.csv"])
+    assert result.exception is None, result.output
+
+    # The credential created on the simulated YubiKey is the FIDO2 method registered for the user
+    [yubikey] = sk.device_backend.removed
+    assert len(yubikey.authenticator.credentials) == 1
+    assert yubikey.authenticator.pin_hash is not None
+    assert sk.ledger.enrollment("alice@example.com")["auth_method"]
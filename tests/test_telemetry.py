@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+
+def test_spans_are_recorded_as_events_and_metrics(sk):
+    telemetry = sk.Telemetry("events.jsonl", "metrics.prom", station="station-1")
+    with telemetry.span("enrollment", serial=1001, upn="Alice@example.com"):
+        with telemetry.span("pin") as event:
+            event["outcome"] = "failed"
+        with pytest.raises(ValueError):
+            with telemetry.span("register"):
+                raise ValueError
+
+    with open("events.jsonl") as f:
+        events = [json.loads(line) for line in f]
+    assert [(event["stage"], event["outcome"]) for event in events] == [
+        ("pin", "failed"), ("register", "error"), ("enrollment", "ok")
+    ]
+    # The User Principal Name is only recorded as a hash
+    assert {(event["station"], event["serial"], event["upn_hash"]) for event in events} == {
+        ("station-1", 1001, telemetry.hash_upn("alice@example.com"))
+    }
+
+    # The metrics are written once the outermost span ends
+    with open("metrics.prom") as f:
+        metrics = f.read()
+    assert 'sk_entra_id_stages_total{station="station-1",outcome="failed",stage="pin"} 1' in metrics
+    assert 'sk_entra_id_stage_duration_seconds_count{station="station-1",stage="enrollment"} 1' in metrics
+
+
+def test_graph_requests_are_labelled_by_endpoint(sk, server):
+    sk.telemetry.events_file = "events.jsonl"
+    sk.fetch_user("alice@example.com")
+    assert sk.telemetry.endpoint("https://graph.microsoft.com/beta/users/alice%40example.com/authentication/"
+                                 "fido2Methods/creationOptions") == "users/{id}/authentication/fido2Methods/creationOptions"
+
+    with open("events.jsonl") as f:
+        events = [json.loads(line) for line in f]
+    assert [(event["endpoint"], event["status"], event["attempts"]) for event in events] == [("users/{id}", 200, 1)]
+    assert 'endpoint="users/{id}",method="GET",status="200"' in sk.telemetry.format_metrics()
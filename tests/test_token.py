@@ -0,0 +1,20 @@
+def token_requests(server):
+    return server.requests.count(("POST", f"/{server.tenant_id}/oauth2/v2.0/token"))
+
+
+def test_token_is_reused(sk, server):
+    for upn in ("alice@example.com", "bob@example.com", "carol@example.com"):
+        user_profile, status_code = sk.fetch_user(upn)
+        assert status_code == 200
+    assert token_requests(server) == 1
+    assert sk.graph.token_provider._timer is not None  # Refreshed in the background before it expires
+
+
+def test_rejected_token_is_replaced(sk, server):
+    sk.fetch_user("alice@example.com")
+
+    # Microsoft Graph API no longer accepts the token (e.g., it was revoked): the request is sent again with a new one
+    server._tokens.clear()
+    user_profile, status_code = sk.fetch_user("bob@example.com")
+    assert status_code == 200
+    assert token_requests(server) == 2